@@ -0,0 +1,5 @@
+#!/bin/sh
+
+set -ex
+
+echo "Job $JOB_ID on $(hostname): greeting=$1 count=$2"
@@ -0,0 +1,106 @@
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import pickle
+from time import time
+
+
+logger = logging.getLogger(__name__)
+
+
+def default_cache_dir():
+    if os.environ.get('SPOT_RUNNER_CACHE_DIR'):
+        return Path(os.environ['SPOT_RUNNER_CACHE_DIR'])
+    base = Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache')
+    return base / 'spot-runner'
+
+
+def cache_enabled():
+    return os.environ.get('SPOT_RUNNER_CACHE', '1') != '0'
+
+
+class ApiCache:
+    '''
+    On-disk cache of replies of read-only AWS API calls, shared by all
+    spot-runner invocations.
+
+    Entries are keyed by region, operation name and call arguments.
+    An entry can be bound to a scope (for example instance id), so that all
+    entries related to given instance can be invalidated when its state changes.
+
+    Cache can be disabled by setting environment variable SPOT_RUNNER_CACHE=0.
+    '''
+
+    def __init__(self, cache_dir=None, enabled=None):
+        self._dir = Path(cache_dir) if cache_dir else default_cache_dir() / 'api'
+        self.enabled = cache_enabled() if enabled is None else enabled
+
+    def call(self, client, operation, ttl, scope=None, **kwargs):
+        '''
+        Return cached reply of client.<operation>(**kwargs) if it is not older
+        than ttl seconds, otherwise call the API and cache the reply.
+        '''
+        reply = self.get(client, operation, ttl, scope=scope, **kwargs)
+        if reply is None:
+            reply = getattr(client, operation)(**kwargs)
+            reply = self.put(client, operation, reply, scope=scope, **kwargs)
+        return reply
+
+    def get(self, client, operation, ttl, scope=None, **kwargs):
+        '''
+        Return cached reply or None if it is not cached or is older than ttl seconds.
+        '''
+        if not self.enabled:
+            return None
+        path = self._entry_path(client, operation, scope, kwargs)
+        try:
+            with path.open('rb') as f:
+                stored, reply = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.debug('Failed to read cache entry %s: %r', path, e)
+            return None
+        if time() - stored > ttl:
+            return None
+        logger.debug('Using cached %s reply (%.0f s old)', operation, time() - stored)
+        return reply
+
+    def put(self, client, operation, reply, scope=None, **kwargs):
+        '''
+        Save reply to cache and return it (without response metadata).
+        '''
+        reply = {k: v for k, v in reply.items() if k != 'ResponseMetadata'}
+        if not self.enabled:
+            return reply
+        path = self._entry_path(client, operation, scope, kwargs)
+        try:
+            self._dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+            temp_path = path.with_name('{}.tmp{}'.format(path.name, os.getpid()))
+            with temp_path.open('wb') as f:
+                pickle.dump((time(), reply), f)
+            os.replace(str(temp_path), str(path))
+        except OSError as e:
+            logger.debug('Failed to write cache entry %s: %r', path, e)
+        return reply
+
+    def invalidate(self, scope):
+        '''
+        Remove all entries bound to given scope.
+        '''
+        if not self._dir.is_dir():
+            return
+        for path in self._dir.glob('*.{}.pickle'.format(scope)):
+            logger.debug('Invalidating cache entry %s', path)
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def _entry_path(self, client, operation, scope, kwargs):
+        key_data = json.dumps([client.meta.region_name, operation, kwargs], sort_keys=True, default=str)
+        key = hashlib.sha1(key_data.encode()).hexdigest()
+        name = '{}-{}.{}.pickle'.format(operation, key, scope or '')
+        return self._dir / name
@@ -0,0 +1,81 @@
+import hashlib
+import json
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# Tags of baked images (and their snapshots)
+bake_hash_tag = 'SpotRunnerBake'
+bake_key_tag = 'SpotRunnerBakeKey'
+
+
+def bake_hash(region_name, launch_specification, data_sha1, setup_command):
+    '''
+    Return hash of everything that determines the content of a baked image:
+    launch specification (with the source image), uploaded data and the setup
+    command.
+    '''
+    payload = json.dumps({
+        'region': region_name,
+        'launch_specification': launch_specification,
+        'data_sha1': data_sha1,
+        'setup_command': setup_command,
+    }, sort_keys=True)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+def bake_key(region_name, bake_name):
+    '''
+    Return key identifying images baked from the same blueprint
+    (in all its versions), used for garbage collection.
+    '''
+    payload = json.dumps([region_name, bake_name])
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+def image_tag_specifications(digest, key, task_id):
+    tags = [
+        {'Key': bake_hash_tag, 'Value': digest},
+        {'Key': bake_key_tag, 'Value': key},
+        {'Key': 'TaskId', 'Value': task_id},
+        {'Key': 'CreatedBy', 'Value': __name__},
+    ]
+    return [
+        {'ResourceType': 'image', 'Tags': [{'Key': 'Name', 'Value': task_id}] + tags},
+        {'ResourceType': 'snapshot', 'Tags': tags},
+    ]
+
+
+def describe_baked_images(ec2_client, filters):
+    reply = ec2_client.describe_images(Owners=['self'], Filters=[
+        {'Name': 'state', 'Values': ['available']},
+    ] + filters)
+    return sorted(reply['Images'], key=lambda image: image['CreationDate'], reverse=True)
+
+
+def find_baked_image(ec2_client, digest):
+    '''
+    Return id of the newest available image baked with given hash or None.
+    '''
+    images = describe_baked_images(ec2_client, [{'Name': 'tag:' + bake_hash_tag, 'Values': [digest]}])
+    return images[0]['ImageId'] if images else None
+
+
+def gc_baked_images(ec2_client, key, keep):
+    '''
+    Deregister all but keep newest images baked from the blueprint with given
+    key (see bake_key) and delete their snapshots. Returns list of deregistered
+    image ids.
+    '''
+    images = describe_baked_images(ec2_client, [{'Name': 'tag:' + bake_key_tag, 'Values': [key]}])
+    removed = []
+    for image in images[keep:]:
+        logger.info('Deregistering old baked image %s (%s)', image['ImageId'], image['CreationDate'])
+        ec2_client.deregister_image(ImageId=image['ImageId'])
+        for mapping in image.get('BlockDeviceMappings') or []:
+            snapshot_id = (mapping.get('Ebs') or {}).get('SnapshotId')
+            if snapshot_id:
+                ec2_client.delete_snapshot(SnapshotId=snapshot_id)
+        removed.append(image['ImageId'])
+    return removed
@@ -1,64 +1,222 @@
+import hashlib
 import logging
+import os
 from pathlib import Path
-import yaml
+import pickle
+from time import time
 
+from .api_cache import cache_enabled, default_cache_dir
+from .compression import codec_names
 from .errors import AppError
-from .file_transformations import preprocess_file
+from .file_transformations import preprocess_file, read_file, track_file_reads, yaml_load
 
 logger = logging.getLogger(__name__)
 
 
 class Blueprint:
 
-    def __init__(self, path):
+    def __init__(self, path, use_cache=None):
         '''
         Parameter path is path to a blueprint file - see examples directory.
+
+        Resolved blueprint is cached on disk (see load_resolved_blueprint).
         '''
         self._path = Path(path)
         logger.info('Loading blueprint from %s', self._path)
         try:
-            content = preprocess_file(self._path)
-            d = yaml.safe_load(content)['spot_runner_blueprint']
-            base_dir = self._path.parent
+            if use_cache is None:
+                use_cache = cache_enabled()
+            if use_cache:
+                resolved = load_resolved_blueprint(self._path)
+            else:
+                resolved, reads = resolve_blueprint(self._path)
+            d = resolved['blueprint']
+            base_dir = self._path.resolve().parent
             self.region_name = d['region']
             self.ami_owner_id_whitelist = d.get('ami_owner_id_whitelist') or []
             self.task_id_template = d['task_id_template']
             self.spot_price = d['spot_price']
+            self.count = int(d.get('count') or 1)
+            self.max_workers = int(d.get('max_workers') or 10)
             self.upload_paths = to_paths(base_dir, d.get('upload'))
             self.upload_preprocessed_paths = to_paths(base_dir, d.get('upload_preprocessed'))
             self.remote_command = d['remote_command']
+            self.setup_command = d.get('setup_command')
+            self.bake_keep = int(d.get('bake_keep', 2))
+            self.bake_name = d.get('bake_name') or str(self._path.resolve())
+            self.download_paths = d.get('download') or []
+            self.download_dir = base_dir / (d.get('download_dir') or 'downloaded')
             self.launch_specification = d['launch_specification']
             self.ssh_username = d.get('ssh_username')
             self.interactive_shell = d.get('interactive_shell')
-            if d.get('ssh_private_key_path'):
-                ssh_pk_path = base_dir / d['ssh_private_key_path']
-                self.ssh_private_key = ssh_pk_path.read_text()
-                self.ssh_private_key_search_paths = None
-            else:
-                self.ssh_private_key, self.ssh_private_key_search_paths = \
-                    find_ssh_key(base_dir, self.launch_specification['KeyName'])
+            self.ssh_multiplexing = bool(d.get('ssh_multiplexing'))
+            self.fast_start = bool(d.get('fast_start'))
+            self.compression = d.get('compression') or 'auto'
+            if self.compression not in codec_names:
+                raise Exception('Invalid compression value: {!r}'.format(self.compression))
+            self.instance_types = d.get('instance_types') or []
+            self.subnet_ids = d.get('subnet_ids') or []
+            self.availability_zones = d.get('availability_zones') or []
+            if self.availability_zones and launch_spec_subnet_id(self.launch_specification):
+                raise Exception('availability_zones can not be used with SubnetId in launch_specification')
+            self.rank_by = d.get('rank_by') or 'vcpu'
+            self.max_relaunches = int(d.get('max_relaunches', 3))
+            self.checkpoint_command = d.get('checkpoint_command')
+            self.pool_idle_ttl = int(d.get('pool_idle_ttl') or 0)
+            if self.pool_idle_ttl and self.count != 1:
+                raise Exception('pool_idle_ttl can be used only with count 1')
+            self.race = d.get('race') or []
+            for entry in self.race:
+                if not entry.get('region'):
+                    raise Exception('Missing region in race entry {!r}'.format(entry))
+            if self.rank_by not in ('vcpu', 'memory'):
+                raise Exception('Invalid rank_by value: {!r}'.format(self.rank_by))
+            ssh_pk_path = resolved['ssh_private_key_path']
+            self.ssh_private_key = ssh_pk_path.read_text() if ssh_pk_path else None
+            self.ssh_private_key_search_paths = resolved['ssh_private_key_search_paths']
         except Exception as e:
             msg = 'Failed to read blueprint file {}: {!r}'.format(self._path, e)
             raise AppError(msg) from e
 
 
+def resolve_blueprint(path):
+    '''
+    Preprocess blueprint file and find SSH private key.
+
+    Returns tuple (resolved blueprint dict, files read - see track_file_reads).
+    '''
+    path = Path(path)
+    # absolute, so that the resolved paths do not depend on current directory when loaded from cache
+    base_dir = path.resolve().parent
+    with track_file_reads() as reads:
+        content = preprocess_file(path)
+        d = yaml_load(content)['spot_runner_blueprint']
+        if d.get('ssh_private_key_path'):
+            ssh_pk_path = base_dir / d['ssh_private_key_path']
+            ssh_pk_search_paths = None
+        else:
+            ssh_pk_path, ssh_pk_search_paths = \
+                find_ssh_key(base_dir, d['launch_specification']['KeyName'])
+    resolved = {
+        'blueprint': d,
+        'ssh_private_key_path': ssh_pk_path,
+        'ssh_private_key_search_paths': ssh_pk_search_paths,
+    }
+    return resolved, reads
+
+
+blueprint_cache_version = 2
+
+
+def load_resolved_blueprint(path, cache_dir=None):
+    '''
+    Return resolved blueprint (see resolve_blueprint) from cache.
+
+    Cache entry is used only if none of the files read while resolving
+    the blueprint have changed. Files are compared by mtime and size first,
+    by content hash if these differ.
+    '''
+    path = Path(path)
+    cache_dir = Path(cache_dir) if cache_dir else default_cache_dir() / 'blueprints'
+    key = hashlib.sha1(str(path.absolute()).encode()).hexdigest()
+    cache_path = cache_dir / '{}.pickle'.format(key)
+    try:
+        with cache_path.open('rb') as f:
+            entry = pickle.load(f)
+        if entry['version'] == blueprint_cache_version and dependencies_unchanged(entry['dependencies']):
+            logger.debug('Using cached blueprint %s', cache_path)
+            return entry['resolved']
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.debug('Failed to read cached blueprint %s: %r', cache_path, e)
+    resolved, reads = resolve_blueprint(path)
+    entry = {
+        'version': blueprint_cache_version,
+        'dependencies': {p: file_signature(p, sha1) for p, sha1 in reads.items()},
+        'resolved': resolved,
+    }
+    try:
+        cache_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+        temp_path = cache_path.with_name('{}.tmp{}'.format(cache_path.name, os.getpid()))
+        with temp_path.open('wb') as f:
+            pickle.dump(entry, f)
+        os.replace(str(temp_path), str(cache_path))
+    except OSError as e:
+        logger.debug('Failed to write cached blueprint %s: %r', cache_path, e)
+    return resolved
+
+
+def file_signature(path, sha1):
+    '''
+    Return tuple (mtime_ns, size, sha1) or None for file that does not exist.
+    '''
+    if sha1 is None:
+        return None
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return (None, None, sha1)
+    if time() - st.st_mtime < 2:
+        # file modified just now could be modified again within mtime resolution
+        return (None, None, sha1)
+    return (st.st_mtime_ns, st.st_size, sha1)
+
+
+def dependencies_unchanged(dependencies):
+    for path, signature in dependencies.items():
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            if signature is None:
+                continue
+            return False
+        if signature is None:
+            return False
+        mtime_ns, size, sha1 = signature
+        if (st.st_mtime_ns, st.st_size) == (mtime_ns, size):
+            continue
+        if hashlib.sha1(path.read_text().encode()).hexdigest() != sha1:
+            return False
+    return True
+
+
+def launch_spec_subnet_id(launch_specification):
+    '''
+    Return subnet given in launch specification (directly or in the first
+    network interface) or None.
+    '''
+    interfaces = launch_specification.get('NetworkInterfaces') or [{}]
+    return launch_specification.get('SubnetId') or interfaces[0].get('SubnetId')
+
+
 def to_paths(base_dir, value):
     if not value:
         return []
     assert isinstance(value, list)
-    return [base_dir / p for p in value]
+    return [base_dir / Path(p).expanduser() for p in value]
 
 
 def find_ssh_key(base_dir, key_name):
+    '''
+    Returns tuple (path of the SSH private key file or None, paths searched).
+    '''
     search_paths = [
         base_dir / '{}.pem'.format(key_name),
         base_dir / 'ssh_keys/{}.pem'.format(key_name),
         Path.home() / '.ssh/{}.pem'.format(key_name),
     ]
-    private_key = None
+    private_key_path = None
     for p in search_paths:
         logger.debug('Looking for SSH key in %s', p)
-        if p.is_file():
-            logger.info('Reading SSH key from %s', p)
-            private_key = p.read_text()
-    return (private_key, search_paths)
+        try:
+            # read (and not just check existence) so that the key file is tracked as blueprint dependency
+            read_file(p)
+        except FileNotFoundError:
+            continue
+        except OSError as e:
+            logger.debug('Failed to read %s: %r', p, e)
+            continue
+        logger.info('Reading SSH key from %s', p)
+        private_key_path = p
+    return (private_key_path, search_paths)
@@ -0,0 +1,136 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import logging
+
+from botocore.exceptions import ClientError
+
+from .listing import task_filters
+from .pool import instance_tags
+
+
+logger = logging.getLogger(__name__)
+
+# Max. number of ids in one terminate_instances or cancel_spot_instance_requests call
+batch_size = 500
+
+# Max. number of values of one filter of describe_* calls
+filter_batch_size = 100
+
+
+def find_task_resources(ec2_client, task_id=None, older_than=None, now=None):
+    '''
+    Return list of spot-runner resources in the client region that can be
+    cleaned up: open or active spot requests, instances that are not
+    terminated and volumes that are not attached to any instance.
+
+    Resources are filtered by tag TaskId (task_id may contain wildcards
+    * and ?) and by creation time (older_than is timedelta).
+    Each item is dict with keys region, type (spot_request, instance or
+    volume), id, task_id and created.
+    '''
+    now = now or datetime.now(timezone.utc)
+    region_name = ec2_client.meta.region_name
+    filters = task_filters(task_id)
+    resources = []
+
+    def add(resource_type, resource_id, resource, created):
+        if older_than is not None and created and now - created < older_than:
+            return
+        resources.append({
+            'region': region_name,
+            'type': resource_type,
+            'id': resource_id,
+            'task_id': instance_tags(resource).get('TaskId'),
+            'created': created.strftime('%Y-%m-%dT%H:%M:%SZ') if created else None,
+        })
+
+    pages = ec2_client.get_paginator('describe_spot_instance_requests').paginate(
+        Filters=filters + [{'Name': 'state', 'Values': ['open', 'active']}])
+    for page in pages:
+        for sir in page['SpotInstanceRequests']:
+            add('spot_request', sir['SpotInstanceRequestId'], sir, sir.get('CreateTime'))
+    pages = ec2_client.get_paginator('describe_instances').paginate(
+        Filters=filters + [{'Name': 'instance-state-name', 'Values': ['pending', 'running', 'stopping', 'stopped']}])
+    for page in pages:
+        for reservation in page['Reservations']:
+            for instance in reservation['Instances']:
+                add('instance', instance['InstanceId'], instance, instance.get('LaunchTime'))
+    pages = ec2_client.get_paginator('describe_volumes').paginate(
+        Filters=filters + [{'Name': 'status', 'Values': ['available']}])
+    for page in pages:
+        for volume in page['Volumes']:
+            add('volume', volume['VolumeId'], volume, volume.get('CreateTime'))
+    return resources
+
+
+def cleanup_resources(ec2_client, resources, wait=False):
+    '''
+    Cancel spot requests, terminate instances and delete volumes (items
+    of find_task_resources, all from the client region). Spot requests and
+    instances are handled in batches; volumes, which cannot be deleted
+    in batch, are deleted concurrently.
+
+    With wait=True wait until the instances are terminated and delete also
+    their volumes that are not deleted on termination.
+
+    Returns list of ids of volumes that could not be deleted.
+    '''
+    by_type = {}
+    for r in resources:
+        by_type.setdefault(r['type'], []).append(r['id'])
+    instance_ids = by_type.get('instance') or []
+    volume_ids = list(by_type.get('volume') or [])
+    kept_volume_ids = []
+    if wait:
+        for ids in batches(instance_ids, filter_batch_size):
+            reply = ec2_client.describe_volumes(Filters=[
+                {'Name': 'attachment.instance-id', 'Values': ids},
+                {'Name': 'attachment.delete-on-termination', 'Values': ['false']},
+            ])
+            kept_volume_ids += [v['VolumeId'] for v in reply['Volumes']]
+    for ids in batches(by_type.get('spot_request') or []):
+        logger.info('Cancelling spot requests: %s', ' '.join(ids))
+        ec2_client.cancel_spot_instance_requests(SpotInstanceRequestIds=ids)
+    for ids in batches(instance_ids):
+        logger.info('Terminating instances: %s', ' '.join(ids))
+        ec2_client.terminate_instances(InstanceIds=ids)
+    if kept_volume_ids:
+        logger.info('Waiting for %d instances to terminate...', len(instance_ids))
+        for ids in batches(instance_ids):
+            ec2_client.get_waiter('instance_terminated').wait(InstanceIds=ids)
+        for ids in batches(kept_volume_ids, filter_batch_size):
+            ec2_client.get_waiter('volume_available').wait(VolumeIds=ids)
+        volume_ids += kept_volume_ids
+    failed = []
+
+    def delete_volume(volume_id):
+        try:
+            ec2_client.delete_volume(VolumeId=volume_id)
+            logger.info('Deleted volume %s', volume_id)
+        except ClientError as e:
+            logger.warning('Failed to delete volume %s: %s', volume_id, e)
+            failed.append(volume_id)
+
+    if volume_ids:
+        with ThreadPoolExecutor(max_workers=min(len(volume_ids), 10)) as executor:
+            list(executor.map(delete_volume, volume_ids))
+    return failed
+
+
+def batches(items, size=None):
+    size = size or batch_size
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def format_table(resources):
+    lines = []
+    for r in resources:
+        lines.append('  '.join([
+            r['region'].ljust(14),
+            r['type'].ljust(12),
+            r['id'].ljust(22),
+            (r['created'] or '-')[:16].replace('T', ' ').ljust(16),
+            str(r.get('action') or '-').ljust(14),
+            str(r['task_id'] or '-'),
+        ]))
+    return ''.join(line + '\n' for line in lines)
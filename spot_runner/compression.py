@@ -0,0 +1,140 @@
+from contextlib import contextmanager
+import logging
+from pathlib import Path
+import shlex
+import shutil
+import subprocess
+import zlib
+
+
+logger = logging.getLogger(__name__)
+
+# Compression programs used on both sides of tar transfers (upload and
+# download), the preferred first - a tuple, because the order matters
+# (dict order is arbitrary in Python 3.5). Each reads stdin and writes
+# stdout; with -d it decompresses (that is how tar -I calls it too).
+codec_programs = (
+    ('zstd', ['zstd', '-1', '-T0', '-q']),
+    ('lz4', ['lz4', '-1', '-q']),
+    ('gzip', ['gzip', '-1']),
+)
+
+codec_commands = dict(codec_programs)
+
+# Codec "none" transfers plain tar, "ssh" plain tar with ssh -C (zlib)
+codec_names = ('auto', 'zstd', 'lz4', 'gzip', 'none', 'ssh')
+
+# Uncompressed throughput (bytes/s) above which compression ratio matters
+# less than compression speed
+fast_link_throughput = 100 * 2**20
+
+# Estimated ratio (compressed / original size) above which compression
+# is not worth the CPU time
+incompressible_ratio = 0.9
+
+compressed_suffixes = {
+    '.gz', '.tgz', '.bz2', '.xz', '.zst', '.lz4', '.zip', '.7z', '.rar',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.mp3', '.mp4', '.mkv', '.avi',
+    '.parquet', '.orc', '.npz', '.pdf',
+}
+
+remote_codecs_script = 'for c in {}; do command -v $c >/dev/null 2>&1 && echo $c; done; true'.format(
+    ' '.join(c for c, cmd in codec_programs))
+
+
+def local_codecs():
+    return [c for c, cmd in codec_programs if shutil.which(cmd[0])]
+
+
+def parse_remote_codecs(output):
+    return [line.strip() for line in output.splitlines() if line.strip() in codec_commands]
+
+
+def tar_compress_args(codec):
+    '''
+    Return tar arguments (list) to compress or decompress the archive by codec.
+    '''
+    if codec not in codec_commands:
+        return []
+    return ['-I', ' '.join(codec_commands[codec])]
+
+
+def estimate_compressibility(items, sample_size=65536):
+    '''
+    Return estimated ratio of compressed and original size of upload items
+    (dict {path in archive: source Path or bytes content}).
+
+    Beginning of every file is compressed by fast zlib; files with suffixes
+    of already compressed formats are not sampled at all.
+    '''
+    total_size = 0
+    compressed_size = 0
+    for name, item in items.items():
+        if isinstance(item, bytes):
+            size, sample = len(item), item[:sample_size]
+        else:
+            size = item.stat().st_size
+            if Path(name).suffix.lower() in compressed_suffixes:
+                total_size += size
+                compressed_size += size
+                continue
+            with item.open('rb') as f:
+                sample = f.read(sample_size)
+        if not sample:
+            continue
+        ratio = min(len(zlib.compress(sample, 1)) / len(sample), 1)
+        total_size += size
+        compressed_size += size * ratio
+    return compressed_size / total_size if total_size else 1
+
+
+def choose_codec(available, ratio=None, throughput=None):
+    '''
+    Choose codec for a transfer from codecs available on both sides,
+    estimated compression ratio (see estimate_compressibility) and measured
+    throughput of previous transfers (bytes/s of uncompressed data).
+    '''
+    if ratio is not None and ratio > incompressible_ratio:
+        return 'none'
+    if throughput and throughput > fast_link_throughput and 'lz4' in available:
+        return 'lz4'
+    for codec, cmd in codec_programs:
+        if codec in available:
+            return codec
+    return 'ssh'
+
+
+@contextmanager
+def compressor(codec, f):
+    '''
+    Yield binary file object; data written to it are compressed by codec
+    and written to f (that must have a file descriptor, like a pipe to
+    another process). For codecs none and ssh data are written to f as is.
+    '''
+    if codec not in codec_commands:
+        yield f
+        return
+    f.flush()
+    p = subprocess.Popen(codec_commands[codec] + ['-c'], stdin=subprocess.PIPE, stdout=f)
+    try:
+        yield p.stdin
+    finally:
+        try:
+            p.stdin.close()
+        except BrokenPipeError:
+            pass
+        returncode = p.wait()
+    if returncode != 0:
+        raise Exception('Compression by {} failed with exit code {}'.format(codec, returncode))
+
+
+def decompress_command(codec):
+    return codec_commands[codec] + ['-d', '-c'] if codec in codec_commands else None
+
+
+def remote_tar_command(codec, tar_args):
+    '''
+    Return shell command running tar with given arguments (list)
+    and with compression by codec.
+    '''
+    return ' '.join(shlex.quote(a) for a in ['tar'] + tar_compress_args(codec) + tar_args)
@@ -0,0 +1,82 @@
+import logging
+import os
+import shlex
+import tarfile
+
+from .compression import remote_tar_command
+
+
+logger = logging.getLogger(__name__)
+
+# Packs one remote path (file or directory) into tar archive on stdout,
+# compressed by given codec (see compression module).
+download_script_template = '''\
+set -e
+p={path}
+cd "$(dirname -- "$p")"
+{tar} "$(basename -- "$p")"
+'''
+
+
+def download_script(remote_path, codec='gzip'):
+    return download_script_template.format(
+        path=shlex.quote(str(remote_path).rstrip('/') or '/'),
+        tar=remote_tar_command(codec, ['-c', '-f', '-', '--']))
+
+
+def extract_tar_stream(f, dest_dir):
+    '''
+    Extract uncompressed tar archive from binary file object f into dest_dir
+    as the data are read (streaming mode, the archive is not stored anywhere).
+
+    Returns number of extracted members.
+    '''
+    dest_dir.mkdir(parents=True, exist_ok=True)
+    count = 0
+    with tarfile.open(fileobj=f, mode='r|') as tar:
+        for member in tar:
+            if hasattr(tarfile, 'data_filter'):
+                # reject absolute paths, links outside dest_dir etc.
+                tar.extract(member, str(dest_dir), filter='data')
+            else:
+                check_member(member, dest_dir)
+                tar.extract(member, str(dest_dir))
+            count += 1
+    return count
+
+
+def check_member(member, dest_dir):
+    '''
+    Raise exception if tar member would be extracted outside dest_dir or is
+    a link pointing outside dest_dir (for Pythons without tarfile.data_filter).
+
+    Paths are resolved with links already extracted, so a file cannot be
+    written through a link either.
+    '''
+    dest = os.path.realpath(str(dest_dir))
+    path = os.path.join(dest, member.name)
+    targets = [path]
+    if member.issym():
+        targets.append(os.path.join(os.path.dirname(path), member.linkname))
+    elif member.islnk():
+        targets.append(os.path.join(dest, member.linkname))
+    elif not (member.isfile() or member.isdir()):
+        raise Exception('Unsupported member type in downloaded archive: {!r}'.format(member.name))
+    for target in targets:
+        if os.path.commonpath([dest, os.path.realpath(target)]) != dest:
+            raise Exception('Unsafe path in downloaded archive: {!r}'.format(member.name))
+
+
+class CountingReader:
+    '''
+    Wraps binary file object and counts bytes read from it.
+    '''
+
+    def __init__(self, f):
+        self._f = f
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        self.size += len(data)
+        return data
@@ -1,16 +1,69 @@
+from contextlib import contextmanager
+import hashlib
 import logging
 import jinja2
+import os
 from pathlib import Path
+import threading
 import yaml
 
 logger = logging.getLogger(__name__)
 
+_tracking = threading.local()
+
+
+@contextmanager
+def track_file_reads():
+    '''
+    Record all files read by functions of this module (and by read_file below)
+    within this context.
+
+    Yields dict {Path: sha1 hex digest of the file content or None if the file
+    was looked for, but did not exist}.
+    '''
+    reads = {}
+    stack = getattr(_tracking, 'stack', None)
+    if stack is None:
+        stack = _tracking.stack = []
+    stack.append(reads)
+    try:
+        yield reads
+    finally:
+        stack.pop()
+
+
+def record_file_read(path, content):
+    '''
+    Record file read for track_file_reads. Content is str, bytes or None if
+    the file does not exist.
+    '''
+    for reads in getattr(_tracking, 'stack', None) or []:
+        if content is None:
+            reads[Path(path).absolute()] = None
+        else:
+            data = content.encode() if isinstance(content, str) else content
+            reads[Path(path).absolute()] = hashlib.sha1(data).hexdigest()
+
+
+def read_file(path):
+    '''
+    Read text file; the read is recorded by track_file_reads.
+    '''
+    path = Path(path)
+    try:
+        with path.open() as f:
+            content = f.read()
+    except FileNotFoundError:
+        record_file_read(path, None)
+        raise
+    record_file_read(path, content)
+    return content
+
 
 def preprocess_file(file_path, content=None, values=None):
     logger.info('Preprocessing %s', file_path)
     if content is None:
-        with file_path.open() as f:
-            content = f.read()
+        content = read_file(file_path)
     base_path = Path(file_path).parent
     while True:
         first_line, rest = extract_first_line(content)
@@ -36,60 +89,120 @@ def preprocess_jinja(base_path, content, values=None):
     t = jinja2.Template(content)
     # TODO: jinja includes
 
-    def read_file(*paths):
+    def jinja_read_file(*paths):
         for path in paths:
             full_path = base_path / path
             try:
-                with full_path.open('r') as f:
-                    return f.read()
+                return read_file(full_path)
             except FileNotFoundError:
                 logger.info('File not found: %s (%s)', path, full_path)
                 continue
         raise Exception('Failed to read file(s) {}'.format(' '.join(str(p) for p in paths)))
 
     values.update({
-        'read_file': read_file,
+        'read_file': jinja_read_file,
     })
     return t.render(**values)
 
 
 def preprocess_yaml_includes(base_path, content):
     assert isinstance(content, str)
+    data = yaml_load(content)
+    data = IncludeResolver().resolve(data, Path(base_path))
+    return yaml_dump(data)
 
-    def r(obj):
+
+class IncludeResolver:
+    '''
+    Replaces INCLUDE_TEXT and INCLUDE_YAML directives with the file content.
+
+    Included YAML files are resolved recursively (paths relative to the
+    included file); include cycles are detected. Every file is resolved only
+    once per resolver and parsed only once per process (until it changes).
+    '''
+
+    def __init__(self):
+        self._resolved = {}
+
+    def resolve(self, obj, base_path, include_stack=()):
         if isinstance(obj, list):
-            return [r(v) for v in obj]
+            return [self.resolve(v, base_path, include_stack) for v in obj]
         if isinstance(obj, dict):
             if len(obj) == 1:
                 (k, v), = obj.items()
                 if k == 'INCLUDE_TEXT':
                     inc_path = base_path / v
                     logger.info('Including text file %s', inc_path)
-                    with inc_path.open() as f:
-                        return f.read()
+                    return read_file(inc_path)
                 elif k == 'INCLUDE_YAML':
                     inc_path = base_path / v
                     logger.info('Including YAML file %s', inc_path)
-                    with inc_path.open() as f:
-                        return yaml_load(f.read())
-            return {k: r(v) for k, v in obj.items()}
+                    return self.resolve_yaml_file(inc_path, include_stack)
+            return {k: self.resolve(v, base_path, include_stack) for k, v in obj.items()}
         return obj
 
+    def resolve_yaml_file(self, path, include_stack):
+        key = os.path.abspath(str(path))
+        if key in include_stack:
+            cycle = ' -> '.join(include_stack[include_stack.index(key):] + (key, ))
+            raise Exception('Include cycle detected: {}'.format(cycle))
+        if key not in self._resolved:
+            data = load_yaml_file(path)
+            self._resolved[key] = self.resolve(data, Path(path).parent, include_stack + (key, ))
+        return self._resolved[key]
+
+
+_yaml_file_cache = {}
+_yaml_file_cache_lock = threading.Lock()
+
+
+def load_yaml_file(path):
+    '''
+    Load YAML file. Parsed content is kept in memory and reused until
+    the file changes.
+
+    The returned object is shared, it must not be modified.
+    '''
+    key = os.path.abspath(str(path))
+    try:
+        st = os.stat(key)
+    except FileNotFoundError:
+        record_file_read(path, None)
+        raise
+    with _yaml_file_cache_lock:
+        cached = _yaml_file_cache.get(key)
+    if cached and cached[:2] == (st.st_mtime_ns, st.st_size):
+        mtime_ns, size, sha1, data = cached
+        for reads in getattr(_tracking, 'stack', None) or []:
+            reads[Path(key)] = sha1
+        return data
+    content = read_file(path)
     data = yaml_load(content)
-    data = r(data)
-    return yaml_dump(data)
+    sha1 = hashlib.sha1(content.encode()).hexdigest()
+    with _yaml_file_cache_lock:
+        _yaml_file_cache[key] = (st.st_mtime_ns, st.st_size, sha1, data)
+    return data
+
+
+# Use LibYAML bindings if available - they are much faster
+_SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+_SafeDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
 
 
 def yaml_load(content):
-    return yaml.safe_load(content)
+    return yaml.load(content, Loader=_SafeLoader)
 
 
 def yaml_dump(obj):
     return yaml.dump(obj, width=120, default_flow_style=False, Dumper=_CustomDumper)
 
 
-class _CustomDumper (yaml.SafeDumper):
-    pass
+class _CustomDumper (_SafeDumper):
+
+    def ignore_aliases(self, data):
+        # included files are shared objects; always dump them in full
+        return True
+
 
 def _str_representer(dumper, data):
     style = '|' if '\n' in data else None
@@ -0,0 +1,116 @@
+import json
+import logging
+from threading import Event, Thread
+
+
+logger = logging.getLogger(__name__)
+
+# Prints spot interruption notice (JSON) if there is any; uses IMDSv2
+instance_action_script = '''\
+token=$(curl -sf -m 5 -X PUT -H 'X-aws-ec2-metadata-token-ttl-seconds: 60' http://169.254.169.254/latest/api/token)
+curl -sf -m 5 -H "X-aws-ec2-metadata-token: $token" http://169.254.169.254/latest/meta-data/spot/instance-action
+true
+'''
+
+# EC2 StateReason codes of instances reclaimed by AWS
+interruption_state_reasons = ('Server.SpotInstanceTermination', 'Server.SpotInstanceShutdown')
+
+
+def parse_instance_action(output):
+    '''
+    Return interruption notice (dict with keys action and time) from output
+    of instance_action_script or None if there is no notice.
+    '''
+    output = output.strip()
+    if not output:
+        return None
+    try:
+        notice = json.loads(output)
+    except ValueError:
+        logger.debug('Unexpected instance-action output: %r', output)
+        return None
+    return notice if isinstance(notice, dict) and notice.get('action') else None
+
+
+def is_interrupted_state(instance_state):
+    '''
+    Return True if EC2 instance (dict State, StateReason from describe_instances
+    or None if it no longer exists) was reclaimed by AWS.
+    '''
+    if instance_state is None:
+        return True
+    if instance_state['State']['Name'] in ('pending', 'running'):
+        return False
+    return (instance_state.get('StateReason') or {}).get('Code') in interruption_state_reasons
+
+
+class InterruptionWatcher:
+    '''
+    Background thread that polls for spot interruption notice (via
+    poll_notice function) and for instance state (via poll_instance_state
+    function) while it is active (use as a context manager).
+
+    Function on_notice is called once with the notice when the notice
+    appears - for example to run a checkpoint hook. Function on_reclaim
+    is called when the instance is found reclaimed - for example to stop
+    commands still waiting for the dead instance.
+    '''
+
+    def __init__(self, poll_notice, poll_instance_state, on_notice=None, interval=15, state_interval=60,
+                 on_reclaim=None):
+        self._poll_notice = poll_notice
+        self._poll_instance_state = poll_instance_state
+        self._on_notice = on_notice
+        self._on_reclaim = on_reclaim
+        self._interval = interval
+        self._state_interval = state_interval
+        self._stop = Event()
+        self._thread = None
+        self.notice = None
+        self.reclaimed = False
+
+    def __enter__(self):
+        self._thread = Thread(target=self._run, name='InterruptionWatcher', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    @property
+    def interrupted(self):
+        return bool(self.notice) or self.reclaimed
+
+    def _run(self):
+        since_state_check = 0
+        while not self._stop.wait(self._interval):
+            if not self.notice:
+                try:
+                    self.notice = self._poll_notice()
+                except Exception as e:
+                    logger.debug('Failed to poll interruption notice: %r', e)
+                if self.notice:
+                    logger.warning('Spot interruption notice: %r', self.notice)
+                    if self._on_notice:
+                        try:
+                            self._on_notice(self.notice)
+                        except Exception as e:
+                            logger.error('Interruption notice hook failed: %r', e)
+            since_state_check += self._interval
+            if since_state_check >= self._state_interval:
+                since_state_check = 0
+                try:
+                    instance_state = self._poll_instance_state()
+                except Exception as e:
+                    logger.debug('Failed to poll instance state: %r', e)
+                    continue
+                if is_interrupted_state(instance_state):
+                    logger.warning('Instance was reclaimed: %r', instance_state)
+                    self.reclaimed = True
+                    if self._on_reclaim:
+                        try:
+                            self._on_reclaim()
+                        except Exception as e:
+                            logger.error('Instance reclaim hook failed: %r', e)
+                    return
@@ -0,0 +1,128 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+from .pool import idle_until_tag, instance_tags
+
+
+logger = logging.getLogger(__name__)
+
+region_list_ttl = 86400
+
+# Tag CreatedBy of resources created by any spot-runner version
+created_by_pattern = 'spot_runner.*'
+
+active_instance_states = ['pending', 'running', 'shutting-down', 'stopping', 'stopped']
+
+
+def list_regions(ec2_client, api_cache):
+    '''
+    Return sorted names of regions enabled in the account (cached for a day).
+    '''
+    reply = api_cache.call(ec2_client, 'describe_regions', region_list_ttl)
+    return sorted(r['RegionName'] for r in reply['Regions'])
+
+
+def task_filters(task_id=None):
+    '''
+    Return API filters of resources tagged by spot-runner (optionally only
+    of tasks matching task_id, which may contain wildcards * and ?).
+    '''
+    filters = [{'Name': 'tag:CreatedBy', 'Values': [created_by_pattern]}]
+    if task_id:
+        filters.append({'Name': 'tag:TaskId', 'Values': [task_id]})
+    return filters
+
+
+def describe_task_instances(ec2_client, task_id=None, include_terminated=False):
+    '''
+    Return instances launched by spot-runner in the client region as list
+    of dicts (see instance_row). Instances are filtered by the API, not here;
+    task_id may contain wildcards * and ?.
+    '''
+    filters = task_filters(task_id)
+    if not include_terminated:
+        filters.append({'Name': 'instance-state-name', 'Values': active_instance_states})
+    paginator = ec2_client.get_paginator('describe_instances')
+    pages = paginator.paginate(Filters=filters, PaginationConfig={'PageSize': 1000})
+    region_name = ec2_client.meta.region_name
+    return [instance_row(region_name, i) for page in pages for r in page['Reservations'] for i in r['Instances']]
+
+
+def instance_row(region_name, instance):
+    tags = instance_tags(instance)
+    return {
+        'region': region_name,
+        'instance_id': instance['InstanceId'],
+        'instance_type': instance.get('InstanceType'),
+        'state': instance['State']['Name'],
+        'launch_time': instance['LaunchTime'].strftime('%Y-%m-%dT%H:%M:%SZ') if instance.get('LaunchTime') else None,
+        'public_ip': instance.get('PublicIpAddress'),
+        'lifecycle': instance.get('InstanceLifecycle') or 'on-demand',
+        'task_id': tags.get('TaskId'),
+        'pool_idle_until': int(tags[idle_until_tag]) if tags.get(idle_until_tag) else None,
+    }
+
+
+def list_instances(regions, create_client, task_id=None, include_terminated=False):
+    '''
+    List spot-runner instances in all regions concurrently (see map_regions).
+    '''
+    results = map_regions(
+        regions, create_client,
+        lambda ec2_client: describe_task_instances(
+            ec2_client, task_id=task_id, include_terminated=include_terminated))
+    rows = [row for region_rows in results for row in region_rows or []]
+    rows.sort(key=lambda row: (row['region'], row['launch_time'] or '', row['instance_id']))
+    return rows
+
+
+def map_regions(regions, create_client, f):
+    '''
+    Call f(ec2_client) for all regions concurrently and return list of results
+    (None for regions where f fails - the error is reported and skipped).
+
+    Clients (create_client(region_name)) are created one by one in this
+    thread, because boto3 session is not thread-safe; the call for each
+    region starts right after its client is created, so it overlaps with
+    creating the next ones.
+    '''
+    def call(ec2_client):
+        try:
+            return f(ec2_client)
+        except Exception as e:
+            logger.warning('Failed in %s: %s', ec2_client.meta.region_name, e)
+            return None
+
+    with ThreadPoolExecutor(max_workers=min(len(regions), 32) or 1) as executor:
+        futures = [executor.submit(call, create_client(region_name)) for region_name in regions]
+    return [f.result() for f in futures]
+
+
+def join_local_tasks(rows, local_tasks):
+    '''
+    Add keys stage and state_path (state file path or SQLite state name)
+    to rows of instances found in local_tasks (dict {instance id:
+    {'stage': ..., 'state_path': ...}}).
+    '''
+    for row in rows:
+        local = local_tasks.get(row['instance_id']) or {}
+        row['stage'] = local.get('stage')
+        row['state_path'] = local.get('state_path')
+    return rows
+
+
+def format_table(rows):
+    lines = []
+    for row in rows:
+        stage = row.get('stage') or ('idle (pool)' if row['pool_idle_until'] else '-')
+        lines.append('  '.join([
+            row['region'].ljust(14),
+            row['instance_id'].ljust(19),
+            str(row['instance_type'] or '-').ljust(12),
+            row['state'].ljust(13),
+            (row['launch_time'] or '-')[:16].replace('T', ' ').ljust(16),
+            str(row['public_ip'] or '-').ljust(15),
+            stage.ljust(11),
+            str(row['task_id'] or '-'),
+        ]))
+    return ''.join(line + '\n' for line in lines)
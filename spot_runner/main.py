@@ -1,15 +1,20 @@
 import click
 from datetime import datetime
+import json
 import logging
 import os
 from pathlib import Path
 import sys
 from tempfile import TemporaryDirectory
 
-from .blueprint import Blueprint
 from .errors import AppError
-from .state import open_state_file
-from .workflow import RunSpotInstance
+from .state_scan import read_simple_state_value, sqlite_prefix
+from .timings import \
+    read_jsonl, save_timings_to_state, summarize, timings, write_jsonl, write_prometheus_textfile
+
+# Modules that import boto3, jinja2 or yaml (workflow, blueprint, state...)
+# are imported in the commands that need them, so that read-only commands
+# like instance-id start fast.
 
 
 logger = logging.getLogger(__name__)
@@ -35,83 +40,411 @@ def spot_runner_main():
 @click.group()
 @click.option('--verbose', '-v', count=True)
 @click.option('--log', metavar='FILE', help='path to log file')
-def cli(verbose, log):
+@click.option('--timings-jsonl', metavar='FILE', help='append phase and API call timings to JSON lines file')
+@click.option('--timings-textfile', metavar='FILE', help='write timings to node_exporter textfile')
+@click.pass_obj
+def cli(obj, verbose, log, timings_jsonl, timings_textfile):
     log_path = log or os.environ.get('SPOT_RUNNER_LOG')
     setup_logging(console_level=verbose, log_file=log_path)
+    obj['timings_jsonl'] = timings_jsonl or os.environ.get('SPOT_RUNNER_TIMINGS_JSONL')
+    obj['timings_textfile'] = timings_textfile or os.environ.get('SPOT_RUNNER_TIMINGS_TEXTFILE')
 
 
 @cli.command()
 @click.option('--blueprint', metavar='FILE', default='blueprint.yaml')
-@click.option('--state', metavar='FILE', help='path to state file')
+@click.option('--state', metavar='FILE', help='path to state file or sqlite:DB_PATH[#NAME]')
 @click.option('--new-state', '-n', is_flag=True, help='create new state file')
 def run_spot_instance(blueprint, state, new_state):
+    from .blueprint import Blueprint
+    from .state import backup_state, open_state_file
+    from .workflow import RunSpotInstances
     bp = Blueprint(blueprint)
-    state_path = Path(
-        state or
-        os.environ.get('SPOT_RUNNER_STATE') or
-        Path(blueprint).with_name('state.yaml'))
+    state_path = get_state_path(state, blueprint)
     if new_state:
-        if state_path.is_file():
-            backup_suffix = '.backup-{date}'.format(
-                date=datetime.utcnow().strftime('%Y%m%dT%H%M%SZ'))
-            backup_path = state_path.with_name(state_path.name + backup_suffix)
-            assert not backup_path.exists()
-            logger.info('Renaming %s -> %s', state_path, backup_path)
-            state_path.rename(backup_path)
+        backup_state(state_path)
     with open_state_file(state_path) as state:
-        with TemporaryDirectory(prefix='spot_runner.') as td:
-            r = RunSpotInstance(state=state, blueprint=bp, temp_dir=Path(td))
-            r.run_spot_instance()
+        try:
+            with TemporaryDirectory(prefix='spot_runner.') as td:
+                with RunSpotInstances(state=state, blueprint=bp, temp_dir=Path(td)) as r:
+                    r.run_spot_instance()
+        finally:
+            export_timings(state, 'run-spot-instance')
 
 
 @cli.command()
 @click.option('--blueprint', metavar='FILE', default='blueprint.yaml')
-@click.option('--state', metavar='FILE', help='path to state file')
-def instance_id(blueprint, state):
+@click.option('--sweep', metavar='FILE', default='sweep.yaml')
+@click.option('--state', metavar='FILE', help='path to state file or sqlite:DB_PATH[#NAME]')
+@click.option('--new-state', '-n', is_flag=True, help='create new state file')
+def run_sweep(blueprint, sweep, state, new_state):
     '''
-    Read instance id from state file
+    Run jobs from sweep file on a bounded set of instances
+    '''
+    from .blueprint import Blueprint
+    from .state import backup_state, open_state_file
+    from .sweep import RunSweep, Sweep
+    bp = Blueprint(blueprint)
+    sw = Sweep(sweep)
+    state_path = get_state_path(state, blueprint)
+    if new_state:
+        backup_state(state_path)
+    with open_state_file(state_path) as state:
+        try:
+            with TemporaryDirectory(prefix='spot_runner.') as td:
+                RunSweep(state=state, blueprint=bp, sweep=sw, temp_dir=Path(td)).run_sweep()
+        finally:
+            export_timings(state, 'run-sweep')
+
+
+@cli.command()
+@click.option('--blueprint', metavar='FILE', default='blueprint.yaml')
+@click.option('--state', metavar='FILE', help='path to state file or sqlite:DB_PATH[#NAME]')
+@click.option('--instance', metavar='INDEX', type=int, help='instance index (multi-instance tasks only)')
+@click.option('--dest', metavar='DIR', help='local directory (default: blueprint download_dir)')
+@click.argument('paths', nargs=-1)
+def download(blueprint, state, instance, dest, paths):
+    '''
+    Download remote paths (default: blueprint download list)
     '''
-    state_path = Path(
-        state or
-        os.environ.get('SPOT_RUNNER_STATE') or
-        Path(blueprint).with_name('state.yaml'))
+    from .blueprint import Blueprint
+    from .state import open_state_file
+    from .workflow import RunSpotInstances
+    bp = Blueprint(blueprint)
+    paths = list(paths) or bp.download_paths
+    if not paths:
+        raise AppError('No paths to download - pass them as arguments or list them in blueprint download section')
+    state_path = get_state_path(state, blueprint)
     with open_state_file(state_path) as state:
-        print(state['instance_id'])
+        try:
+            with TemporaryDirectory(prefix='spot_runner.') as td:
+                with RunSpotInstances(state=state, blueprint=bp, temp_dir=Path(td)) as r:
+                    r.download(paths, Path(dest) if dest else bp.download_dir, instance_index=instance)
+        finally:
+            export_timings(state, 'download')
 
 
 @cli.command()
 @click.option('--blueprint', metavar='FILE', default='blueprint.yaml')
-@click.option('--state', metavar='FILE', help='path to state file')
-def ip_address(blueprint, state):
+@click.option('--state', metavar='FILE', help='state file of the bake (default: bake-state.yaml next to blueprint)')
+@click.option('--force', is_flag=True, help='bake even if an image with matching bake hash exists')
+def bake(blueprint, state, force):
+    '''
+    Create AMI with setup_command done; following runs launch from it
+    '''
+    from .blueprint import Blueprint
+    from .state import backup_state, open_state_file
+    from .workflow import RunSpotInstance
+    bp = Blueprint(blueprint)
+    if not bp.setup_command:
+        raise AppError('Blueprint has no setup_command to bake')
+    if bp.race:
+        raise AppError('Baking is not supported in race mode')
+    state_path = get_state_path(state, blueprint) if state else Path(blueprint).with_name('bake-state.yaml')
+    backup_state(state_path)
+    with open_state_file(state_path) as state:
+        try:
+            with TemporaryDirectory(prefix='spot_runner.') as td:
+                with RunSpotInstance(state=state, blueprint=bp, temp_dir=Path(td)) as r:
+                    print(r.bake(force=force))
+        finally:
+            export_timings(state, 'bake')
+
+
+def export_timings(state, command):
+    '''
+    Save timings of this run into the state and into files given by options
+    --timings-jsonl and --timings-textfile.
+    '''
+    records = list(timings.records)
+    if not records:
+        return
+    save_timings_to_state(state, command, records)
+    obj = click.get_current_context().obj
+    try:
+        if obj.get('timings_jsonl'):
+            write_jsonl(obj['timings_jsonl'], records, task_id=state.get('task_id'))
+        if obj.get('timings_textfile'):
+            write_prometheus_textfile(obj['timings_textfile'], records, task_id=state.get('task_id'))
+    except OSError as e:
+        logger.warning('Failed to write timings: %r', e)
+
+
+@cli.command('timings')
+@click.option('--blueprint', metavar='FILE', default='blueprint.yaml')
+@click.option('--state', metavar='FILE', help='path to state file or sqlite:DB_PATH[#NAME]')
+@click.option('--jsonl', metavar='FILE', multiple=True, help='read timings from JSON lines file(s) instead of state')
+@click.option('--region', metavar='REGION', help='only timings from this region')
+@click.option('--instance-type', metavar='TYPE', help='only timings of this instance type')
+@click.option('--api', is_flag=True, help='include AWS API calls')
+def show_timings(blueprint, state, jsonl, region, instance_type, api):
+    '''
+    Summarize duration of workflow phases across runs (p50, p95)
+    '''
+    if jsonl:
+        records = [r for path in jsonl for r in read_jsonl(path)]
+    else:
+        from .state import open_state_file
+        with open_state_file(get_state_path(state, blueprint)) as st:
+            records = [r for run in st.get('timings') or [] for r in run['records']]
+    records = [
+        r for r in records
+        if (api or r['kind'] == 'phase')
+        and (not region or r.get('region') == region)
+        and (not instance_type or r.get('instance_type') == instance_type)
+    ]
+    print('{:5} {:32} {:>6} {:>9} {:>9} {:>9}'.format('kind', 'name', 'count', 'p50', 'p95', 'max'))
+    for row in summarize(records):
+        print('{kind:5} {name:32} {count:6} {p50:9.3f} {p95:9.3f} {max:9.3f}'.format(**row))
+
+
+def get_state_path(state, blueprint):
+    '''
+    Return state path from --state option, environment variable SPOT_RUNNER_STATE
+    or default path next to the blueprint.
+
+    For SQLite state (sqlite:DB_PATH) the blueprint file name is used
+    as the state name if it is not given.
+    '''
+    state_path = state or os.environ.get('SPOT_RUNNER_STATE')
+    if state_path and state_path.startswith(sqlite_prefix):
+        if '#' not in state_path:
+            state_path += '#' + str(Path(blueprint).resolve().with_suffix(''))
+        return state_path
+    return Path(state_path or Path(blueprint).with_name('state.yaml'))
+
+
+@cli.command()
+@click.option('--db', metavar='FILE', help='path to SQLite state database')
+@click.option('--task-id', metavar='GLOB', help='filter by task id (wildcards allowed)')
+@click.option('--instance-id', metavar='ID', help='filter by instance id')
+@click.option('--region', metavar='REGION', help='filter by region')
+@click.option('--stage', metavar='STAGE', help='filter by stage (launched, ready, running, finished, failed)')
+@click.option('--json', 'json_output', is_flag=True, help='output JSON')
+def tasks(db, task_id, instance_id, region, stage, json_output):
+    '''
+    List tasks in SQLite state database
+    '''
+    db = db or default_state_db()
+    if not db:
+        raise AppError('Pass --db or set SPOT_RUNNER_STATE to sqlite:DB_PATH')
+    from .state import query_tasks
+    rows = query_tasks(db, task_id=task_id, instance_id=instance_id, region=region, stage=stage)
+    if json_output:
+        print(json.dumps(rows, indent=2))
+        return
+    for row in rows:
+        instance_ids = [row['instance_id']] if row['instance_id'] else [i['instance_id'] for i in row['instances']]
+        print('  '.join([
+            datetime.utcfromtimestamp(row['updated'] or 0).strftime('%Y-%m-%d %H:%M:%S'),
+            str(row['region'] or '-').ljust(14),
+            str(row['stage'] or '-').ljust(9),
+            (','.join(instance_ids) or '-').ljust(19),
+            str(row['task_id'] or '-'),
+        ]))
+
+
+def default_state_db():
+    '''
+    Return SQLite state database path from environment variable SPOT_RUNNER_STATE
+    or None if it is not set to sqlite:DB_PATH.
+    '''
+    env_state = os.environ.get('SPOT_RUNNER_STATE') or ''
+    if not env_state.startswith(sqlite_prefix):
+        return None
+    return env_state[len(sqlite_prefix):].partition('#')[0]
+
+
+@cli.command('ls')
+@click.option('--region', metavar='REGION', multiple=True, help='only this region (default: all enabled regions)')
+@click.option('--task-id', metavar='GLOB', help='filter by task id (wildcards allowed)')
+@click.option('--all', 'include_terminated', is_flag=True, help='include terminated instances')
+@click.option('--db', metavar='FILE', help='SQLite state database to join task stage from')
+@click.option('--state', metavar='FILE', multiple=True, help='state file(s) to join task stage from')
+@click.option('--json', 'json_output', is_flag=True, help='output JSON')
+def ls(region, task_id, include_terminated, db, state, json_output):
+    '''
+    List instances launched by spot-runner in all regions
+    '''
+    from .listing import format_table, join_local_tasks, list_instances
+    regions, create_client = region_clients(region)
+    rows = list_instances(regions, create_client, task_id=task_id, include_terminated=include_terminated)
+    rows = join_local_tasks(rows, local_tasks_by_instance(db or default_state_db(), state))
+    if json_output:
+        print(json.dumps(rows, indent=2))
+    else:
+        sys.stdout.write(format_table(rows))
+
+
+def region_clients(regions):
+    '''
+    Return list of regions (given or all enabled in the account) and function
+    creating EC2 client for a region name.
+    '''
+    import boto3
+    from .api_cache import ApiCache
+    from .listing import list_regions
+    from .workflow import create_ec2_client
+    regions = list(regions)
+    clients = {}
+    if not regions:
+        default_region = boto3.session.Session().region_name or 'us-east-1'
+        clients[default_region] = create_ec2_client(default_region)
+        regions = list_regions(clients[default_region], ApiCache())
+    return regions, lambda region_name: clients.get(region_name) or create_ec2_client(region_name)
+
+
+@cli.command()
+@click.option('--region', metavar='REGION', multiple=True, help='only this region (default: all enabled regions)')
+@click.option('--task-id', metavar='GLOB', help='only resources of these tasks (wildcards allowed)')
+@click.option('--older-than', metavar='HOURS', type=float, help='only resources created more than HOURS ago')
+@click.option('--all-tasks', is_flag=True, help='clean up resources of all tasks (if no other filter is given)')
+@click.option('--dry-run', is_flag=True, help='only print what would be cleaned up')
+@click.option('--wait', is_flag=True, help='wait for instances to terminate and delete their remaining volumes')
+@click.option('--json', 'json_output', is_flag=True, help='output JSON')
+def cleanup(region, task_id, older_than, all_tasks, dry_run, wait, json_output):
+    '''
+    Cancel spot requests, terminate instances and delete volumes of tasks in all regions
+    '''
+    from datetime import timedelta
+    from .cleanup import cleanup_resources, find_task_resources, format_table
+    from .listing import map_regions
+    if not task_id and older_than is None and not all_tasks:
+        raise AppError('Pass --task-id, --older-than or --all-tasks')
+    regions, create_client = region_clients(region)
+    older_than = timedelta(hours=older_than) if older_than is not None else None
+
+    def clean_region(ec2_client):
+        resources = find_task_resources(ec2_client, task_id=task_id, older_than=older_than)
+        failed = set()
+        if resources and not dry_run:
+            failed = set(cleanup_resources(ec2_client, resources, wait=wait))
+        for r in resources:
+            r['action'] = 'failed' if r['id'] in failed else ('would clean up' if dry_run else 'cleaned up')
+        return resources
+
+    results = map_regions(regions, create_client, clean_region)
+    resources = [r for region_resources in results for r in region_resources or []]
+    if json_output:
+        print(json.dumps(resources, indent=2))
+    else:
+        sys.stdout.write(format_table(resources))
+    counts = {}
+    for r in resources:
+        counts[r['type']] = counts.get(r['type'], 0) + 1
+    print('{} {} spot requests, {} instances, {} volumes'.format(
+        'Would clean up' if dry_run else 'Cleaned up',
+        counts.get('spot_request', 0), counts.get('instance', 0), counts.get('volume', 0)), file=sys.stderr)
+    failed_regions = [region_name for region_name, result in zip(regions, results) if result is None]
+    if failed_regions or any(r['action'] == 'failed' for r in resources):
+        raise AppError('Cleanup incomplete (failed regions: {})'.format(', '.join(failed_regions) or 'none'))
+
+
+def local_tasks_by_instance(db_path, state_paths):
+    '''
+    Return dict {instance id: {'stage': ..., 'state_path': state path or name}}
+    of tasks in SQLite state database and state files.
+    '''
+    from .state import InstanceState, open_state_file, query_tasks
+    tasks = {}
+    if db_path and Path(db_path).is_file():
+        for row in query_tasks(db_path):
+            state_path = '{}{}#{}'.format(sqlite_prefix, db_path, row['name'])
+            if row['instance_id']:
+                tasks[row['instance_id']] = {'stage': row['stage'], 'state_path': state_path}
+            for instance in row['instances']:
+                tasks[instance['instance_id']] = {
+                    'stage': instance['stage'] or row['stage'],
+                    'state_path': state_path,
+                }
+    for state_path in state_paths:
+        with open_state_file(state_path) as st:
+            instance_states = [st]
+            if st.get('instances'):
+                instance_states = [InstanceState(st, n) for n in range(len(st['instances']))]
+            for ist in instance_states:
+                if ist.get('instance_id'):
+                    tasks[ist['instance_id']] = {'stage': ist.get('stage'), 'state_path': str(state_path)}
+    return tasks
+
+
+@cli.command()
+@click.option('--blueprint', metavar='FILE', default='blueprint.yaml')
+@click.option('--state', metavar='FILE', help='path to state file or sqlite:DB_PATH[#NAME]')
+@click.option('--instance', metavar='INDEX', type=int, help='instance index (multi-instance tasks only)')
+def instance_id(blueprint, state, instance):
     '''
     Read instance id from state file
     '''
-    state_path = Path(
-        state or
-        os.environ.get('SPOT_RUNNER_STATE') or
-        Path(blueprint).with_name('state.yaml'))
+    state_path = get_state_path(state, blueprint)
+    value = read_simple_state_value(state_path, 'instance_id') if instance is None else None
+    if value:
+        print(value)
+        return
+    from .state import open_state_file
     with open_state_file(state_path) as state:
-        print(state['instance_info']['PublicIpAddress'])
+        for st in instance_states(state, instance):
+            print(st['instance_id'])
 
 
 @cli.command()
 @click.option('--blueprint', metavar='FILE', default='blueprint.yaml')
-@click.option('--state', metavar='FILE', help='path to state file')
+@click.option('--state', metavar='FILE', help='path to state file or sqlite:DB_PATH[#NAME]')
+@click.option('--instance', metavar='INDEX', type=int, help='instance index (multi-instance tasks only)')
+def ip_address(blueprint, state, instance):
+    '''
+    Read instance public IP address from state file
+    '''
+    state_path = get_state_path(state, blueprint)
+    value = read_simple_state_value(state_path, 'public_ip') if instance is None else None
+    if value:
+        print(value)
+        return
+    from .state import open_state_file
+    with open_state_file(state_path) as state:
+        for st in instance_states(state, instance):
+            ip = (st.get('instance_info') or {}).get('PublicIpAddress')
+            if not ip:
+                raise AppError('Instance {} has no public IP address (relaunching?)'.format(
+                    st.get('instance_id') or '(not launched yet)'))
+            print(ip)
+
+
+@cli.command()
+@click.option('--blueprint', metavar='FILE', default='blueprint.yaml')
+@click.option('--state', metavar='FILE', help='path to state file or sqlite:DB_PATH[#NAME]')
 @click.option('--user', metavar='USERNMAME', help='username to login as')
+@click.option('--instance', metavar='INDEX', type=int, default=0, help='instance index (multi-instance tasks only)')
 @click.argument('command', nargs=-1)
-def ssh(blueprint, state, user, command):
+def ssh(blueprint, state, user, instance, command):
+    from .blueprint import Blueprint
+    from .state import InstanceState, open_state_file
+    from .workflow import RunSpotInstance
     bp = Blueprint(blueprint)
-    state_path = Path(
-        state or
-        os.environ.get('SPOT_RUNNER_STATE') or
-        Path(blueprint).with_name('state.yaml'))
+    state_path = get_state_path(state, blueprint)
     with open_state_file(state_path) as state:
         with TemporaryDirectory(prefix='spot_runner.') as td:
-            r = RunSpotInstance(state=state, blueprint=bp, temp_dir=Path(td))
-            if command:
-                r.run_ssh_command(user=user, command=command)
+            if state.get('instances'):
+                state, instance_index = InstanceState(state, instance), instance
             else:
-                r.run_interactive_ssh(user=user)
+                instance_index = None
+            with RunSpotInstance(state=state, blueprint=bp, temp_dir=Path(td), instance_index=instance_index) as r:
+                if command:
+                    r.run_ssh_command(user=user, command=command)
+                else:
+                    r.run_interactive_ssh(user=user)
+
+
+def instance_states(state, index=None):
+    '''
+    Return list of states of all instances (or only the one with given index)
+    of the task.
+    '''
+    from .state import InstanceState
+    if not state.get('instances'):
+        return [state]
+    if index is not None:
+        return [InstanceState(state, index)]
+    return [InstanceState(state, n) for n in range(len(state['instances']))]
 
 
 log_format = '%(asctime)s %(name)-22s %(levelname)5s: %(message)s'
@@ -0,0 +1,128 @@
+import hashlib
+import json
+import logging
+from time import time
+
+
+logger = logging.getLogger(__name__)
+
+# Tags of idle instances in the warm pool
+fingerprint_tag = 'SpotRunnerPool'
+idle_until_tag = 'SpotRunnerIdleUntil'
+host_key_tag = 'SpotRunnerHostKey'
+pool_tags = (fingerprint_tag, idle_until_tag, host_key_tag)
+
+# Idle instance is not leased if it expires in less than this (seconds),
+# so that it cannot be terminated as expired while being taken over
+lease_margin = 120
+
+# Exit code of lease_script when the instance is already leased
+lease_taken = 75
+
+# Run on the instance when leasing it - mkdir is the lock (it is atomic,
+# so only one of concurrent leases succeeds). Prints the manifest
+# of uploaded data (see upload module) if the files still match it,
+# otherwise the uploaded files are removed, so that they are uploaded again.
+lease_script_template = '''\
+mkdir .spot_runner_lease 2>/dev/null || exit {taken}
+sudo -n shutdown -c >/dev/null 2>&1
+if (cd uploaded && sha1sum -c --quiet {meta}/manifest) >/dev/null 2>&1; then
+    cat uploaded/{meta}/manifest
+else
+    rm -rf uploaded
+fi
+true
+'''
+
+# Run on the instance when returning it to the pool. The shutdown timer
+# makes sure the instance goes away even if no spot-runner run terminates
+# it (shutdown of a one-time spot instance terminates it).
+release_script_template = '''\
+rmdir .spot_runner_lease 2>/dev/null
+sudo -n shutdown -h +{minutes} >/dev/null 2>&1
+true
+'''
+
+
+def pool_fingerprint(region_name, launch_specification, instance_types, data_sha1, setup_command=None):
+    '''
+    Return fingerprint of instances that are interchangeable - launched
+    the same way, with the same uploaded data and set up by the same command.
+    '''
+    payload = json.dumps({
+        'region': region_name,
+        'launch_specification': launch_specification,
+        'instance_types': instance_types,
+        'data_sha1': data_sha1,
+        'setup_command': setup_command,
+    }, sort_keys=True)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+def release_tags(fingerprint, idle_ttl, host_keys, now=None):
+    '''
+    Return EC2 tags marking instance as idle in the warm pool for idle_ttl seconds.
+    '''
+    now = time() if now is None else now
+    tags = [
+        {'Key': fingerprint_tag, 'Value': fingerprint},
+        {'Key': idle_until_tag, 'Value': str(int(now + idle_ttl))},
+    ]
+    host_key = pool_host_key(host_keys)
+    if host_key:
+        tags.append({'Key': host_key_tag, 'Value': host_key})
+    return tags
+
+
+def pool_host_key(host_keys):
+    '''
+    Return SSH host key short enough to be stored in a tag (ed25519 preferred)
+    or None.
+    '''
+    candidates = [' '.join(key.split()[:2]) for key in host_keys or []]
+    candidates = [k for k in candidates if len(k) <= 256]
+    candidates.sort(key=lambda k: not k.startswith('ssh-ed25519 '))
+    return candidates[0] if candidates else None
+
+
+def instance_tags(instance):
+    return {t['Key']: t['Value'] for t in instance.get('Tags') or []}
+
+
+def describe_pool_instances(ec2_client, filters):
+    paginator = ec2_client.get_paginator('describe_instances')
+    pages = paginator.paginate(Filters=[
+        {'Name': 'instance-state-name', 'Values': ['running']},
+        {'Name': 'tag-key', 'Values': [idle_until_tag]},
+    ] + filters)
+    return [i for page in pages for r in page['Reservations'] for i in r['Instances']]
+
+
+def find_idle_instances(ec2_client, fingerprint, now=None):
+    '''
+    Return idle instances with given fingerprint that can be leased,
+    the most recently released first.
+    '''
+    now = time() if now is None else now
+    instances = describe_pool_instances(ec2_client, [{'Name': 'tag:' + fingerprint_tag, 'Values': [fingerprint]}])
+    # checked here too - an instance with other fingerprint must never be leased
+    instances = [i for i in instances if instance_tags(i).get(fingerprint_tag) == fingerprint]
+    idle = [(int(instance_tags(i)[idle_until_tag]), i) for i in instances]
+    idle = [(until, i) for until, i in idle if until - now > lease_margin]
+    idle.sort(key=lambda item: -item[0])
+    return [i for until, i in idle]
+
+
+def terminate_expired_instances(ec2_client, now=None):
+    '''
+    Terminate idle instances (with any fingerprint) whose idle TTL has passed.
+    Returns list of their ids.
+    '''
+    now = time() if now is None else now
+    expired = [
+        i['InstanceId'] for i in describe_pool_instances(ec2_client, [])
+        if int(instance_tags(i)[idle_until_tag]) < now]
+    if expired:
+        logger.info('Terminating expired idle instances: %s', ' '.join(expired))
+        ec2_client.terminate_instances(InstanceIds=expired)
+    return expired
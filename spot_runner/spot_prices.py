@@ -0,0 +1,123 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+instance_type_info_ttl = 86400
+
+
+def fetch_price_history(ec2_client, instance_types, hours=6, product_description='Linux/UNIX'):
+    '''
+    Return dict {(instance type, availability zone): [(timestamp, price), ...]}
+    with spot price history of last few hours, oldest first.
+
+    History of each instance type is fetched concurrently.
+    '''
+    start_time = datetime.now(timezone.utc) - timedelta(hours=hours)
+
+    def fetch(instance_type):
+        paginator = ec2_client.get_paginator('describe_spot_price_history')
+        pages = paginator.paginate(
+            InstanceTypes=[instance_type],
+            ProductDescriptions=[product_description],
+            StartTime=start_time)
+        return [item for page in pages for item in page['SpotPriceHistory']]
+
+    history = {}
+    with ThreadPoolExecutor(max_workers=min(len(instance_types), 8) or 1) as executor:
+        for items in executor.map(fetch, instance_types):
+            for item in items:
+                key = (item['InstanceType'], item['AvailabilityZone'])
+                history.setdefault(key, []).append((item['Timestamp'], float(item['SpotPrice'])))
+    for records in history.values():
+        records.sort()
+    return history
+
+
+def fetch_instance_type_info(api_cache, ec2_client, instance_types):
+    '''
+    Return dict {instance type: {'vcpus': int, 'memory_gib': float}}.
+    '''
+    reply = api_cache.call(
+        ec2_client, 'describe_instance_types', instance_type_info_ttl,
+        InstanceTypes=sorted(instance_types))
+    return {
+        t['InstanceType']: {
+            'vcpus': t['VCpuInfo']['DefaultVCpus'],
+            'memory_gib': t['MemoryInfo']['SizeInMiB'] / 1024,
+        } for t in reply['InstanceTypes']
+    }
+
+
+def pool_price_stats(records, now):
+    '''
+    Return tuple (current price, volatility) from price history records.
+
+    Volatility is time-weighted relative standard deviation of the price
+    since the first record - 0 for a price that did not change.
+    '''
+    current_price = records[-1][1]
+    prices, weights = [], []
+    for (ts, price), (next_ts, _) in zip(records, records[1:] + [(now, None)]):
+        prices.append(price)
+        weights.append(max((next_ts - ts).total_seconds(), 1))
+    avg = sum(p * w for p, w in zip(prices, weights)) / sum(weights)
+    if len(prices) < 2 or not avg:
+        return current_price, 0
+    var = sum(w * (p - avg) ** 2 for p, w in zip(prices, weights)) / sum(weights)
+    return current_price, var ** .5 / avg
+
+
+def rank_pools(pools, history, type_info, rank_by='vcpu', max_price=None, now=None):
+    '''
+    Return pools (list of dicts with keys instance_type, availability_zone
+    and optionally subnet_id) ordered from the best to the worst, extended
+    by keys price, unit_price, volatility and score.
+
+    Pools are scored by current price per vCPU (rank_by='vcpu') or per GiB
+    of memory (rank_by='memory'), penalized by price volatility. Pools
+    without price history (not offered in the AZ) or with price above
+    max_price are left out.
+    '''
+    now = now or datetime.now(timezone.utc)
+    ranked = []
+    for pool in pools:
+        records = history.get((pool['instance_type'], pool['availability_zone']))
+        if not records:
+            logger.debug('No spot price history for %s in %s', pool['instance_type'], pool['availability_zone'])
+            continue
+        price, volatility = pool_price_stats(records, now)
+        if max_price is not None and price > float(max_price):
+            logger.debug(
+                'Spot price of %s in %s is too high: %s', pool['instance_type'], pool['availability_zone'], price)
+            continue
+        info = type_info[pool['instance_type']]
+        units = info['memory_gib'] if rank_by == 'memory' else info['vcpus']
+        unit_price = price / units
+        ranked.append(dict(
+            pool, price=price, unit_price=unit_price, volatility=volatility,
+            score=unit_price * (1 + volatility)))
+    ranked.sort(key=lambda p: (p['score'], p['price']))
+    return ranked
+
+
+def apply_pool(launch_args, pool):
+    '''
+    Return copy of run_instances arguments modified to launch in given pool.
+    '''
+    launch_args = dict(launch_args)
+    launch_args['InstanceType'] = pool['instance_type']
+    if pool.get('subnet_id'):
+        if launch_args.get('NetworkInterfaces'):
+            interfaces = [dict(ni) for ni in launch_args['NetworkInterfaces']]
+            interfaces[0]['SubnetId'] = pool['subnet_id']
+            launch_args['NetworkInterfaces'] = interfaces
+        else:
+            launch_args['SubnetId'] = pool['subnet_id']
+    elif pool.get('availability_zone'):
+        launch_args['Placement'] = dict(
+            launch_args.get('Placement') or {},
+            AvailabilityZone=pool['availability_zone'])
+    return launch_args
@@ -1,8 +1,17 @@
 from contextlib import contextmanager
+from datetime import datetime
+import fcntl
 import logging
+import os
 from pathlib import Path
+import sqlite3
+from threading import Lock, RLock
+from time import time
 import yaml
 
+from .errors import AppError
+from .state_scan import snapshot_header, sqlite_prefix, update_prefix
+
 
 logger = logging.getLogger(__name__)
 
@@ -10,46 +19,176 @@ logger = logging.getLogger(__name__)
 @contextmanager
 def open_state_file(state_path):
     '''
-    Open state file. Currently supports only file paths.
+    Open state file. State path is either a file path or sqlite:DB_PATH#NAME
+    for state stored in SQLite database (see SQLiteState).
     '''
     # In future there could also be object for managing state file on AWS S3.
     # TODO: move context API to StateFile itself.
-    state = StateFile(state_path)
+    if str(state_path).startswith(sqlite_prefix):
+        db_path, name = parse_sqlite_state_path(state_path)
+        state = SQLiteState(db_path, name)
+    else:
+        state = StateFile(state_path)
     try:
         yield state
     finally:
-        state.flush()
+        state.close()
+
+
+def parse_sqlite_state_path(state_path):
+    '''
+    Return tuple (database path, state name) from sqlite:DB_PATH#NAME.
+    '''
+    s = str(state_path)[len(sqlite_prefix):]
+    db_path, sep, name = s.partition('#')
+    if not name:
+        raise AppError('State name missing in {!r} (expected sqlite:DB_PATH#NAME)'.format(str(state_path)))
+    return Path(db_path), name
+
+
+def backup_state(state_path):
+    '''
+    Move existing state away, so that a new state can be created on the same path.
+    '''
+    backup_suffix = '.backup-{date}'.format(date=datetime.utcnow().strftime('%Y%m%dT%H%M%SZ'))
+    if str(state_path).startswith(sqlite_prefix):
+        db_path, name = parse_sqlite_state_path(state_path)
+        if db_path.is_file():
+            state = SQLiteState(db_path, name)
+            try:
+                state.rename(name + backup_suffix)
+            finally:
+                state.close()
+    else:
+        state_path = Path(state_path)
+        if state_path.is_file():
+            backup_path = state_path.with_name(state_path.name + backup_suffix)
+            assert not backup_path.exists()
+            logger.info('Renaming %s -> %s', state_path, backup_path)
+            state_path.rename(backup_path)
 
 
 class StateFile:
     '''
     Key-value collection (like dict) backed by YAML file.
+
+    The file starts with a snapshot document (key spot_runner_state) that
+    may be followed by update documents (key spot_runner_state_update),
+    one per line. Every top-level key of the snapshot is on its own line
+    too, so simple values can be read without YAML parser (see state_scan).
+    Setting a value just appends an update document; the file is compacted
+    into a single snapshot document (written to a temporary file and
+    renamed) when there are too many updates and when the state is closed.
+
+    Changes are done under an advisory lock (flock on file with suffix
+    .lock), so the state file can be used by multiple processes at once.
+    Changes made by other processes are loaded before each update. Reading
+    takes a shared lock only if the lock file exists, so a state that is
+    only read leaves no lock file behind (compaction is an atomic rename).
     '''
 
+    compact_threshold = 100
+
     def __init__(self, path):
         self._path = Path(path)
+        self._lock_path = self._path.with_name(self._path.name + '.lock')
+        self._thread_lock = RLock()
+        self._file_id = None
+        self._data = {}
+        self._update_count = 0
+        self._appended = False
         logger.info('Using state file %s', self._path)
+        with self._locked(shared=True):
+            self._reload()
+
+    @contextmanager
+    def _locked(self, shared=False):
+        with self._thread_lock:
+            lock_file = None
+            if not shared:
+                lock_file = self._lock_path.open('a')
+            elif self._lock_path.exists():
+                try:
+                    lock_file = self._lock_path.open('r')
+                except OSError as e:
+                    logger.debug('Failed to open %s: %r', self._lock_path, e)
+            if lock_file is None:
+                yield
+                return
+            with lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+                yield
+
+    def _current_file_id(self):
         try:
-            self._text = self._path.read_text()
-            self._data = yaml.safe_load(self._text)['spot_runner_state']
+            st = self._path.stat()
         except FileNotFoundError:
-            self._text = None
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def _reload(self):
+        '''
+        Read the state file if it was changed since we have read it last time.
+        '''
+        file_id = self._current_file_id()
+        if file_id == self._file_id:
+            return
+        if file_id is None:
             self._data = {}
+            self._update_count = 0
+        else:
+            docs = list(yaml.load_all(self._path.read_text(), Loader=_SafeLoader))
+            data = dict(docs[0]['spot_runner_state'])
+            for doc in docs[1:]:
+                data.update(doc['spot_runner_state_update'])
+            self._data = data
+            self._update_count = len(docs) - 1
+        self._file_id = file_id
+
+    def _compact(self):
+        if self._data:
+            new_text = snapshot_header + '\n' + ''.join(
+                '  ' + dump_line({key: value})[1:-1] + '\n' for key, value in sorted(self._data.items()))
+        else:
+            new_text = snapshot_header + ' {}\n'
+        temp_path = self._path.with_name('{}.tmp{}'.format(self._path.name, os.getpid()))
+        with temp_path.open('w') as f:
+            f.write(new_text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(str(temp_path), str(self._path))
+        self._update_count = 0
+        self._file_id = self._current_file_id()
+
+    def _append_update(self, key, value):
+        line = update_prefix + dump_line({key: value})[1:] + '}\n'
+        with self._path.open('a') as f:
+            f.write(line)
+        self._update_count += 1
+        self._file_id = self._current_file_id()
 
     def flush(self):
         '''
-        Save all cnanges.
+        Make sure all changes are written to disk.
         '''
-        new_text = yaml.safe_dump({'spot_runner_state': self._data})
-        if self._text != new_text:
-            try:
-                current_text = self._path.read_text()
-            except FileNotFoundError:
-                current_text = None
-            if current_text != self._text:
-                raise Exception('State file has changed')
-            self._path.write_text(new_text)
-            self._text = new_text
+        if not self._appended:
+            return
+        with self._locked():
+            if self._path.exists():
+                with self._path.open('a') as f:
+                    os.fsync(f.fileno())
+
+    def close(self):
+        '''
+        Compact the state file if this object has appended any updates.
+        '''
+        if not self._appended:
+            return
+        with self._locked():
+            self._reload()
+            if self._update_count:
+                self._compact()
+            self._appended = False
 
     def get(self, key, default=None):
         '''
@@ -67,4 +206,239 @@ class StateFile:
         '''
         Set new value for given key
         '''
-        self._data[key] = value
+        with self._locked():
+            self._reload()
+            self._data[key] = value
+            if self._file_id is None or self._update_count >= self.compact_threshold:
+                self._compact()
+            else:
+                self._append_update(key, value)
+            self._appended = True
+
+
+# Use LibYAML bindings if available - they are much faster
+_SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+_SafeDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+
+class _LineDumper(_SafeDumper):
+    '''
+    Dumper for one-line flow documents - strings with line breaks
+    are written double-quoted with escapes.
+    '''
+
+
+def _represent_str(dumper, data):
+    style = '"' if any(c in data for c in '\r\n\x85\u2028\u2029') else None
+    return dumper.represent_scalar('tag:yaml.org,2002:str', data, style=style)
+
+
+_LineDumper.add_representer(str, _represent_str)
+
+
+def dump_line(value):
+    '''
+    Return value as YAML flow text on one line (without trailing newline).
+    '''
+    line = yaml.dump(value, default_flow_style=True, width=2**30, Dumper=_LineDumper)
+    assert line.endswith('\n') and line.count('\n') == 1
+    return line[:-1]
+
+
+sqlite_schema = '''
+    CREATE TABLE IF NOT EXISTS spot_runner_tasks (
+        name TEXT PRIMARY KEY,
+        task_id TEXT,
+        instance_id TEXT,
+        region TEXT,
+        stage TEXT,
+        updated REAL
+    );
+    CREATE INDEX IF NOT EXISTS spot_runner_tasks_task_id ON spot_runner_tasks (task_id);
+    CREATE INDEX IF NOT EXISTS spot_runner_tasks_instance_id ON spot_runner_tasks (instance_id);
+    CREATE INDEX IF NOT EXISTS spot_runner_tasks_region_stage ON spot_runner_tasks (region, stage);
+    CREATE INDEX IF NOT EXISTS spot_runner_tasks_stage ON spot_runner_tasks (stage);
+    CREATE TABLE IF NOT EXISTS spot_runner_task_values (
+        name TEXT NOT NULL,
+        key TEXT NOT NULL,
+        value TEXT NOT NULL,
+        PRIMARY KEY (name, key)
+    );
+    CREATE TABLE IF NOT EXISTS spot_runner_task_instances (
+        name TEXT NOT NULL,
+        instance_id TEXT NOT NULL,
+        stage TEXT,
+        PRIMARY KEY (name, instance_id)
+    );
+    CREATE INDEX IF NOT EXISTS spot_runner_task_instances_instance_id ON spot_runner_task_instances (instance_id);
+'''
+
+# state keys that are copied to indexed columns of table spot_runner_tasks
+sqlite_indexed_keys = ('task_id', 'instance_id', 'region', 'stage')
+
+
+def connect_sqlite(db_path):
+    conn = sqlite3.connect(str(db_path), timeout=60, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(sqlite_schema)
+    return conn
+
+
+class SQLiteState:
+    '''
+    Key-value collection (like dict) stored in SQLite database.
+
+    One database holds state of many tasks. State of a task is identified
+    by its name; a task can be also looked up by its task_id. Some keys
+    (see sqlite_indexed_keys) are indexed, so tasks can be queried quickly
+    (see query_tasks). Instance ids of multi-instance tasks (see InstanceState)
+    are indexed in table spot_runner_task_instances.
+    '''
+
+    def __init__(self, db_path, name):
+        self._db_path = Path(db_path)
+        self._lock = RLock()
+        self._conn = connect_sqlite(self._db_path)
+        row = self._conn.execute('SELECT name FROM spot_runner_tasks WHERE name = ?', (name, )).fetchone()
+        if not row:
+            row = self._conn.execute(
+                'SELECT name FROM spot_runner_tasks WHERE task_id = ? ORDER BY updated DESC', (name, )).fetchone()
+        self._name = row[0] if row else name
+        logger.info('Using state %s in database %s', self._name, self._db_path)
+        rows = self._conn.execute(
+            'SELECT key, value FROM spot_runner_task_values WHERE name = ?', (self._name, ))
+        self._data = {key: yaml.load(value, Loader=_SafeLoader) for key, value in rows}
+
+    def flush(self):
+        '''
+        Nothing to do - every change is committed immediately.
+        '''
+        pass
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def rename(self, new_name):
+        with self._lock, self._conn:
+            logger.info('Renaming state %s -> %s', self._name, new_name)
+            self._conn.execute('UPDATE spot_runner_tasks SET name = ? WHERE name = ?', (new_name, self._name))
+            self._conn.execute('UPDATE spot_runner_task_values SET name = ? WHERE name = ?', (new_name, self._name))
+            self._conn.execute(
+                'UPDATE spot_runner_task_instances SET name = ? WHERE name = ?', (new_name, self._name))
+            self._name = new_name
+
+    def get(self, key, default=None):
+        '''
+        Return the value for key if key is present, else default.
+        '''
+        return self._data.get(key, default)
+
+    def __getitem__(self, key):
+        '''
+        Return the value for given key. Raise KeyError if key is not present.
+        '''
+        return self._data[key]
+
+    def __setitem__(self, key, value):
+        '''
+        Set new value for given key
+        '''
+        value_text = dump_line(value)
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO spot_runner_task_values (name, key, value) VALUES (?, ?, ?)',
+                (self._name, key, value_text))
+            self._conn.execute(
+                'INSERT OR IGNORE INTO spot_runner_tasks (name) VALUES (?)', (self._name, ))
+            if key in sqlite_indexed_keys:
+                self._conn.execute(
+                    'UPDATE spot_runner_tasks SET {} = ? WHERE name = ?'.format(key),
+                    (value if isinstance(value, str) else None, self._name))
+            if key == 'instances':
+                self._conn.execute('DELETE FROM spot_runner_task_instances WHERE name = ?', (self._name, ))
+                self._conn.executemany(
+                    'INSERT OR REPLACE INTO spot_runner_task_instances (name, instance_id, stage) VALUES (?, ?, ?)',
+                    [(self._name, i['instance_id'], i.get('stage')) for i in value or []
+                     if isinstance(i, dict) and isinstance(i.get('instance_id'), str)])
+            self._conn.execute(
+                'UPDATE spot_runner_tasks SET updated = ? WHERE name = ?', (time(), self._name))
+            self._data[key] = value
+
+
+def query_tasks(db_path, **filters):
+    '''
+    Return list of dicts with indexed fields (see sqlite_indexed_keys) of tasks
+    in SQLite state database. Filters are key=value pairs for indexed fields;
+    task_id filter may contain glob wildcards, instance_id filter matches also
+    instances of multi-instance tasks. Key instances of each dict is list
+    of dicts with instance_id and stage of these instances.
+    '''
+    where, params = [], []
+    for key, value in sorted(filters.items()):
+        if value is None:
+            continue
+        assert key in sqlite_indexed_keys
+        if key == 'task_id':
+            where.append('t.task_id GLOB ?')
+        elif key == 'instance_id':
+            where.append('(t.instance_id = ? OR t.name IN '
+                         '(SELECT name FROM spot_runner_task_instances WHERE instance_id = ?))')
+            params.append(value)
+        else:
+            where.append('t.{} = ?'.format(key))
+        params.append(value)
+    where_sql = ' WHERE ' + ' AND '.join(where) if where else ''
+    conn = connect_sqlite(db_path)
+    try:
+        instances = {}
+        rows = conn.execute(
+            'SELECT i.name, i.instance_id, i.stage FROM spot_runner_task_instances i '
+            'JOIN spot_runner_tasks t ON t.name = i.name' + where_sql + ' ORDER BY i.rowid', params)
+        for name, instance_id, stage in rows:
+            instances.setdefault(name, []).append({'instance_id': instance_id, 'stage': stage})
+        columns = ['name', 'task_id', 'instance_id', 'region', 'stage', 'updated']
+        rows = conn.execute(
+            'SELECT t.name, t.task_id, t.instance_id, t.region, t.stage, t.updated FROM spot_runner_tasks t'
+            + where_sql + ' ORDER BY t.updated', params)
+        return [dict(zip(columns, row), instances=instances.get(row[0], [])) for row in rows]
+    finally:
+        conn.close()
+
+
+class InstanceState:
+    '''
+    State of one instance of a multi-instance task.
+
+    It is stored as an item of list "instances" in the parent state.
+    Keys that are not set for the instance (like task_id) are read
+    from the parent state.
+    '''
+
+    _lock = Lock()
+
+    def __init__(self, parent, index):
+        self._parent = parent
+        self._index = index
+
+    def flush(self):
+        with self._lock:
+            self._parent.flush()
+
+    def get(self, key, default=None):
+        own = self._parent['instances'][self._index]
+        if key in own:
+            return own[key]
+        return self._parent.get(key, default)
+
+    def __getitem__(self, key):
+        own = self._parent['instances'][self._index]
+        if key in own:
+            return own[key]
+        return self._parent[key]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            instances = list(self._parent['instances'])
+            instances[self._index] = dict(instances[self._index], **{key: value})
+            self._parent['instances'] = instances
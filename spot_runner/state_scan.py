@@ -0,0 +1,98 @@
+'''
+Reading simple values from state file without YAML parser.
+
+This module is imported by read-only CLI commands (instance-id, ip-address)
+that are called very often from scripts, so it must not import anything
+heavy (yaml, boto3, ...). It relies on the line-oriented layout written
+by StateFile - every top-level key is on its own line, either in the
+snapshot document or in an update document:
+
+    spot_runner_state:
+      instance_id: i-0123456789abcdef0
+      instance_info: {InstanceId: i-0123456789abcdef0, ...}
+    --- {spot_runner_state_update: {public_ip: 1.2.3.4}}
+
+Anything unexpected makes the scan give up (return None), so the caller
+can fall back to regular StateFile.
+'''
+
+from pathlib import Path
+import re
+
+
+sqlite_prefix = 'sqlite:'
+
+snapshot_header = 'spot_runner_state:'
+update_prefix = '--- {spot_runner_state_update: {'
+update_suffix = '}}'
+
+_key_re = re.compile(r'([A-Za-z_][A-Za-z0-9_]*): (.+)$')
+
+# Plain scalars that YAML resolves as strings - identifiers starting
+# with a letter (except booleans and null) and IPv4 addresses
+_plain_str_re = re.compile(r'[A-Za-z][-A-Za-z0-9_.]*$|[0-9]{1,3}(\.[0-9]{1,3}){3}$')
+_non_str_words = {'yes', 'no', 'true', 'false', 'on', 'off', 'null'}
+
+
+def scan_state_file(path):
+    '''
+    Return dict {key: value text} with the last value of every top-level
+    key in the state file, or None if the file does not exist or does not
+    have the expected layout.
+    '''
+    try:
+        text = Path(path).read_text()
+    except FileNotFoundError:
+        return None
+    if not text.endswith('\n'):
+        # missing or partially written file
+        return None
+    lines = text.splitlines()
+    if lines[0] not in (snapshot_header, snapshot_header + ' {}'):
+        return None
+    values = {}
+    in_snapshot = lines[0] == snapshot_header
+    for line in lines[1:]:
+        if in_snapshot and line.startswith('  ') and not line.startswith('   '):
+            m = _key_re.match(line[2:])
+        elif line.startswith(update_prefix) and line.endswith(update_suffix):
+            in_snapshot = False
+            m = _key_re.match(line[len(update_prefix):-len(update_suffix)])
+        else:
+            return None
+        if not m:
+            return None
+        values[m.group(1)] = m.group(2)
+    return values
+
+
+def scalar_str(value_text):
+    '''
+    Return string represented by YAML flow value text if it is a simple
+    string scalar, otherwise None.
+    '''
+    if _plain_str_re.match(value_text) and value_text.lower() not in _non_str_words:
+        return value_text
+    if len(value_text) >= 2 and value_text[0] == value_text[-1] == "'" and "'" not in value_text[1:-1]:
+        return value_text[1:-1]
+    return None
+
+
+def read_simple_state_value(state_path, key):
+    '''
+    Return string value of given key of single-instance task state,
+    or None if it cannot be read quickly - SQLite state, multi-instance
+    task, value that is not a simple string etc. In that case use regular
+    open_state_file.
+
+    The file is read without locking; updates are appended as whole lines
+    and compaction replaces the file atomically.
+    '''
+    if str(state_path).startswith(sqlite_prefix):
+        return None
+    values = scan_state_file(state_path)
+    if values is None or key not in values:
+        return None
+    if 'instances' in values and values['instances'] != 'null':
+        return None
+    return scalar_str(values[key])
@@ -0,0 +1,157 @@
+from functools import partial
+import hashlib
+from itertools import product
+import json
+import logging
+from pathlib import Path
+from queue import Empty, Queue
+from threading import Lock
+import yaml
+
+from .errors import AppError
+from .file_transformations import preprocess_file, preprocess_jinja
+from .workflow import RunSpotInstances, run_parallel, set_stage, ssh_connection_failed
+
+
+logger = logging.getLogger(__name__)
+
+
+class Sweep:
+
+    def __init__(self, path):
+        '''
+        Parameter path is path to a sweep file - see examples/hello_sweep directory.
+        '''
+        self._path = Path(path)
+        logger.info('Loading sweep from %s', self._path)
+        try:
+            content = preprocess_file(self._path)
+            d = yaml.safe_load(content)['spot_runner_sweep']
+            self.base_dir = self._path.parent
+            self.max_instances = int(d.get('max_instances') or 1)
+            self.command = d['command']
+            self.jobs = expand_matrix(d['matrix'])
+        except Exception as e:
+            msg = 'Failed to read sweep file {}: {!r}'.format(self._path, e)
+            raise AppError(msg) from e
+
+    def job_command(self, values):
+        '''
+        Return command for a job - each item of the command template
+        is rendered by jinja with the job values.
+        '''
+        return [preprocess_jinja(self.base_dir, str(item), values) for item in self.command]
+
+
+def expand_matrix(matrix):
+    '''
+    Return list of dicts - template values for each job.
+
+    Matrix is either dict {name: list of values} - a job is generated for
+    every combination of the values - or list of such dicts.
+    '''
+    if isinstance(matrix, list):
+        jobs = []
+        for m in matrix:
+            jobs.extend(expand_matrix(m))
+        return jobs
+    assert isinstance(matrix, dict)
+    names = sorted(matrix)
+    value_lists = [v if isinstance(v, list) else [v] for v in (matrix[k] for k in names)]
+    return [dict(zip(names, values)) for values in product(*value_lists)]
+
+
+def get_job_id(values):
+    return hashlib.sha1(json.dumps(values, sort_keys=True).encode()).hexdigest()[:12]
+
+
+class RunSweep:
+    '''
+    Runs sweep jobs on at most sweep.max_instances instances.
+
+    Every instance takes next job from a shared queue when it finishes
+    the previous one. Job status is saved in state under key "sweep_jobs",
+    so an interrupted sweep continues with jobs that are not done yet.
+    '''
+
+    def __init__(self, state, blueprint, sweep, temp_dir):
+        self.state = state
+        self.blueprint = blueprint
+        self.sweep = sweep
+        self.temp_dir = temp_dir
+        self._lock = Lock()
+
+    def run_sweep(self):
+        pending = []
+        jobs = dict(self.state.get('sweep_jobs') or {})
+        for values in self.sweep.jobs:
+            job_id = get_job_id(values)
+            if job_id not in jobs:
+                jobs[job_id] = {'values': values, 'status': 'pending'}
+            if jobs[job_id]['status'] != 'done':
+                pending.append(job_id)
+        self.state['sweep_jobs'] = jobs
+        logger.info('Sweep jobs: %d total, %d not done', len(self.sweep.jobs), len(pending))
+        if not pending:
+            return
+        if not self.state.get('task_id'):
+            self.blueprint.count = min(self.sweep.max_instances, len(pending))
+        queue = Queue()
+        for job_id in pending:
+            queue.put(job_id)
+        with RunSpotInstances(state=self.state, blueprint=self.blueprint, temp_dir=self.temp_dir) as r:
+            runs = r.runs()
+            set_stage(self.state, 'running')
+            try:
+                run_parallel(len(runs), [partial(self.run_worker, run, queue) for run in runs])
+            except AppError as e:
+                logger.error('Some sweep workers failed: %s', e)
+        failed = [job_id for job_id, job in sorted(self.state['sweep_jobs'].items()) if job['status'] != 'done']
+        if failed:
+            set_stage(self.state, 'failed')
+            raise AppError('{} sweep jobs not done: {}'.format(len(failed), ' '.join(failed)))
+        set_stage(self.state, 'finished')
+        logger.info('All sweep jobs done')
+
+    def run_worker(self, run, queue):
+        '''
+        Run jobs from the queue on one instance until the queue is empty.
+
+        If the SSH connection to the instance fails, the job is returned
+        to the queue (other workers may take it) and the worker stops.
+        '''
+        run.ensure_instance()
+        run.instance_info()
+        with run.phase('upload'):
+            run.upload()
+        run.run_setup_command()
+        while True:
+            try:
+                job_id = queue.get_nowait()
+            except Empty:
+                return
+            values = self.state['sweep_jobs'][job_id]['values']
+            self.set_job_status(job_id, 'running', instance_id=run.instance_id())
+            try:
+                with run.phase('sweep_job'):
+                    returncode = run.run_ssh(
+                        self.sweep.job_command(values), env={'JOB_ID': job_id},
+                        check_returncodes=(ssh_connection_failed, ))
+            except AppError as e:
+                logger.error('Sweep job %s failed: %s', job_id, e)
+                self.set_job_status(job_id, 'failed')
+                continue
+            if returncode == ssh_connection_failed:
+                self.set_job_status(job_id, 'pending')
+                queue.put(job_id)
+                raise AppError('Lost SSH connection to instance {} - sweep job {} returned to the queue'.format(
+                    run.instance_id(), job_id))
+            logger.info('Sweep job %s done', job_id)
+            self.set_job_status(job_id, 'done')
+
+    def set_job_status(self, job_id, status, **kwargs):
+        with self._lock:
+            jobs = dict(self.state['sweep_jobs'])
+            jobs[job_id] = dict(jobs[job_id], status=status, **kwargs)
+            self.state['sweep_jobs'] = jobs
+            self.state.flush()
@@ -0,0 +1,181 @@
+from contextlib import contextmanager
+from datetime import datetime
+import json
+import logging
+import os
+from pathlib import Path
+from threading import Lock
+from time import monotonic as monotime, time
+from weakref import WeakKeyDictionary
+
+
+logger = logging.getLogger(__name__)
+
+# Number of runs whose timings are kept in the state
+state_timings_runs = 20
+
+
+class Timings:
+    '''
+    Collects durations of workflow phases and AWS API calls of one
+    spot-runner invocation.
+
+    Each record is dict with keys kind ("phase" or "api"), name, start
+    (unix timestamp), duration (seconds), ok (bool) and tags like region
+    and instance_type.
+    '''
+
+    def __init__(self):
+        self._lock = Lock()
+        self._client_tags = WeakKeyDictionary()
+        self.records = []
+
+    def add(self, kind, name, start, duration, ok=True, **tags):
+        record = dict(tags, kind=kind, name=name, start=start, duration=duration, ok=ok)
+        with self._lock:
+            self.records.append(record)
+        logger.debug('Timing %s %s: %.3f s', kind, name, duration)
+
+    @contextmanager
+    def phase(self, name, **tags):
+        start, start_mt = time(), monotime()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            self.add('phase', name, start, monotime() - start_mt, ok=ok, **tags)
+
+    def instrument_client(self, client):
+        '''
+        Record duration of every API call made by boto3 client, tagged
+        by region and tags set by tag_client.
+        '''
+        service = client.meta.service_model.service_name
+        tags = {'region': client.meta.region_name}
+        self._client_tags[client] = tags
+
+        def before_parameter_build(context, **kwargs):
+            context['spot_runner_start'] = (time(), monotime())
+
+        def after_call(http_response, parsed, model, context, **kwargs):
+            start, start_mt = context.pop('spot_runner_start', (None, None))
+            if start is None:
+                return
+            ok = not (parsed or {}).get('Error')
+            self.add('api', model.name, start, monotime() - start_mt, ok=ok, **tags)
+
+        client.meta.events.register('before-parameter-build.{}'.format(service), before_parameter_build)
+        client.meta.events.register('after-call.{}'.format(service), after_call)
+        return client
+
+    def tag_client(self, client, **tags):
+        '''
+        Set tags (like instance_type) of following API calls of instrumented client.
+        '''
+        if client in self._client_tags:
+            self._client_tags[client].update(tags)
+
+
+# Timings of this process
+timings = Timings()
+
+
+def save_timings_to_state(state, command, records):
+    '''
+    Append timings of this run to state key "timings" (list of runs).
+    '''
+    if not records:
+        return
+    run = {
+        'command': command,
+        'started': datetime.utcfromtimestamp(min(r['start'] for r in records)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'records': records,
+    }
+    state['timings'] = (list(state.get('timings') or []) + [run])[-state_timings_runs:]
+
+
+def write_jsonl(path, records, task_id=None):
+    '''
+    Append records to JSON lines file.
+    '''
+    with Path(path).open('a') as f:
+        for record in records:
+            f.write(json.dumps(dict(record, task_id=task_id), sort_keys=True) + '\n')
+
+
+def read_jsonl(path):
+    with Path(path).open() as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def write_prometheus_textfile(path, records, task_id=None):
+    '''
+    Write records as node_exporter textfile collector metrics. The file
+    is replaced atomically.
+    '''
+    lines = [
+        '# HELP spot_runner_phase_duration_seconds Duration of spot-runner workflow phase in the last run.',
+        '# TYPE spot_runner_phase_duration_seconds gauge',
+    ]
+    for r in records:
+        if r['kind'] == 'phase':
+            labels = dict(phase=r['name'], task_id=task_id, region=r.get('region'),
+                          instance_type=r.get('instance_type'))
+            lines.append('spot_runner_phase_duration_seconds{} {:.3f}'.format(format_labels(labels), r['duration']))
+    api_totals = {}
+    for r in records:
+        if r['kind'] == 'api':
+            key = (r['name'], r.get('region') or '', r.get('instance_type') or '')
+            count, total = api_totals.get(key, (0, 0))
+            api_totals[key] = (count + 1, total + r['duration'])
+    lines += [
+        '# HELP spot_runner_api_call_duration_seconds Duration of AWS API calls in the last run.',
+        '# TYPE spot_runner_api_call_duration_seconds summary',
+    ]
+    for (name, region, instance_type), (count, total) in sorted(api_totals.items()):
+        labels = format_labels(dict(
+            operation=name, task_id=task_id, region=region or None, instance_type=instance_type or None))
+        lines.append('spot_runner_api_call_duration_seconds_sum{} {:.3f}'.format(labels, total))
+        lines.append('spot_runner_api_call_duration_seconds_count{} {}'.format(labels, count))
+    path = Path(path)
+    temp_path = path.with_name('.{}.tmp{}'.format(path.name, os.getpid()))
+    temp_path.write_text(''.join(line + '\n' for line in lines))
+    os.replace(str(temp_path), str(path))
+
+
+def format_labels(labels):
+    parts = []
+    for k, v in sorted(labels.items()):
+        if v is None:
+            continue
+        v = str(v).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+        parts.append('{}="{}"'.format(k, v))
+    return '{' + ','.join(parts) + '}'
+
+
+def percentile(values, p):
+    '''
+    Return p-th percentile (nearest rank) of non-empty list of values.
+    '''
+    values = sorted(values)
+    rank = max(int(-(-p * len(values) // 100)), 1)
+    return values[rank - 1]
+
+
+def summarize(records):
+    '''
+    Return list of dicts with keys kind, name, count, p50, p95 and max -
+    duration statistics of records grouped by kind and name.
+    '''
+    groups = {}
+    for r in records:
+        groups.setdefault((r['kind'], r['name']), []).append(r['duration'])
+    return [{
+        'kind': kind,
+        'name': name,
+        'count': len(durations),
+        'p50': percentile(durations, 50),
+        'p95': percentile(durations, 95),
+        'max': max(durations),
+    } for (kind, name), durations in sorted(groups.items())]
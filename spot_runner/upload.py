@@ -0,0 +1,144 @@
+import hashlib
+from io import BytesIO
+import logging
+import os
+from pathlib import Path
+import tarfile
+from time import time
+
+
+logger = logging.getLogger(__name__)
+
+# Directory inside remote "uploaded" directory where upload metadata are kept
+meta_dir_name = '.spot_runner'
+
+
+def list_dir_files(dir_path, arc_dir):
+    '''
+    Return dict {path in archive: Path} of all files in dir_path (recursively),
+    archive paths being prefixed with arc_dir.
+
+    Symlinks to directories are followed, except those pointing to the
+    directory itself or its parent (that would be an endless loop).
+    '''
+    dir_path = Path(dir_path)
+    files = {}
+    ancestors = {str(dir_path): frozenset()}
+    for dir_name, sub_dir_names, file_names in os.walk(str(dir_path), followlinks=True):
+        seen = ancestors.pop(dir_name) | {dir_identity(dir_name)}
+        for name in list(sub_dir_names):
+            if dir_identity(os.path.join(dir_name, name)) in seen:
+                logger.warning('Skipping directory link cycle: %s', os.path.join(dir_name, name))
+                sub_dir_names.remove(name)
+        sub_dir_names.sort()
+        for name in sub_dir_names:
+            ancestors[os.path.join(dir_name, name)] = seen
+        rel_dir = Path(dir_name).relative_to(dir_path)
+        for name in sorted(file_names):
+            files[(Path(arc_dir) / rel_dir / name).as_posix()] = Path(dir_name) / name
+    return files
+
+
+def dir_identity(path):
+    st = os.stat(path)
+    return st.st_dev, st.st_ino
+
+
+def build_manifest(items):
+    '''
+    Return dict {path in archive: sha1 hex digest} for upload items
+    (dict {path in archive: source Path or bytes content}).
+    '''
+    manifest = {}
+    for name, item in items.items():
+        if isinstance(item, bytes):
+            manifest[name] = hashlib.sha1(item).hexdigest()
+        else:
+            manifest[name] = file_sha1(item)
+    return manifest
+
+
+def file_sha1(path, chunk_size=2**20):
+    h = hashlib.sha1()
+    with Path(path).open('rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def format_manifest(manifest):
+    '''
+    Serialize manifest in the format of sha1sum tool output.
+    '''
+    return ''.join('{}  {}\n'.format(manifest[p], p) for p in sorted(manifest))
+
+
+def parse_manifest(text):
+    '''
+    Parse manifest serialized by format_manifest.
+    '''
+    manifest = {}
+    for line in text.splitlines():
+        sha1, sep, path = line.partition('  ')
+        if not sep or len(sha1) != 40:
+            raise ValueError('Invalid manifest line: {!r}'.format(line))
+        manifest[path] = sha1
+    return manifest
+
+
+def manifest_sha1(manifest):
+    return hashlib.sha1(format_manifest(manifest).encode()).hexdigest()
+
+
+def diff_manifests(old_manifest, new_manifest):
+    '''
+    Return tuple (changed, deleted) - lists of paths that are new or changed
+    in new_manifest and paths that are present only in old_manifest.
+    '''
+    old_manifest = old_manifest or {}
+    changed = sorted(p for p, h in new_manifest.items() if old_manifest.get(p) != h)
+    deleted = sorted(p for p in old_manifest if p not in new_manifest)
+    return changed, deleted
+
+
+def write_tar(f, members):
+    '''
+    Write uncompressed tar archive into binary file object f in streaming mode.
+
+    Parameter members is list of tuples (path in archive, source Path or bytes content).
+    '''
+    with tarfile.open(fileobj=f, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+        for name, item in members:
+            if isinstance(item, bytes):
+                info = tarfile.TarInfo(name)
+                info.size = len(item)
+                info.mtime = time()
+                info.mode = 0o644
+                tar.addfile(info, BytesIO(item))
+            else:
+                with item.open('rb') as src:
+                    # fstat, not lstat - symlinks are uploaded as regular files
+                    info = tar.gettarinfo(arcname=name, fileobj=src)
+                    tar.addfile(info, src)
+
+
+class HashingWriter:
+    '''
+    Wraps binary file object and computes sha1 of all data written to it.
+    '''
+
+    def __init__(self, f):
+        self._f = f
+        self._sha1 = hashlib.sha1()
+        self.size = 0
+
+    def write(self, data):
+        self._sha1.update(data)
+        self.size += len(data)
+        return self._f.write(data)
+
+    def hexdigest(self):
+        return self._sha1.hexdigest()
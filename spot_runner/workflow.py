@@ -1,129 +1,746 @@
+from base64 import b64decode
 import boto3
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime
+from functools import partial
 import logging
-import hashlib
-from pathlib import Path
+import os
 from reprlib import repr as smart_repr
+import shlex
+import socket
 from socket import getfqdn
 import subprocess
+import sys
+from threading import Event, Lock, Thread
 from time import monotonic as monotime, sleep
 
+from .api_cache import ApiCache
+from .bake import bake_hash, bake_key, find_baked_image, gc_baked_images, image_tag_specifications
+from .compression import \
+    choose_codec, compressor, decompress_command, estimate_compressibility, local_codecs, \
+    parse_remote_codecs, remote_codecs_script, remote_tar_command
+from .download import CountingReader, download_script, extract_tar_stream
 from .errors import AppError
 from .file_transformations import preprocess_file
+from .interruption import InterruptionWatcher, instance_action_script, is_interrupted_state, parse_instance_action
+from .pool import \
+    find_idle_instances, host_key_tag, instance_tags, lease_script_template, lease_taken, pool_fingerprint, \
+    pool_tags, release_script_template, release_tags, terminate_expired_instances
+from .spot_prices import apply_pool, fetch_instance_type_info, fetch_price_history, rank_pools
+from .state import InstanceState
+from .timings import timings
+from .upload import \
+    HashingWriter, build_manifest, diff_manifests, format_manifest, list_dir_files, \
+    manifest_sha1, meta_dir_name, parse_manifest, write_tar
 
 
 logger = logging.getLogger(__name__)
 
+# Exit code of ssh when the connection fails (or is lost)
+ssh_connection_failed = 255
+
 
 class RunSpotInstance:
 
     console_output_timeout = 300
+    ssh_probe_timeout = 300
+    capacity_wait_timeout = 600
+    pending_timeout = 600
+    interruption_poll_interval = 15
+    instance_state_poll_interval = 60
+    ssh_path = '/usr/bin/ssh'
+    image_info_ttl = 86400
+    instance_info_ttl = 1800
 
-    def __init__(self, state, blueprint, temp_dir):
+    def __init__(self, state, blueprint, temp_dir, ec2_client=None, instance_index=None, api_cache=None):
+        '''
+        Parameter instance_index is set when this object manages one instance
+        of a multi-instance task (see RunSpotInstances); SSH output is then
+        prefixed by instance id.
+        '''
         self.state = state
         self.blueprint = blueprint
         self.temp_dir = temp_dir
-        self.ec2_client = boto3.client('ec2', region_name=blueprint.region_name)
+        self.ec2_client = ec2_client or state_ec2_client(state, blueprint)
+        self.instance_index = instance_index
+        self.api_cache = api_cache or ApiCache()
+        self.ssh_path = os.environ.get('SPOT_RUNNER_SSH') or self.ssh_path
         self._instance_info = None
+        self._pool_fingerprint = None
+        self._bake_hash = None
+        self._ssh_masters = set()
+        self._ssh_master_lock = Lock()
+        self._processes = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        '''
+        Stop SSH master connections, if any were started.
+        '''
+        for user in sorted(self._ssh_masters):
+            cmd = [self.ssh_path] + self.ssh_connection_args(user) + ['-O', 'exit', self.instance_public_ip()]
+            logger.debug('Stopping SSH master connection: %s', cmd)
+            subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self._ssh_masters.clear()
 
     def run_spot_instance(self):
-        self.ensure_instance()
-        self.instance_info()
-        self.upload()
-        self.run_ssh(self.blueprint.remote_command)
+        '''
+        Launch (if not launched yet) and prepare the instance, upload data and
+        run the remote command.
+
+        If the instance is reclaimed by AWS meanwhile, a new instance is
+        launched (at most blueprint.max_relaunches times) and the remote
+        command runs again there with environment variable RELAUNCH_COUNT.
+
+        With blueprint.pool_idle_ttl the instance is returned to the warm
+        pool (see release_to_pool) when the run finishes; after a failed run
+        it is terminated instead, as its state is unknown.
+        '''
+        while True:
+            watcher = None
+            try:
+                self.ensure_instance()
+                self.prepare_instance()
+                set_stage(self.state, 'ready')
+                with self.phase('upload'):
+                    self.upload()
+                self.run_setup_command()
+                set_stage(self.state, 'running')
+                with self.interruption_watcher() as watcher:
+                    with self.phase('remote_command'):
+                        self.run_ssh(
+                            self.blueprint.remote_command,
+                            env={'RELAUNCH_COUNT': self.state.get('relaunch_count') or 0})
+                    if self.blueprint.download_paths:
+                        with self.phase('download'):
+                            self.download(self.blueprint.download_paths, self.blueprint.download_dir)
+            except BaseException as e:
+                if isinstance(e, Exception) and self.instance_interrupted(watcher):
+                    if (self.state.get('relaunch_count') or 0) < self.blueprint.max_relaunches:
+                        set_stage(self.state, 'interrupted')
+                        self.relaunch_spot_instance()
+                        continue
+                    logger.error('Instance interrupted, no relaunches left')
+                elif isinstance(e, Exception) and self.uses_pool():
+                    self.terminate_pooled_instance()
+                set_stage(self.state, 'failed')
+                raise
+            set_stage(self.state, 'finished')
+            self.try_release_to_pool()
+            return
+
+    def uses_pool(self):
+        return bool(
+            self.blueprint.pool_idle_ttl and self.instance_index is None and self.state.get('instance_id'))
+
+    def try_release_to_pool(self):
+        '''
+        Return the instance to the warm pool if the blueprint uses it.
+        If that fails, the instance is terminated, so that it is not left
+        running outside the pool.
+        '''
+        if not self.uses_pool():
+            return
+        try:
+            self.release_to_pool()
+        except Exception as e:
+            logger.warning('Failed to return instance to the warm pool: %r', e)
+            self.terminate_pooled_instance()
+
+    def terminate_pooled_instance(self):
+        instance_id = self.state['instance_id']
+        logger.info('Terminating instance %s instead of returning it to the warm pool', instance_id)
+        try:
+            self.ec2_client.terminate_instances(InstanceIds=[instance_id])
+        except Exception as e:
+            logger.error('Failed to terminate instance %s: %r', instance_id, e)
+
+    def run_setup_command(self):
+        '''
+        Run blueprint setup_command unless it has already run on the instance
+        or the instance was launched from an image baked with it (see bake).
+        '''
+        if self.blueprint.setup_command and not self.state.get('setup_done'):
+            with self.phase('setup'):
+                self.run_ssh(self.blueprint.setup_command)
+            self.state['setup_done'] = True
+
+    def bake(self, force=False):
+        '''
+        Launch instance from the blueprint image, upload data, run setup_command
+        and create image (AMI) from the instance, tagged by bake hash. Following
+        launches of the blueprint use this image and skip setup_command.
+        Only one instance is launched, whatever blueprint.count is.
+
+        The instance is terminated (also when baking fails) and images baked
+        from older versions of the blueprint are deregistered (except
+        blueprint.bake_keep newest). Returns the image id.
+        '''
+        if not force:
+            image_id = find_baked_image(self.ec2_client, self.bake_hash())
+            if image_id:
+                logger.info('Image %s with matching bake hash already exists', image_id)
+                return image_id
+        try:
+            self.launch_spot_instances(baked=False, count=1)
+            self.prepare_instance()
+            with self.phase('upload'):
+                self.upload()
+            self.run_setup_command()
+            with self.phase('create_image'):
+                reply = self.ec2_client.create_image(
+                    InstanceId=self.instance_id(),
+                    Name='{}-{}'.format(self.state['task_id'], self.bake_hash()[:12]),
+                    Description='Baked by spot-runner',
+                    TagSpecifications=image_tag_specifications(
+                        self.bake_hash(), self.bake_key(), self.state['task_id']))
+                image_id = reply['ImageId']
+                self.state['baked_image_id'] = image_id
+                logger.info('Creating image %s...', image_id)
+                waiter = self.ec2_client.get_waiter('image_available')
+                waiter.wait(ImageIds=[image_id], WaiterConfig={'Delay': 15, 'MaxAttempts': 240})
+            logger.info('Image %s is available', image_id)
+        except BaseException:
+            set_stage(self.state, 'failed')
+            raise
+        finally:
+            instance_ids = [self.state.get('instance_id')]
+            instance_ids += [i['instance_id'] for i in self.state.get('instances') or []]
+            instance_ids = [i for i in instance_ids if i]
+            if instance_ids:
+                logger.info('Terminating bake instance %s', ' '.join(instance_ids))
+                self.ec2_client.terminate_instances(InstanceIds=instance_ids)
+        set_stage(self.state, 'finished')
+        gc_baked_images(self.ec2_client, self.bake_key(), self.blueprint.bake_keep)
+        return image_id
+
+    def bake_hash(self):
+        if not self._bake_hash:
+            bp = self.blueprint
+            data_sha1 = manifest_sha1(build_manifest(self.static_upload_items()))
+            self._bake_hash = bake_hash(bp.region_name, bp.launch_specification, data_sha1, bp.setup_command)
+        return self._bake_hash
+
+    def bake_key(self):
+        return bake_key(self.blueprint.region_name, self.blueprint.bake_name)
+
+    def phase(self, name):
+        '''
+        Return context manager timing a workflow phase (see timings module).
+        Following API calls are tagged by the same instance type.
+        '''
+        info = self._instance_info or self.state.get('instance_info') or {}
+        instance_type = info.get('InstanceType') or self.blueprint.launch_specification.get('InstanceType')
+        timings.tag_client(self.ec2_client, instance_type=instance_type)
+        return timings.phase(name, region=self.ec2_client.meta.region_name, instance_type=instance_type)
+
+    def interruption_watcher(self):
+        return InterruptionWatcher(
+            poll_notice=self.poll_interruption_notice,
+            poll_instance_state=self.poll_instance_state,
+            on_notice=self.run_checkpoint_command,
+            on_reclaim=self.kill_ssh_processes,
+            interval=self.interruption_poll_interval,
+            state_interval=self.instance_state_poll_interval)
+
+    def kill_ssh_processes(self):
+        '''
+        Kill ssh commands running on the instance (see run_ssh) - used when
+        the instance is gone, so that they do not wait for the dead host.
+        '''
+        for p in list(self._processes):
+            logger.warning('Killing SSH command (pid %s) of reclaimed instance', p.pid)
+            p.kill()
+
+    def poll_interruption_notice(self):
+        user = self.blueprint.ssh_username or 'admin'
+        cmd = [self.ssh_path] + self.ssh_connection_args(user) + [
+            '-o', 'BatchMode=yes',
+            '-o', 'ConnectTimeout=10',
+            self.instance_public_ip(),
+            instance_action_script,
+        ]
+        p = subprocess.run(
+            cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=60)
+        return parse_instance_action(p.stdout.decode())
+
+    def poll_instance_state(self):
+        '''
+        Return dict with instance State and StateReason or None if the instance
+        does not exist (anymore). Not cached.
+        '''
+        try:
+            reply = self.ec2_client.describe_instances(DryRun=False, InstanceIds=[self.instance_id()])
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'InvalidInstanceID.NotFound':
+                return None
+            raise
+        for reservation in reply['Reservations']:
+            for instance in reservation['Instances']:
+                return instance
+        return None
+
+    def run_checkpoint_command(self, notice):
+        if self.blueprint.checkpoint_command:
+            logger.info('Running checkpoint command')
+            self.run_ssh(
+                self.blueprint.checkpoint_command,
+                env={'INTERRUPTION_ACTION': notice['action'], 'INTERRUPTION_TIME': notice.get('time', '')})
+
+    def instance_interrupted(self, watcher=None):
+        '''
+        Return True if the instance got spot interruption notice or
+        it was reclaimed by AWS.
+        '''
+        if watcher is not None and watcher.interrupted:
+            return True
+        if not self.state.get('instance_id'):
+            return False
+        try:
+            return is_interrupted_state(self.poll_instance_state())
+        except Exception as e:
+            logger.debug('Failed to check instance state: %r', e)
+            return False
+
+    def relaunch_spot_instance(self):
+        '''
+        Forget the interrupted instance and launch a new one for the same task.
+        '''
+        old_instance_id = self.instance_id()
+        relaunch_count = (self.state.get('relaunch_count') or 0) + 1
+        logger.warning('Instance %s was interrupted, relaunching (%s/%s)',
+                       old_instance_id, relaunch_count, self.blueprint.max_relaunches)
+        self.forget_instance()
+        interrupted_ids = list(self.state.get('interrupted_instance_ids') or [])
+        self.state['interrupted_instance_ids'] = interrupted_ids + [old_instance_id]
+        self.state['relaunch_count'] = relaunch_count
+        self.launch_spot_instances(relaunch=True)
+
+    def forget_instance(self):
+        '''
+        Clear everything the state and this object know about the instance.
+        '''
+        instance_id = self.state.get('instance_id')
+        self.close()
+        if instance_id:
+            self.api_cache.invalidate(instance_id)
+        for key in instance_state_keys:
+            if self.state.get(key) is not None:
+                self.state[key] = None
+        self._instance_info = None
+        host_key_path = self.temp_dir / 'instance_host_key'
+        if host_key_path.exists():
+            host_key_path.unlink()
+
+    def pool_fingerprint(self):
+        if not self._pool_fingerprint:
+            bp = self.blueprint
+            data_sha1 = manifest_sha1(build_manifest(self.static_upload_items()))
+            self._pool_fingerprint = pool_fingerprint(
+                bp.region_name, bp.launch_specification, bp.instance_types, data_sha1, bp.setup_command)
+        return self._pool_fingerprint
+
+    def lease_pooled_instance(self):
+        '''
+        Take over an idle instance from the warm pool - launched with the same
+        blueprint and with the same data uploaded (see pool module).
+
+        Returns True if an instance was leased.
+        '''
+        terminate_expired_instances(self.ec2_client)
+        fingerprint = self.pool_fingerprint()
+        for instance in find_idle_instances(self.ec2_client, fingerprint):
+            instance_id = instance['InstanceId']
+            self.state['instance_id'] = instance_id
+            self.state['instance_info'] = instance
+            self.state['public_ip'] = instance['PublicIpAddress']
+            self.state['instance_ok'] = True
+            self._instance_info = instance
+            host_key = instance_tags(instance).get(host_key_tag)
+            if host_key:
+                self.state['instance_host_keys'] = [host_key]
+            try:
+                manifest_text = self.run_pool_script(
+                    lease_script_template.format(taken=lease_taken, meta=meta_dir_name))
+            except AppError as e:
+                logger.info('Failed to lease idle instance %s: %s', instance_id, e)
+                manifest_text = None
+            if manifest_text is None:
+                self.forget_instance()
+                continue
+            task_id = generate_task_id(self.blueprint.task_id_template)
+            logger.info('Leased idle instance %s', instance_id)
+            self.ec2_client.delete_tags(Resources=[instance_id], Tags=[{'Key': k} for k in pool_tags])
+            self.tag_instance(instance_id, task_id)
+            self.tag_volumes(instance_id, task_id)
+            if manifest_text.strip():
+                manifest = parse_manifest(manifest_text)
+                self.state['uploaded_manifest'] = manifest
+                self.state['uploaded_data_sha1'] = manifest_sha1(manifest)
+            self.state['tags_created'] = True
+            self.state['setup_done'] = True
+            self.state['task_id'] = task_id
+            self.state['region'] = self.ec2_client.meta.region_name
+            self.state['leased_from_pool'] = True
+            self.state['stage'] = 'launched'
+            self.state.flush()
+            return True
+        logger.info('No idle instance in the warm pool')
+        return False
+
+    def release_to_pool(self):
+        '''
+        Return the instance to the warm pool, so that a following run
+        of the same blueprint can lease it. The instance is terminated
+        when it stays idle for blueprint.pool_idle_ttl seconds.
+        '''
+        if self.ec2_client.meta.region_name != self.blueprint.region_name:
+            logger.info('Instance launched outside blueprint region is not returned to the warm pool')
+            return
+        ttl = self.blueprint.pool_idle_ttl
+        self.run_pool_script(release_script_template.format(minutes=ttl // 60 + 5))
+        self.ec2_client.create_tags(
+            Resources=[self.instance_id()],
+            Tags=release_tags(self.pool_fingerprint(), ttl, self.state.get('instance_host_keys')))
+        self.state['released_to_pool'] = True
+        logger.info('Instance %s returned to the warm pool for %s s', self.instance_id(), ttl)
+        terminate_expired_instances(self.ec2_client)
+
+    def run_pool_script(self, script):
+        '''
+        Run lease or release script on the instance and return its output
+        or None if the instance is already leased.
+        '''
+        user = self.blueprint.ssh_username or 'admin'
+        cmd = [self.ssh_path] + self.ssh_connection_args(user) + [
+            '-o', 'BatchMode=yes',
+            '-o', 'ConnectTimeout=10',
+            self.instance_public_ip(),
+            script,
+        ]
+        p = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if p.returncode == lease_taken:
+            return None
+        if p.returncode != 0:
+            raise AppError('Failed to run pool script on the instance: {}'.format(p.stderr.decode().strip()))
+        return p.stdout.decode()
 
     def run_interactive_ssh(self, user=None):
         self.ensure_instance()
-        self.instance_info()
+        self.prepare_instance()
         self.run_ssh(self.blueprint.interactive_shell or ['/bin/bash', '-l'], user=user, tty=True)
 
     def run_ssh_command(self, command, user=None):
         assert isinstance(command, (list, tuple))
         command = list(command)
         self.ensure_instance()
-        self.instance_info()
+        self.prepare_instance()
         self.run_ssh(command, user=user, tty=False)
 
     def ensure_instance(self):
         if self.state.get('instance_id'):
             logger.info('Instance id: %s', self.state['instance_id'])
         elif not self.state.get('spot_instance_request_id'):
-            self.create_spot_instance_request()
+            if self.blueprint.pool_idle_ttl and not self.state.get('task_id'):
+                with self.phase('lease'):
+                    if self.lease_pooled_instance():
+                        return
+            self.launch_spot_instances()
+
+    def prepare_instance(self):
+        '''
+        Retrieve instance info and SSH host keys. These API calls are
+        independent, so they run concurrently.
+        '''
+        self.instance_id()
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [
+                executor.submit(self.instance_info),
+                executor.submit(self.instance_host_keys),
+            ]
+        for f in futures:
+            f.result()
 
     def upload(self):
-        build_dir = self.prepare_upload_build()
-        for p in '/bin/tar', '/usr/bin/tar':
-            if Path(p).exists():
-                tar_path = p
-                break
-        else:
-            raise Exception('Could not find tar')
-        data = subprocess.check_output([str(tar_path), 'c', '-C', str(build_dir), '.'])
-        data_sha1 = hashlib.sha1(data).hexdigest()
+        items = self.upload_items()
+        manifest = build_manifest(items)
+        data_sha1 = manifest_sha1(manifest)
         if self.state.get('uploaded_data_sha1') == data_sha1:
             logger.info('Remote data are already uploaded (sha1: %s)', data_sha1)
+            return
+        base_manifest = self.state.get('uploaded_manifest')
+        if base_manifest:
+            if self.upload_delta(items, base_manifest, manifest) == remote_manifest_mismatch:
+                logger.warning('Remote uploaded data do not match state, uploading everything')
+                self.upload_delta(items, None, manifest)
         else:
-            self.run_ssh(['mkdir', '-p', 'uploaded'])
-            self.run_ssh(['tar', 'x', '-C', 'uploaded'], input=data)
-            self.state['uploaded_data_sha1'] = data_sha1
-            logger.info('Uploaded remote data')
-
-    def prepare_upload_build(self):
-        from shutil import copy2, copytree
-        build_dir = self.temp_dir / 'upload_build'
-        logger.debug('Upload build dir: %s', build_dir)
-        build_dir.mkdir()
-        for p in self.blueprint.upload_paths:
-            if not p.exists():
-                p = p.expanduser()
-            if not p.exists():
-                raise Exception('Upload item does not exist: {}'.format(p))
-            if p.is_dir():
-                logger.info('Copying directory %s to %s', p, build_dir)
-                copytree(str(p), str(build_dir / p.name))
-            else:
-                logger.info('Copying file %s to %s', p, build_dir)
-                copy2(str(p), str(build_dir / p.name))
+            self.upload_delta(items, None, manifest)
+        self.state['uploaded_manifest'] = manifest
+        self.state['uploaded_data_sha1'] = data_sha1
+        logger.info('Uploaded remote data')
+
+    def upload_delta(self, items, base_manifest, manifest):
+        '''
+        Upload files that are not present in base_manifest and delete files
+        that are not present in manifest.
+
+        Remote side checks that its manifest matches base_manifest; if not,
+        nothing is changed and remote_manifest_mismatch is returned.
+        '''
+        changed, deleted = diff_manifests(base_manifest, manifest)
+        logger.info('Uploading %d new or changed files, deleting %d files', len(changed), len(deleted))
+        members = [(name, items[name]) for name in changed]
+        members.append((meta_dir_name + '/manifest', format_manifest(manifest).encode()))
+        members.append((meta_dir_name + '/deleted', b''.join(p.encode() + b'\0' for p in deleted)))
+        codec = self.transfer_codec(ratio=estimate_compressibility({name: items[name] for name in changed}))
+        script = upload_script_template.format(
+            meta=meta_dir_name,
+            expected_sha1=manifest_sha1(base_manifest) if base_manifest else '',
+            mismatch=remote_manifest_mismatch,
+            tar_extract=remote_tar_command(codec, ['-x', '-f', '-']))
+        # Archive is written directly to ssh stdin (through the compressor),
+        # so it is never held in memory and the transfer runs while the files
+        # are still being read.
+        writer = None
+
+        def write_archive(f):
+            nonlocal writer
+            with compressor(codec, f) as cf:
+                writer = HashingWriter(cf)
+                write_tar(writer, members)
+
+        start_mt = monotime()
+        returncode = self.run_ssh(
+            ['sh', '-c', shlex.quote(script)],
+            input=write_archive, check_returncodes=[remote_manifest_mismatch], compress=(codec == 'ssh'))
+        if returncode == remote_manifest_mismatch:
+            return returncode
+        self.record_throughput(writer.size, monotime() - start_mt)
+        logger.info('Uploaded archive: %d bytes, sha1: %s', writer.size, writer.hexdigest())
+        self.state['uploaded_archive_sha1'] = writer.hexdigest()
+        return returncode
+
+    def transfer_codec(self, ratio=None):
+        '''
+        Return codec (see compression module) for upload or download.
+        '''
+        codec = self.blueprint.compression
+        if codec == 'auto':
+            available = [c for c in local_codecs() if c in self.remote_codecs()]
+            codec = choose_codec(available, ratio=ratio, throughput=self.state.get('transfer_throughput'))
+            logger.debug(
+                'Chose transfer codec %s (available: %s, estimated ratio: %s)',
+                codec, ' '.join(available), ratio)
+        return codec
+
+    def remote_codecs(self):
+        if self.state.get('remote_codecs') is None:
+            user = self.blueprint.ssh_username or 'admin'
+            if self.blueprint.ssh_multiplexing:
+                self.ensure_ssh_master(user)
+            cmd = [self.ssh_path] + self.ssh_connection_args(user) + [
+                self.instance_public_ip(),
+                remote_codecs_script,
+            ]
+            p = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+            if p.returncode != 0:
+                raise AppError('Failed to list compression programs on the instance')
+            self.state['remote_codecs'] = parse_remote_codecs(p.stdout.decode())
+        return self.state['remote_codecs']
+
+    def record_throughput(self, size, duration):
+        '''
+        Save throughput of a transfer of size bytes (uncompressed); only
+        transfers large enough to be meaningful are taken into account.
+        '''
+        if size >= 2**24 and duration > 0:
+            self.state['transfer_throughput'] = size / duration
+
+    def upload_items(self):
+        '''
+        Return dict {path in upload archive: source Path or bytes content}.
+        '''
+        items = self.static_upload_items()
         for p in self.blueprint.upload_preprocessed_paths:
             if not p.is_file():
                 raise Exception('Preprocess path must be file: {}'.format(p))
             content = preprocess_file(p, values={
                 'instance_id': self.state['instance_id'],
                 'task_id': self.state['task_id'],
+                'instance_index': self.instance_index,
             })
-            target_path = build_dir / p.name
-            if target_path.exists():
-                logger.info('Rewriting file %s', target_path)
-            with target_path.open('w') as f:
-                f.write(content)
-        return build_dir
-
-    def run_ssh(self, cmd, user=None, input=None, tty=False):
-        assert isinstance(cmd, list)
-        ssh_args = [
-            '-S', 'none',
-            '-C',
-            '-i', str(self.ssh_private_key_path()),
-            '-l', user or self.blueprint.ssh_username or 'admin',
-            '-o', 'UserKnownHostsFile=' + str(self.instance_host_key_path()),
+            if p.name in items:
+                logger.info('Rewriting file %s', p.name)
+            items[p.name] = content.encode()
+        return items
+
+    def static_upload_items(self):
+        '''
+        Return upload items that do not depend on the task (not preprocessed).
+        '''
+        items = {}
+        for p in self.blueprint.upload_paths:
+            if not p.exists():
+                p = p.expanduser()
+            if not p.exists():
+                raise Exception('Upload item does not exist: {}'.format(p))
+            if p.is_dir():
+                logger.info('Uploading directory %s', p)
+                items.update(list_dir_files(p, p.name))
+            else:
+                logger.info('Uploading file %s', p)
+                items[p.name] = p
+        return items
+
+    def download(self, paths, dest_dir):
+        '''
+        Download remote paths (relative to the home directory or absolute)
+        into dest_dir (into its subdirectory named by instance id for
+        multi-instance tasks). Paths are downloaded concurrently.
+        '''
+        if self.instance_index is not None:
+            dest_dir = dest_dir / self.instance_id()
+        run_parallel(
+            min(len(paths), self.blueprint.max_workers),
+            [partial(self.download_path, path, dest_dir) for path in paths])
+
+    def download_path(self, remote_path, dest_dir):
+        '''
+        Stream remote path as compressed tar archive over SSH and extract it
+        into dest_dir on the fly.
+        '''
+        user = self.blueprint.ssh_username or 'admin'
+        if self.blueprint.ssh_multiplexing:
+            self.ensure_ssh_master(user)
+        codec = self.transfer_codec()
+        cmd = [self.ssh_path] + self.ssh_connection_args(user) + ([] if codec != 'ssh' else ['-C']) + [
+            self.instance_public_ip(),
+            download_script(remote_path, codec),
         ]
+        logger.info('Downloading %s into %s (compression: %s)', remote_path, dest_dir, codec)
+        logger.debug('Full command: %s', cmd)
+        start_mt = monotime()
+        processes = [subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)]
+        if decompress_command(codec):
+            processes.append(subprocess.Popen(
+                decompress_command(codec), stdin=processes[0].stdout, stdout=subprocess.PIPE))
+            # only the decompressor reads ssh output
+            processes[0].stdout.close()
+        reader = CountingReader(processes[-1].stdout)
+        try:
+            count = extract_tar_stream(reader, dest_dir)
+        except Exception as e:
+            for p in processes:
+                p.kill()
+                p.wait()
+            raise AppError('Failed to download {}: {!r}'.format(remote_path, e)) from e
+        finally:
+            processes[-1].stdout.close()
+        for p in processes:
+            returncode = p.wait()
+            if returncode != 0:
+                raise AppError('Failed to download {}: {} exited with code {}'.format(
+                    remote_path, p.args[0], returncode))
+        duration = monotime() - start_mt
+        self.record_throughput(reader.size, duration)
+        logger.info(
+            'Downloaded %s: %d files, %.1f MB in %.1f s (%.1f MB/s)',
+            remote_path, count, reader.size / 2**20, duration, reader.size / 2**20 / max(duration, 0.001))
+
+    def run_ssh(self, cmd, user=None, input=None, tty=False, check_returncodes=(), env=None, compress=True):
+        '''
+        Run command on the instance via SSH. Raise AppError if the command fails,
+        unless its exit code is listed in check_returncodes - then return it.
+
+        Parameter input can be bytes or a function that writes the command
+        input to a binary file object passed as its argument.
+        Parameter env is dict of additional environment variables.
+        Parameter compress enables ssh compression (-C).
+        '''
+        assert isinstance(cmd, list)
+        user = user or self.blueprint.ssh_username or 'admin'
+        if self.blueprint.ssh_multiplexing:
+            self.ensure_ssh_master(user)
+        ssh_args = self.ssh_connection_args(user)
+        if compress:
+            ssh_args.append('-C')
         if tty:
             ssh_args.append('-t')
+        env_args = ['TASK_ID=' + self.state['task_id']]
+        output_prefix = None
+        if self.instance_index is not None:
+            env_args.append('INSTANCE_INDEX={}'.format(self.instance_index))
+            env_args.append('INSTANCE_COUNT={}'.format(len(self.state['instances'])))
+            if not tty:
+                output_prefix = '[{}] '.format(self.instance_id())
+        for k, v in sorted((env or {}).items()):
+            env_args.append('{}={}'.format(k, shlex.quote(str(v))))
         full_cmd = [
-            '/usr/bin/ssh',
+            self.ssh_path,
         ] + ssh_args + [
             self.instance_public_ip(),
             'env',
-            'TASK_ID=' + self.state['task_id'],
-        ] + cmd
+        ] + env_args + cmd
         logger.info('Running SSH %s', cmd)
         logger.debug('Full command: %s', full_cmd)
         try:
-            subprocess.run(full_cmd, input=input, check=True)
+            returncode = run_process(full_cmd, input=input, output_prefix=output_prefix, processes=self._processes)
+            if returncode == ssh_connection_failed:
+                # ssh connection failed - maybe the instance is gone, do not rely on cached info
+                self.api_cache.invalidate(self.instance_id())
+            if returncode in check_returncodes:
+                return returncode
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, full_cmd)
+            return returncode
         except Exception as e:
             logger.error('Caught exception while running ssh: %r', e)
             raise AppError('Failed to run SSH command: {!r}'.format(cmd)) from e
 
+    def ssh_connection_args(self, user):
+        args = [
+            '-i', str(self.ssh_private_key_path()),
+            '-l', user,
+            '-o', 'UserKnownHostsFile=' + str(self.instance_host_key_path()),
+            # notice a dead (reclaimed) instance in about a minute instead of hanging
+            '-o', 'ServerAliveInterval=15',
+            '-o', 'ServerAliveCountMax=4',
+        ]
+        if self.blueprint.ssh_multiplexing:
+            args += ['-o', 'ControlPath=' + str(self.temp_dir / 'ssh_control-%r')]
+        else:
+            args += ['-S', 'none']
+        return args
+
+    def ensure_ssh_master(self, user):
+        '''
+        Start SSH master connection that subsequent ssh calls reuse.
+        '''
+        with self._ssh_master_lock:
+            if user not in self._ssh_masters:
+                self._start_ssh_master(user)
+
+    def _start_ssh_master(self, user):
+        cmd = [self.ssh_path] + self.ssh_connection_args(user) + [
+            '-o', 'ControlMaster=yes',
+            '-o', 'ControlPersist=yes',
+            '-f', '-N',
+            self.instance_public_ip(),
+        ]
+        logger.info('Starting SSH master connection')
+        logger.debug('Full command: %s', cmd)
+        # The master runs in background - it must not inherit our stdout/stderr
+        p = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if p.returncode != 0:
+            raise AppError('Failed to start SSH master connection: {}'.format(p.stderr.decode().strip()))
+        self._ssh_masters.add(user)
+
     def ssh_private_key_path(self):
         if not self.blueprint.ssh_private_key:
             msg = 'No SSH private key available. '
@@ -151,38 +768,56 @@ class RunSpotInstance:
     def instance_host_keys(self):
         if not self.state.get('instance_host_keys'):
             out = self.instance_console_output()
-            self.state['instance_host_keys'] = parse_host_ssh_keys(out)
+            with self.phase('host_keys'):
+                self.state['instance_host_keys'] = parse_host_ssh_keys(out)
         return self.state['instance_host_keys']
 
     def instance_console_output(self):
         self.instance_ready()
         start_mt = monotime()
-        while True:
-            logger.info('Getting console output of instance %s...', self.instance_id())
-            reply = self.ec2_client.get_console_output(DryRun=False, InstanceId=self.instance_id())
-            logger.debug('reply: %s', smart_repr(reply))
-            if 'Output' in reply:
-                return reply['Output'].splitlines()
-            if monotime() - start_mt > self.console_output_timeout:
-                raise Exception('No console output received')
-            logger.debug('No output yet, sleeping...')
-            sleep(3)
+        with self.phase('console_output'):
+            while True:
+                logger.info('Getting console output of instance %s...', self.instance_id())
+                reply = self.ec2_client.get_console_output(DryRun=False, InstanceId=self.instance_id())
+                logger.debug('reply: %s', smart_repr(reply))
+                if 'Output' in reply:
+                    return reply['Output'].splitlines()
+                if monotime() - start_mt > self.console_output_timeout:
+                    raise Exception('No console output received')
+                logger.debug('No output yet, sleeping...')
+                sleep(3)
 
     def instance_ready(self):
         if not self.state.get('instance_ok'):
             logger.info('Waiter instance_running...')
-            waiter = self.ec2_client.get_waiter('instance_running')
-            waiter.wait(DryRun=False, InstanceIds=[self.instance_id()])
+            with self.phase('instance_running'):
+                waiter = self.ec2_client.get_waiter('instance_running')
+                waiter.wait(DryRun=False, InstanceIds=[self.instance_id()])
+            if self.blueprint.fast_start:
+                # instance info retrieved before the instance was running may lack public IP
+                self._instance_info = None
+                ip = self.instance_public_ip()
+                logger.info('Waiting for SSH port on %s...', ip)
+                with self.phase('ssh_port'):
+                    port_open = wait_for_ssh_port(ip, timeout=self.ssh_probe_timeout)
+                if port_open:
+                    logger.info('SSH port is open')
+                    self.state['instance_ok'] = True
+                    return
+                logger.info('SSH port not open after %s s', self.ssh_probe_timeout)
             logger.info('Waiter instance_status_ok...')
-            waiter = self.ec2_client.get_waiter('instance_status_ok')
-            waiter.wait(DryRun=False, InstanceIds=[self.instance_id()])
+            with self.phase('instance_status_ok'):
+                waiter = self.ec2_client.get_waiter('instance_status_ok')
+                waiter.wait(DryRun=False, InstanceIds=[self.instance_id()])
             logger.info('Waiters done')
             self.state['instance_ok'] = True
 
     def instance_id(self):
         if not self.state.get('instance_id'):
+            # state created by older version that used request_spot_instances
             sir_id = self.state['spot_instance_request_id']
-            wait_for_sir_fullfilled(self.ec2_client, sir_id)
+            with self.phase('spot_request_fulfilment'):
+                wait_for_sir_fullfilled(self.ec2_client, sir_id)
             reply = self.ec2_client.describe_spot_instance_requests(
                 DryRun=False, SpotInstanceRequestIds=[sir_id])
             sir_info, = reply['SpotInstanceRequests']
@@ -223,13 +858,31 @@ class RunSpotInstance:
 
     def instance_info(self):
         if not self._instance_info:
-            reply = self.ec2_client.describe_instances(DryRun=False, InstanceIds=[self.instance_id()])
-            if not reply['Reservations']:
-                raise AppError('Could not find instance {} - maybe it was deleted?'.format(self.instance_id()))
+            # Running instance info is cached, so that following spot-runner
+            # invocations (like ssh) do not need to call the API
+            kwargs = dict(DryRun=False, InstanceIds=[self.instance_id()])
+            reply = self.api_cache.get(
+                self.ec2_client, 'describe_instances', self.instance_info_ttl, scope=self.instance_id(), **kwargs)
+            start_mt = monotime()
+            while reply is None:
+                reply = self.ec2_client.describe_instances(**kwargs)
+                if not reply['Reservations']:
+                    raise AppError('Could not find instance {} - maybe it was deleted?'.format(self.instance_id()))
+                instance = reply['Reservations'][0]['Instances'][0]
+                if instance['State']['Name'] == 'pending' and not instance.get('PublicIpAddress'):
+                    if monotime() - start_mt > self.pending_timeout:
+                        raise AppError('Instance {} has been pending without public IP address for {} s'.format(
+                            self.instance_id(), self.pending_timeout))
+                    logger.info('Instance %s is pending, waiting for public IP address...', self.instance_id())
+                    sleep(2)
+                    reply = None
+                elif instance['State']['Name'] == 'running':
+                    self.api_cache.put(
+                        self.ec2_client, 'describe_instances', reply, scope=self.instance_id(), **kwargs)
             reservation, = reply['Reservations']
+            instance, = reservation['Instances']
             logger.debug('Reservation: %r', reservation)
             logger.info('Reservation id: %s', reservation['ReservationId'])
-            instance, = reservation['Instances']
             assert instance['InstanceId'] == self.instance_id()
             assert instance['InstanceLifecycle'] == 'spot'
             logger.info('Instance state: %s (%r)', instance['State']['Name'], instance['State'])
@@ -239,43 +892,422 @@ class RunSpotInstance:
                 'Instance public IP address: %s (%s)',
                 instance['PublicIpAddress'], instance['PublicDnsName'])
             self.state['instance_info'] = instance
+            # stored separately for the ip-address command (see state_scan)
+            self.state['public_ip'] = instance['PublicIpAddress']
             self._instance_info = instance
         return self._instance_info
 
     def instance_public_ip(self):
         return self.instance_info()['PublicIpAddress']
 
-    def create_spot_instance_request(self):
-        assert not self.state.get('task_id')
-        task_id = generate_task_id(self.blueprint.task_id_template)
-        ami_id = self.blueprint.launch_specification['ImageId']
-        reply = self.ec2_client.describe_images(ImageIds=[ami_id])
+    def launch_spot_instances(self, relaunch=False, baked=True, count=None):
+        '''
+        Launch blueprint.count (or count) spot instances. For count 1 the instance id is
+        stored directly in the state, otherwise in list "instances" - one item
+        per instance (see InstanceState).
+
+        With relaunch=True launch just one instance replacing the interrupted
+        one of the existing task.
+
+        If the blueprint has setup_command and an image baked with it exists
+        (see bake), the instances are launched from that image, unless baked
+        is False. Not used in race mode.
+
+        Instances, their volumes and spot requests are tagged by the launch
+        API call itself.
+        '''
+        if relaunch:
+            task_id = self.state['task_id']
+            count = 1
+        else:
+            assert not self.state.get('task_id')
+            task_id = generate_task_id(self.blueprint.task_id_template)
+            count = count or self.blueprint.count
+        baked_image_id = None
+        with self.phase('launch'):
+            if self.blueprint.race:
+                region_name, reply = self.race_run_instances(task_id, count)
+            else:
+                launch_spec = self.blueprint.launch_specification
+                # the whitelist applies to the source image - baked images are owned by this account
+                self.check_image(self.ec2_client, launch_spec['ImageId'])
+                if baked and self.blueprint.setup_command:
+                    baked_image_id = find_baked_image(self.ec2_client, self.bake_hash())
+                    if baked_image_id:
+                        logger.info('Using baked image %s', baked_image_id)
+                        launch_spec = dict(launch_spec, ImageId=baked_image_id)
+                logger.debug('Launch spec: %r', launch_spec)
+                reply = self.run_instances(
+                    pools=self.select_spot_pools(),
+                    **self.run_instances_args(task_id, launch_spec, count))
+                region_name = self.blueprint.region_name
+        instances = [{
+            'instance_id': instance['InstanceId'],
+            'spot_instance_request_id': instance.get('SpotInstanceRequestId'),
+            'tags_created': True,
+        } for instance in reply['Instances']]
+        logger.info('Launched spot instances: %s', ' '.join(i['instance_id'] for i in instances))
+        if count == 1:
+            for k, v in instances[0].items():
+                self.state[k] = v
+        else:
+            self.state['instances'] = instances
+        if baked_image_id:
+            self.state['setup_done'] = True
+        self.state['task_id'] = task_id
+        self.state['region'] = region_name
+        self.state['stage'] = 'launched'
+        self.state.flush()
+
+    def check_image(self, ec2_client, ami_id):
+        reply = self.api_cache.call(ec2_client, 'describe_images', self.image_info_ttl, ImageIds=[ami_id])
         ami_info, = reply['Images']
         if self.blueprint.ami_owner_id_whitelist:
             if ami_info['OwnerId'] not in self.blueprint.ami_owner_id_whitelist:
                 raise Exception('AMI OwnerId {!r} not present in whitelist'.format(ami_info['OwnerId']))
             else:
                 logger.info('AMI OwnerId %r whitelisted', ami_info['OwnerId'])
-        logger.debug('Launch spec: %r', self.blueprint.launch_specification)
-        reply = self.ec2_client.request_spot_instances(
+
+    def run_instances_args(self, task_id, launch_specification, count):
+        return dict(
             DryRun=False,
-            SpotPrice=self.blueprint.spot_price,
-            InstanceCount=1,
-            Type='one-time',
-            LaunchSpecification=self.blueprint.launch_specification)
-        sir_id = reply['SpotInstanceRequests'][0]['SpotInstanceRequestId']
-        logger.info('Created spot instance request id: %s', sir_id)
-        self.state['spot_instance_request_id'] = sir_id
-        self.state['task_id'] = task_id
-        self.state.flush()
-        self.ec2_client.create_tags(
-            DryRun=False, Resources=[sir_id],
-            Tags=[
-                {'Key': 'Name', 'Value': task_id},
-                {'Key': 'TaskId', 'Value': task_id},
-                {'Key': 'CreatedBy', 'Value': __name__},
-            ])
-        logger.info('Spot instance request tags created')
+            MinCount=count,
+            MaxCount=count,
+            InstanceMarketOptions={
+                'MarketType': 'spot',
+                'SpotOptions': {
+                    'MaxPrice': str(self.blueprint.spot_price),
+                    'SpotInstanceType': 'one-time',
+                },
+            },
+            TagSpecifications=task_tag_specifications(task_id),
+            **run_instances_launch_args(launch_specification))
+
+    def race_run_instances(self, task_id, count):
+        '''
+        Launch instances in all pools listed in blueprint.race (regions or AZs)
+        at once. The first launch that succeeds wins; the other pools stop
+        retrying and instances launched there anyway are terminated.
+
+        Returns tuple (region name, run_instances reply) of the winner.
+        '''
+        won = Event()
+        launched = []
+        launched_lock = Lock()
+        # created here, not in the threads - creating clients is not thread-safe
+        clients = {}
+        for entry in self.blueprint.race:
+            if entry['region'] not in clients:
+                clients[entry['region']] = create_ec2_client(entry['region'])
+
+        def launch(entry):
+            ec2_client = clients[entry['region']]
+            launch_spec = race_launch_specification(self.blueprint.launch_specification, entry)
+            self.check_image(ec2_client, launch_spec['ImageId'])
+            logger.debug('Launch spec for %s: %r', entry['region'], launch_spec)
+            reply = self.run_instances(
+                stop_event=won, ec2_client=ec2_client, **self.run_instances_args(task_id, launch_spec, count))
+            if reply is None:
+                logger.info('Launch in %s cancelled', race_entry_name(entry))
+                return
+            with launched_lock:
+                launched.append((entry, ec2_client, reply))
+                won.set()
+
+        with ThreadPoolExecutor(max_workers=len(self.blueprint.race)) as executor:
+            futures = [executor.submit(launch, entry) for entry in self.blueprint.race]
+            wait(futures)
+        if not launched:
+            errors = [f.exception() for f in futures if f.exception()]
+            for e in errors:
+                logger.error('Launch failed: %s', e)
+            raise AppError('Failed to launch spot instances in any of {} race pools'.format(len(futures)))
+        (entry, ec2_client, reply), late = launched[0], launched[1:]
+        logger.info('Race won by %s', race_entry_name(entry))
+        self.ec2_client = ec2_client
+        for late_entry, late_client, late_reply in late:
+            instance_ids = [i['InstanceId'] for i in late_reply['Instances']]
+            logger.info(
+                'Terminating instances launched late in %s: %s',
+                race_entry_name(late_entry), ' '.join(instance_ids))
+            try:
+                late_client.terminate_instances(InstanceIds=instance_ids)
+            except Exception as e:
+                logger.error('Failed to terminate instances %s: %r', ' '.join(instance_ids), e)
+        return entry['region'], reply
+
+    def select_spot_pools(self):
+        '''
+        Return list of spot pools (instance type and AZ or subnet) to try
+        to launch in, the best first - see spot_prices.rank_pools.
+
+        Returns [None] (launch exactly as in launch_specification) if the
+        blueprint does not list any candidate instance types, subnets or AZs.
+        '''
+        bp = self.blueprint
+        if not (bp.instance_types or bp.subnet_ids or bp.availability_zones):
+            return [None]
+        instance_types = bp.instance_types or [bp.launch_specification['InstanceType']]
+        subnet_ids = bp.subnet_ids
+        if not subnet_ids and not bp.availability_zones and bp.launch_specification.get('SubnetId'):
+            subnet_ids = [bp.launch_specification['SubnetId']]
+        if subnet_ids:
+            reply = self.api_cache.call(
+                self.ec2_client, 'describe_subnets', self.image_info_ttl, SubnetIds=sorted(subnet_ids))
+            subnet_azs = {s['SubnetId']: s['AvailabilityZone'] for s in reply['Subnets']}
+            locations = [{'subnet_id': s, 'availability_zone': subnet_azs[s]} for s in subnet_ids]
+        else:
+            locations = [{'availability_zone': az} for az in bp.availability_zones]
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            history_future = executor.submit(fetch_price_history, self.ec2_client, instance_types)
+            info_future = executor.submit(
+                fetch_instance_type_info, self.api_cache, self.ec2_client, instance_types)
+        history, type_info = history_future.result(), info_future.result()
+        if not locations:
+            # any AZ of the region
+            azs = sorted({az for t, az in history})
+            locations = [{'availability_zone': az} for az in azs]
+        pools = [dict(loc, instance_type=t) for t in instance_types for loc in locations]
+        ranked = rank_pools(pools, history, type_info, rank_by=bp.rank_by, max_price=bp.spot_price)
+        if not ranked:
+            raise AppError('No spot pool with price lower than {} found'.format(bp.spot_price))
+        for pool in ranked:
+            logger.info(
+                'Spot pool %s %s: price %.4f, per %s %.4f, volatility %.2f',
+                pool['instance_type'], pool.get('subnet_id') or pool['availability_zone'],
+                pool['price'], bp.rank_by, pool['unit_price'], pool['volatility'])
+        return ranked
+
+    def run_instances(self, pools=(None, ), stop_event=None, ec2_client=None, **kwargs):
+        '''
+        Call EC2 run_instances in the first spot pool that has capacity;
+        retry while there is no spot capacity in any pool, like the spot
+        request would wait to be fulfilled.
+
+        Returns None if stop_event gets set before the launch succeeds.
+        '''
+        ec2_client = ec2_client or self.ec2_client
+        start_mt = monotime()
+        while True:
+            for pool in pools:
+                if stop_event is not None and stop_event.is_set():
+                    return None
+                try:
+                    if pool is None:
+                        return ec2_client.run_instances(**kwargs)
+                    logger.info('Launching %s in %s', pool['instance_type'], pool['availability_zone'])
+                    return ec2_client.run_instances(**apply_pool(kwargs, pool))
+                except ClientError as e:
+                    code = e.response['Error']['Code']
+                    if code not in ('InsufficientInstanceCapacity', 'SpotMaxPriceTooLow'):
+                        raise AppError('Failed to launch spot instances: {}'.format(e)) from e
+                    logger.info('No spot capacity available (%s)', e)
+            if monotime() - start_mt > self.capacity_wait_timeout:
+                raise AppError('Failed to launch spot instances: no spot capacity available')
+            logger.info('No spot capacity available, retrying...')
+            if stop_event is None:
+                sleep(15)
+            elif stop_event.wait(15):
+                return None
+
+
+class RunSpotInstances:
+    '''
+    Runs the blueprint on blueprint.count instances concurrently.
+
+    With count 1 this just delegates to a single RunSpotInstance.
+    '''
+
+    def __init__(self, state, blueprint, temp_dir):
+        self.state = state
+        self.blueprint = blueprint
+        self.temp_dir = temp_dir
+        self.ec2_client = state_ec2_client(state, blueprint)
+        self.api_cache = ApiCache()
+        self._runs = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for r in self._runs or []:
+            r.close()
+
+    def runs(self):
+        '''
+        Return list of RunSpotInstance objects, one per instance.
+        '''
+        if self._runs is None:
+            single = self.blueprint.count == 1 or self.state.get('task_id')
+            if single and not self.state.get('instances'):
+                self._runs = [RunSpotInstance(
+                    state=self.state, blueprint=self.blueprint, temp_dir=self.temp_dir,
+                    ec2_client=self.ec2_client, api_cache=self.api_cache)]
+            else:
+                if not self.state.get('instances'):
+                    RunSpotInstance(
+                        state=self.state, blueprint=self.blueprint, temp_dir=self.temp_dir,
+                        ec2_client=self.ec2_client, api_cache=self.api_cache).launch_spot_instances()
+                    self.ec2_client = state_ec2_client(self.state, self.blueprint, self.ec2_client)
+                self._runs = []
+                for n in range(len(self.state['instances'])):
+                    instance_temp_dir = self.temp_dir / 'instance-{}'.format(n)
+                    instance_temp_dir.mkdir(exist_ok=True)
+                    self._runs.append(RunSpotInstance(
+                        state=InstanceState(self.state, n), blueprint=self.blueprint,
+                        temp_dir=instance_temp_dir, ec2_client=self.ec2_client, instance_index=n,
+                        api_cache=self.api_cache))
+        return self._runs
+
+    def download(self, paths, dest_dir, instance_index=None):
+        '''
+        Download remote paths from all instances (or only the one with given
+        index) concurrently - see RunSpotInstance.download.
+        '''
+        if not self.state.get('task_id'):
+            raise AppError('No instance launched yet')
+        runs = self.runs()
+        if instance_index is not None:
+            runs = [runs[instance_index]]
+
+        def download(r):
+            r.ensure_instance()
+            r.prepare_instance()
+            r.download(paths, dest_dir)
+
+        run_parallel(self.blueprint.max_workers, [partial(download, r) for r in runs])
+
+    def run_spot_instance(self):
+        runs = self.runs()
+        if len(runs) == 1:
+            runs[0].run_spot_instance()
+            return
+        set_stage(self.state, 'running')
+        try:
+            run_parallel(self.blueprint.max_workers, [r.run_spot_instance for r in runs])
+        except BaseException:
+            set_stage(self.state, 'failed')
+            raise
+        set_stage(self.state, 'finished')
+
+
+# State keys related to one particular EC2 instance; these are cleared
+# when the instance is replaced after interruption
+instance_state_keys = [
+    'instance_id', 'spot_instance_request_id', 'tags_created', 'instance_info', 'instance_ok',
+    'instance_host_keys', 'uploaded_manifest', 'uploaded_data_sha1', 'remote_codecs', 'public_ip',
+    'leased_from_pool', 'released_to_pool', 'setup_done',
+]
+
+
+def state_ec2_client(state, blueprint, current_client=None):
+    '''
+    Return EC2 client for the region the task was launched in (it can differ
+    from blueprint.region_name in race mode). Reuse current_client if it is
+    for the same region.
+    '''
+    region_name = state.get('region') or blueprint.region_name
+    if current_client is not None and current_client.meta.region_name == region_name:
+        return current_client
+    return create_ec2_client(region_name)
+
+
+def create_ec2_client(region_name):
+    return timings.instrument_client(boto3.client('ec2', region_name=region_name))
+
+
+def race_launch_specification(launch_specification, entry):
+    '''
+    Return launch specification for one race pool (item of blueprint race list
+    with keys region, image_id and optionally availability_zone, subnet_id
+    and launch_specification with any other overrides).
+    '''
+    launch_spec = dict(launch_specification)
+    if entry.get('image_id'):
+        launch_spec['ImageId'] = entry['image_id']
+    launch_spec.update(entry.get('launch_specification') or {})
+    if entry.get('subnet_id'):
+        launch_spec['SubnetId'] = entry['subnet_id']
+    if entry.get('availability_zone'):
+        launch_spec['Placement'] = dict(
+            launch_spec.get('Placement') or {},
+            AvailabilityZone=entry['availability_zone'])
+    return launch_spec
+
+
+def race_entry_name(entry):
+    return entry.get('availability_zone') or entry.get('subnet_id') or entry['region']
+
+
+def set_stage(state, stage):
+    '''
+    Save task lifecycle stage: launched, ready, running, finished or failed.
+    '''
+    if state.get('stage') != stage:
+        logger.debug('Task stage: %s', stage)
+        state['stage'] = stage
+
+
+def run_parallel(max_workers, functions):
+    '''
+    Call functions using pool of max_workers threads.
+    Raise AppError if any of them fails, after all of them finish.
+    '''
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(f) for f in functions]
+        wait(futures)
+    errors = [f.exception() for f in futures if f.exception()]
+    for e in errors:
+        logger.error('Failed: %s', e)
+    if errors:
+        raise AppError('{} of {} parallel tasks failed'.format(len(errors), len(futures)))
+
+
+# Exit code of the remote upload script signalling that remote data do not
+# match the manifest stored in state file
+remote_manifest_mismatch = 75
+
+upload_script_template = '''\
+set -e
+mkdir -p uploaded
+cd uploaded
+expected_sha1='{expected_sha1}'
+if [ -n "$expected_sha1" ]; then
+    actual_sha1=$(sha1sum < {meta}/manifest 2>/dev/null | cut -c1-40) || true
+    [ "$actual_sha1" = "$expected_sha1" ] || exit {mismatch}
+fi
+{tar_extract}
+xargs -0 rm -f -- < {meta}/deleted
+'''
+
+
+def task_tag_specifications(task_id):
+    task_tags = [
+        {'Key': 'TaskId', 'Value': task_id},
+        {'Key': 'CreatedBy', 'Value': __name__},
+    ]
+    name_tag = {'Key': 'Name', 'Value': task_id}
+    return [
+        {'ResourceType': 'instance', 'Tags': [name_tag] + task_tags},
+        {'ResourceType': 'volume', 'Tags': task_tags},
+        {'ResourceType': 'spot-instances-request', 'Tags': [name_tag] + task_tags},
+    ]
+
+
+def run_instances_launch_args(launch_specification):
+    '''
+    Convert launch specification (in the format used by request_spot_instances)
+    to arguments of run_instances.
+    '''
+    args = dict(launch_specification)
+    args.pop('AddressingType', None)
+    if args.get('UserData'):
+        # request_spot_instances expects base64 encoded user data, boto3 encodes it for run_instances
+        args['UserData'] = b64decode(args['UserData']).decode()
+    return args
 
 
 def generate_task_id(task_id_template):
@@ -285,6 +1317,96 @@ def generate_task_id(task_id_template):
     return s
 
 
+def run_process(cmd, input=None, output_prefix=None, processes=None):
+    '''
+    Run command and return its exit code.
+
+    Parameter input can be bytes or a function that writes to the process stdin.
+    If output_prefix is given, stdout and stderr of the process are printed
+    line by line with this prefix. If processes (set) is given, the process
+    is in it while it runs, so that other threads can kill it.
+    '''
+    if input is not None:
+        stdin = subprocess.PIPE
+    elif output_prefix is not None:
+        # do not let concurrently running processes read from our terminal
+        stdin = subprocess.DEVNULL
+    else:
+        stdin = None
+    if output_prefix is not None:
+        stdout, stderr = subprocess.PIPE, subprocess.STDOUT
+    else:
+        stdout, stderr = None, None
+    with subprocess.Popen(cmd, stdin=stdin, stdout=stdout, stderr=stderr) as p:
+        if processes is not None:
+            processes.add(p)
+        try:
+            return _communicate(p, cmd, input, output_prefix)
+        finally:
+            if processes is not None:
+                processes.discard(p)
+
+
+def _communicate(p, cmd, input, output_prefix):
+    output_thread = None
+    if output_prefix is not None:
+        output_thread = Thread(target=print_prefixed_lines, args=(p.stdout, output_prefix))
+        output_thread.start()
+    if input is not None:
+        try:
+            if callable(input):
+                input(p.stdin)
+            else:
+                p.stdin.write(input)
+        except BrokenPipeError:
+            # the command has exited without reading all input; its exit code tells more
+            logger.debug('Command %s stopped reading its input', cmd[0])
+        try:
+            p.stdin.close()
+        except BrokenPipeError:
+            pass
+    returncode = p.wait()
+    if output_thread:
+        output_thread.join()
+    return returncode
+
+
+_output_lock = Lock()
+
+
+def print_prefixed_lines(f, prefix):
+    prefix = prefix.encode()
+    for line in f:
+        if not line.endswith(b'\n'):
+            line += b'\n'
+        with _output_lock:
+            sys.stdout.buffer.write(prefix + line)
+            sys.stdout.buffer.flush()
+
+
+def wait_for_ssh_port(host, port=22, timeout=300):
+    '''
+    Wait until SSH server on host sends its identification string.
+    Return True on success, False on timeout.
+    '''
+    deadline = monotime() + timeout
+    delay = 0.5
+    while True:
+        try:
+            with socket.create_connection((host, port), timeout=5) as sock:
+                sock.settimeout(5)
+                if sock.recv(4).startswith(b'SSH-'):
+                    return True
+        except OSError as e:
+            logger.debug('SSH port %s:%s not ready: %r', host, port, e)
+        remaining = deadline - monotime()
+        if remaining <= 0:
+            return False
+        sleep(min(delay, remaining))
+        # short delays at first - sshd usually starts soon after instance is running
+        delay = min(delay * 1.5, 5)
+
+
 def wait_for_sir_fullfilled(ec2_client, sir_id):
     logger.info('Waiting for spot_instance_request_fulfilled %s...', sir_id)
     waiter = ec2_client.get_waiter('spot_instance_request_fulfilled')
@@ -1,6 +1,7 @@
 import logging
 from pathlib import Path
 from pytest import fixture
+import yaml
 
 
 @fixture
@@ -12,3 +13,113 @@ def temp_dir(tmpdir):
 def project_dir():
     here = Path(__file__).parent
     return here.parent.resolve()
+
+
+@fixture(autouse=True)
+def cache_dir(tmpdir, monkeypatch):
+    p = Path(str(tmpdir)) / 'spot_runner_cache'
+    monkeypatch.setenv('SPOT_RUNNER_CACHE_DIR', str(p))
+    return p
+
+
+@fixture
+def make_blueprint(temp_dir):
+    '''
+    Return function that writes blueprint file with given settings
+    (added to minimal valid ones) and loads it.
+    '''
+    from spot_runner.blueprint import Blueprint
+
+    def make_blueprint(**settings):
+        d = {
+            'region': 'eu-west-1',
+            'task_id_template': 'test-{date}',
+            'spot_price': '0.5',
+            'remote_command': ['true'],
+            'launch_specification': {'ImageId': 'ami-1', 'KeyName': 'test', 'InstanceType': 'm5.large'},
+        }
+        d.update(settings)
+        (temp_dir / 'test.pem').write_text('key')
+        bp_path = temp_dir / 'blueprint.yaml'
+        bp_path.write_text(yaml.safe_dump({'spot_runner_blueprint': d}))
+        return Blueprint(bp_path, use_cache=False)
+
+    return make_blueprint
+
+
+@fixture
+def make_run(temp_dir):
+    '''
+    Return function creating RunSpotInstance with mocked EC2 client and API cache.
+    '''
+    from unittest.mock import MagicMock
+    from spot_runner.workflow import RunSpotInstance
+
+    def make_run(state, blueprint, running=False, **kwargs):
+        '''
+        With running=True the task is set up as already running on instance i-1.
+        '''
+        ec2_client = MagicMock()
+        ec2_client.meta.region_name = blueprint.region_name
+        ec2_client.run_instances.return_value = {'Instances': [{'InstanceId': 'i-1'}, {'InstanceId': 'i-2'}]}
+        api_cache = MagicMock()
+        api_cache.get.return_value = None
+        api_cache.call.return_value = {'Images': [{'OwnerId': '123'}]}
+        if running:
+            state['task_id'] = 'task1'
+            state['instance_id'] = 'i-1'
+            state['instance_ok'] = True
+            state['instance_host_keys'] = ['ssh-ed25519 AAAA']
+            ec2_client.describe_instances.return_value = {'Reservations': [{'ReservationId': 'r-1', 'Instances': [{
+                'InstanceId': 'i-1',
+                'InstanceLifecycle': 'spot',
+                'State': {'Name': 'running'},
+                'PublicIpAddress': '10.0.0.1',
+                'PublicDnsName': 'host1',
+            }]}]}
+        return RunSpotInstance(state, blueprint, temp_dir, ec2_client=ec2_client, api_cache=api_cache, **kwargs)
+
+    return make_run
+
+
+fake_ssh_template = '''\
+#!{python}
+# Logs its arguments and runs the remote command by sh in directory {home}
+import json, os, sys
+args = sys.argv[1:]
+with open({log!r}, 'a') as f:
+    f.write(json.dumps(args) + '\\n')
+i = 0
+while i < len(args) and args[i].startswith('-'):
+    i += 2 if args[i] in ('-i', '-l', '-o', '-S', '-O', '-p') else 1
+remote_command = args[i + 1:]
+if remote_command:
+    os.chdir({home!r})
+    os.execvp('sh', ['sh', '-c', ' '.join(remote_command)])
+'''
+
+
+@fixture
+def fake_ssh(temp_dir, monkeypatch):
+    '''
+    Use fake ssh (see fake_ssh_template) in RunSpotInstance. Returns object
+    with attributes home (directory where remote commands run) and calls
+    (function returning list of argument lists of ssh calls so far).
+    '''
+    import json
+    import sys
+    from types import SimpleNamespace
+    home = temp_dir / 'remote_home'
+    home.mkdir()
+    log_path = temp_dir / 'fake_ssh.log'
+    ssh_path = temp_dir / 'fake_ssh'
+    ssh_path.write_text(fake_ssh_template.format(python=sys.executable, home=str(home), log=str(log_path)))
+    ssh_path.chmod(0o755)
+    monkeypatch.setenv('SPOT_RUNNER_SSH', str(ssh_path))
+
+    def calls():
+        if not log_path.exists():
+            return []
+        return [json.loads(line) for line in log_path.read_text().splitlines()]
+
+    return SimpleNamespace(home=home, calls=calls)
@@ -0,0 +1,45 @@
+from spot_runner.api_cache import ApiCache
+
+
+class FakeClient:
+
+    class meta:
+        region_name = 'eu-west-1'
+
+    def __init__(self):
+        self.calls = 0
+
+    def describe_images(self, **kwargs):
+        self.calls += 1
+        return {'Images': [kwargs['ImageIds'][0]], 'ResponseMetadata': {}}
+
+
+def test_api_cache(temp_dir):
+    cache = ApiCache(temp_dir, enabled=True)
+    client = FakeClient()
+    assert cache.call(client, 'describe_images', 60, ImageIds=['ami-1']) == {'Images': ['ami-1']}
+    assert cache.call(client, 'describe_images', 60, ImageIds=['ami-1']) == {'Images': ['ami-1']}
+    assert client.calls == 1
+    assert cache.call(client, 'describe_images', 60, ImageIds=['ami-2']) == {'Images': ['ami-2']}
+    assert client.calls == 2
+    # expired
+    assert cache.call(client, 'describe_images', -1, ImageIds=['ami-1']) == {'Images': ['ami-1']}
+    assert client.calls == 3
+
+
+def test_api_cache_invalidate(temp_dir):
+    cache = ApiCache(temp_dir, enabled=True)
+    client = FakeClient()
+    cache.call(client, 'describe_images', 60, scope='i-1', ImageIds=['ami-1'])
+    cache.call(client, 'describe_images', 60, scope='i-2', ImageIds=['ami-2'])
+    cache.invalidate('i-1')
+    assert cache.get(client, 'describe_images', 60, scope='i-1', ImageIds=['ami-1']) is None
+    assert cache.get(client, 'describe_images', 60, scope='i-2', ImageIds=['ami-2']) == {'Images': ['ami-2']}
+
+
+def test_api_cache_disabled(temp_dir):
+    cache = ApiCache(temp_dir, enabled=False)
+    client = FakeClient()
+    cache.call(client, 'describe_images', 60, ImageIds=['ami-1'])
+    cache.call(client, 'describe_images', 60, ImageIds=['ami-1'])
+    assert client.calls == 2
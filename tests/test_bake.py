@@ -0,0 +1,109 @@
+from unittest.mock import MagicMock
+
+from pytest import raises
+
+from spot_runner.bake import bake_hash, bake_key, find_baked_image, gc_baked_images, image_tag_specifications
+from spot_runner.blueprint import Blueprint
+from spot_runner.errors import AppError
+from spot_runner.state import open_state_file
+
+
+def baked_image(image_id, date, snapshot_id):
+    return {
+        'ImageId': image_id,
+        'CreationDate': date,
+        'BlockDeviceMappings': [{'DeviceName': '/dev/xvda', 'Ebs': {'SnapshotId': snapshot_id}}],
+    }
+
+
+def test_bake_hash():
+    spec = {'ImageId': 'ami-1', 'InstanceType': 'm5.large'}
+    h = bake_hash('eu-west-1', spec, 'abc', ['bash', 'setup.sh'])
+    assert h == bake_hash('eu-west-1', dict(spec), 'abc', ['bash', 'setup.sh'])
+    assert h != bake_hash('eu-west-1', dict(spec, ImageId='ami-2'), 'abc', ['bash', 'setup.sh'])
+    assert h != bake_hash('eu-west-1', spec, 'abd', ['bash', 'setup.sh'])
+    assert h != bake_hash('eu-west-1', spec, 'abc', ['bash', 'setup2.sh'])
+
+
+def test_image_tag_specifications():
+    specs = image_tag_specifications('h', 'k', 'task1')
+    assert [s['ResourceType'] for s in specs] == ['image', 'snapshot']
+    assert {'Key': 'SpotRunnerBake', 'Value': 'h'} in specs[1]['Tags']
+
+
+def test_find_baked_image():
+    client = MagicMock()
+    client.describe_images.return_value = {'Images': [
+        baked_image('ami-1', '2026-01-01T00:00:00.000Z', 'snap-1'),
+        baked_image('ami-2', '2026-02-01T00:00:00.000Z', 'snap-2'),
+    ]}
+    assert find_baked_image(client, 'h') == 'ami-2'
+    kwargs = client.describe_images.call_args[1]
+    assert kwargs['Owners'] == ['self']
+    assert {'Name': 'tag:SpotRunnerBake', 'Values': ['h']} in kwargs['Filters']
+    client.describe_images.return_value = {'Images': []}
+    assert find_baked_image(client, 'h') is None
+
+
+def test_bake_key_is_per_blueprint(project_dir, make_blueprint):
+    hello = Blueprint(project_dir / 'examples/hello/blueprint.yaml')
+    parametrized = Blueprint(project_dir / 'examples/hello_parametrized/blueprint.yaml')
+    assert hello.task_id_template == parametrized.task_id_template
+    assert bake_key(hello.region_name, hello.bake_name) != bake_key(parametrized.region_name, parametrized.bake_name)
+    assert make_blueprint(bake_name='hello').bake_name == 'hello'
+
+
+def test_gc_baked_images():
+    client = MagicMock()
+    client.describe_images.return_value = {'Images': [
+        baked_image('ami-1', '2026-01-01T00:00:00.000Z', 'snap-1'),
+        baked_image('ami-3', '2026-03-01T00:00:00.000Z', 'snap-3'),
+        baked_image('ami-2', '2026-02-01T00:00:00.000Z', 'snap-2'),
+    ]}
+    assert gc_baked_images(client, 'k', keep=2) == ['ami-1']
+    client.deregister_image.assert_called_once_with(ImageId='ami-1')
+    client.delete_snapshot.assert_called_once_with(SnapshotId='snap-1')
+
+
+def test_bake_launches_one_instance_and_terminates_it_on_failure(temp_dir, make_blueprint, make_run):
+    bp = make_blueprint(count=2, setup_command=['true'])
+    with open_state_file(temp_dir / 'state.yaml') as state:
+        r = make_run(state, bp)
+        r.prepare_instance = MagicMock(side_effect=AppError('ssh failed'))
+        with raises(AppError):
+            r.bake(force=True)
+        assert r.ec2_client.run_instances.call_args[1]['MinCount'] == 1
+        r.ec2_client.terminate_instances.assert_called_once_with(InstanceIds=['i-1'])
+        assert state['stage'] == 'failed'
+
+
+def test_bake_launch_failure(temp_dir, make_blueprint, make_run):
+    bp = make_blueprint(setup_command=['true'])
+    with open_state_file(temp_dir / 'state.yaml') as state:
+        r = make_run(state, bp)
+        r.ec2_client.run_instances.side_effect = AppError('no capacity')
+        with raises(AppError):
+            r.bake(force=True)
+        assert not r.ec2_client.terminate_instances.called
+
+
+def test_bake_hash_is_computed_once(temp_dir, make_blueprint, make_run):
+    (temp_dir / 'data.txt').write_text('hello')
+    bp = make_blueprint(setup_command=['true'], upload=['data.txt'])
+    with open_state_file(temp_dir / 'state.yaml') as state:
+        r = make_run(state, bp)
+        r.static_upload_items = MagicMock(wraps=r.static_upload_items)
+        assert r.bake_hash() == r.bake_hash()
+        assert r.static_upload_items.call_count == 1
+
+
+def test_launch_from_baked_image_checks_source_image_owner(temp_dir, make_blueprint, make_run):
+    bp = make_blueprint(setup_command=['true'], ami_owner_id_whitelist=['123'])
+    with open_state_file(temp_dir / 'state.yaml') as state:
+        r = make_run(state, bp)
+        r.ec2_client.describe_images.return_value = {'Images': [
+            baked_image('ami-baked', '2026-01-01T00:00:00.000Z', 'snap-1')]}
+        r.launch_spot_instances()
+        assert r.api_cache.call.call_args[1]['ImageIds'] == ['ami-1']
+        assert r.ec2_client.run_instances.call_args[1]['ImageId'] == 'ami-baked'
+        assert state['setup_done'] is True
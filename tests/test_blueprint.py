@@ -1,6 +1,62 @@
-from spot_runner.blueprint import Blueprint
+from textwrap import dedent
+
+from pytest import raises
+
+from spot_runner.blueprint import Blueprint, load_resolved_blueprint
+from spot_runner.errors import AppError
 
 
 def test_load_example_bluperint(project_dir):
     assert Blueprint(project_dir / 'examples/hello/blueprint.yaml')
     assert Blueprint(project_dir / 'examples/hello_parametrized/blueprint.yaml')
+    assert Blueprint(project_dir / 'examples/hello_sweep/blueprint.yaml')
+
+
+def test_load_resolved_blueprint_cache(temp_dir, cache_dir):
+    bp_path = temp_dir / 'blueprint.yaml'
+    bp_path.write_text(dedent('''\
+        #!jinja
+        spot_runner_blueprint:
+            region: {{ read_file('region.txt') }}
+            launch_specification:
+                KeyName: test
+    '''))
+    (temp_dir / 'region.txt').write_text('eu-west-1')
+    resolved = load_resolved_blueprint(bp_path, cache_dir)
+    assert resolved['blueprint']['region'] == 'eu-west-1'
+    assert resolved['ssh_private_key_path'] is None
+    assert len(list(cache_dir.iterdir())) == 1
+    assert load_resolved_blueprint(bp_path, cache_dir) == resolved
+    # change of an included file
+    (temp_dir / 'region.txt').write_text('us-east-1')
+    resolved = load_resolved_blueprint(bp_path, cache_dir)
+    assert resolved['blueprint']['region'] == 'us-east-1'
+    # SSH key file that did not exist before
+    (temp_dir / 'test.pem').write_text('key')
+    resolved = load_resolved_blueprint(bp_path, cache_dir)
+    assert resolved['ssh_private_key_path'] == temp_dir / 'test.pem'
+
+
+def test_load_resolved_blueprint_cache_from_other_directory(temp_dir, cache_dir, monkeypatch):
+    (temp_dir / 'sub').mkdir()
+    (temp_dir / 'sub/blueprint.yaml').write_text(dedent('''\
+        spot_runner_blueprint:
+            launch_specification:
+                KeyName: mykey
+    '''))
+    (temp_dir / 'sub/mykey.pem').write_text('key')
+    monkeypatch.chdir(str(temp_dir))
+    resolved = load_resolved_blueprint('sub/blueprint.yaml', cache_dir)
+    assert resolved['ssh_private_key_path'].is_absolute()
+    monkeypatch.chdir(str(temp_dir / 'sub'))
+    assert load_resolved_blueprint('blueprint.yaml', cache_dir) == resolved
+    assert len(list(cache_dir.iterdir())) == 1
+    assert resolved['ssh_private_key_path'].read_text() == 'key'
+
+
+def test_availability_zones_with_subnet(make_blueprint):
+    spec = {'ImageId': 'ami-1', 'KeyName': 'test', 'InstanceType': 'm5.large'}
+    assert make_blueprint(availability_zones=['eu-west-1a'], launch_specification=spec)
+    for subnet_spec in {'SubnetId': 'subnet-1'}, {'NetworkInterfaces': [{'SubnetId': 'subnet-1'}]}:
+        with raises(AppError, match='availability_zones can not be used with SubnetId'):
+            make_blueprint(availability_zones=['eu-west-1a'], launch_specification=dict(spec, **subnet_spec))
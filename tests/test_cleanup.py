@@ -0,0 +1,92 @@
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock
+
+from botocore.exceptions import ClientError
+
+from spot_runner import cleanup
+from spot_runner.cleanup import cleanup_resources, find_task_resources
+
+
+tags = [{'Key': 'TaskId', 'Value': 'task1'}, {'Key': 'CreatedBy', 'Value': 'spot_runner.workflow'}]
+
+
+def ec2_client(spot_requests=(), instances=(), volumes=()):
+    pages = {
+        'describe_spot_instance_requests': [{'SpotInstanceRequests': list(spot_requests)}],
+        'describe_instances': [{'Reservations': [{'Instances': list(instances)}]}],
+        'describe_volumes': [{'Volumes': list(volumes)}],
+    }
+    client = MagicMock()
+    client.meta.region_name = 'eu-west-1'
+    paginators = {}
+
+    def get_paginator(name):
+        paginators[name] = MagicMock()
+        paginators[name].paginate.return_value = pages[name]
+        return paginators[name]
+
+    client.get_paginator.side_effect = get_paginator
+    client.paginators = paginators
+    return client
+
+
+def created(hours_ago):
+    return datetime(2026, 1, 2, 12, 0, tzinfo=timezone.utc) - timedelta(hours=hours_ago)
+
+
+def test_find_task_resources():
+    client = ec2_client(
+        spot_requests=[{'SpotInstanceRequestId': 'sir-1', 'CreateTime': created(5), 'Tags': tags}],
+        instances=[
+            {'InstanceId': 'i-1', 'LaunchTime': created(5), 'Tags': tags},
+            {'InstanceId': 'i-2', 'LaunchTime': created(1), 'Tags': tags},
+        ],
+        volumes=[{'VolumeId': 'vol-1', 'CreateTime': created(5), 'Tags': tags}])
+    resources = find_task_resources(
+        client, task_id='task*', older_than=timedelta(hours=2), now=created(0))
+    assert [(r['type'], r['id']) for r in resources] == [
+        ('spot_request', 'sir-1'), ('instance', 'i-1'), ('volume', 'vol-1')]
+    assert resources[0] == {
+        'region': 'eu-west-1',
+        'type': 'spot_request',
+        'id': 'sir-1',
+        'task_id': 'task1',
+        'created': '2026-01-02T07:00:00Z',
+    }
+    filters = client.paginators['describe_instances'].paginate.call_args[1]['Filters']
+    assert {'Name': 'tag:TaskId', 'Values': ['task*']} in filters
+    assert {'Name': 'tag:CreatedBy', 'Values': ['spot_runner.*']} in filters
+
+
+def test_cleanup_resources_batches(monkeypatch):
+    monkeypatch.setattr(cleanup, 'batch_size', 2)
+    client = MagicMock()
+    resources = [{'type': 'instance', 'id': 'i-{}'.format(n)} for n in range(5)]
+    resources.append({'type': 'spot_request', 'id': 'sir-1'})
+    assert cleanup_resources(client, resources) == []
+    assert [c[1]['InstanceIds'] for c in client.terminate_instances.call_args_list] == [
+        ['i-0', 'i-1'], ['i-2', 'i-3'], ['i-4']]
+    client.cancel_spot_instance_requests.assert_called_once_with(SpotInstanceRequestIds=['sir-1'])
+    assert not client.describe_volumes.called
+
+
+def test_cleanup_resources_deletes_volumes():
+    client = MagicMock()
+
+    def delete_volume(VolumeId):
+        if VolumeId == 'vol-2':
+            raise ClientError({'Error': {'Code': 'VolumeInUse', 'Message': 'in use'}}, 'DeleteVolume')
+
+    client.delete_volume.side_effect = delete_volume
+    client.describe_volumes.return_value = {'Volumes': [{'VolumeId': 'vol-3'}]}
+    resources = [
+        {'type': 'instance', 'id': 'i-1'},
+        {'type': 'volume', 'id': 'vol-1'},
+        {'type': 'volume', 'id': 'vol-2'},
+    ]
+    assert cleanup_resources(client, resources, wait=True) == ['vol-2']
+    filters = client.describe_volumes.call_args[1]['Filters']
+    assert {'Name': 'attachment.instance-id', 'Values': ['i-1']} in filters
+    client.get_waiter.assert_any_call('instance_terminated')
+    deleted = sorted(c[1]['VolumeId'] for c in client.delete_volume.call_args_list)
+    assert deleted == ['vol-1', 'vol-2', 'vol-3']
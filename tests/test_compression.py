@@ -0,0 +1,55 @@
+import os
+import pytest
+import subprocess
+
+from spot_runner.compression import \
+    choose_codec, compressor, estimate_compressibility, local_codecs, parse_remote_codecs, remote_codecs_script, \
+    remote_tar_command
+from spot_runner.upload import write_tar
+
+
+def test_estimate_compressibility(temp_dir):
+    (temp_dir / 'text.txt').write_text('hello world\n' * 10000)
+    (temp_dir / 'random.bin').write_bytes(os.urandom(100000))
+    (temp_dir / 'data.gz').write_bytes(b'\0' * 100000)
+    assert estimate_compressibility({'text.txt': temp_dir / 'text.txt'}) < 0.1
+    assert estimate_compressibility({'random.bin': temp_dir / 'random.bin'}) > 0.95
+    assert estimate_compressibility({'data.gz': temp_dir / 'data.gz'}) == 1
+    assert estimate_compressibility({'a': b'a' * 1000}) < 0.1
+    assert estimate_compressibility({}) == 1
+
+
+def test_choose_codec():
+    assert choose_codec(['zstd', 'lz4', 'gzip']) == 'zstd'
+    assert choose_codec(['gzip', 'lz4', 'zstd']) == 'zstd'
+    assert choose_codec(['gzip', 'lz4']) == 'lz4'
+    assert choose_codec(['lz4', 'gzip'], ratio=0.3) == 'lz4'
+    assert choose_codec(['zstd', 'lz4', 'gzip'], ratio=0.98) == 'none'
+    assert choose_codec(['zstd', 'lz4', 'gzip'], ratio=0.3, throughput=500 * 2**20) == 'lz4'
+    assert choose_codec(['gzip']) == 'gzip'
+    assert choose_codec([]) == 'ssh'
+
+
+def test_codec_order():
+    assert 'for c in zstd lz4 gzip;' in remote_codecs_script
+
+
+def test_parse_remote_codecs():
+    assert parse_remote_codecs('zstd\ngzip\n') == ['zstd', 'gzip']
+
+
+@pytest.mark.parametrize('codec', ['zstd', 'lz4', 'gzip', 'none'])
+def test_compressor_roundtrip(temp_dir, codec):
+    if codec != 'none' and codec not in local_codecs():
+        pytest.skip('{} not installed'.format(codec))
+    (temp_dir / 'src.txt').write_text('hello\n' * 1000)
+    dest_dir = temp_dir / 'dest'
+    dest_dir.mkdir()
+    cmd = ['sh', '-c', remote_tar_command(codec, ['-x', '-f', '-'])]
+    with subprocess.Popen(cmd, cwd=str(dest_dir), stdin=subprocess.PIPE) as p:
+        with compressor(codec, p.stdin) as f:
+            write_tar(f, [('a/src.txt', temp_dir / 'src.txt'), ('b.txt', b'bytes')])
+        p.stdin.close()
+    assert p.returncode == 0
+    assert (dest_dir / 'a/src.txt').read_text() == 'hello\n' * 1000
+    assert (dest_dir / 'b.txt').read_text() == 'bytes'
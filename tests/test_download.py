@@ -0,0 +1,90 @@
+from io import BytesIO
+import pytest
+import subprocess
+import tarfile
+
+from spot_runner.compression import decompress_command, local_codecs
+from spot_runner.download import CountingReader, download_script, extract_tar_stream
+
+
+@pytest.mark.parametrize('codec', ['zstd', 'lz4', 'gzip', 'none'])
+def test_download_script_and_extract(temp_dir, codec):
+    if codec != 'none' and codec not in local_codecs():
+        pytest.skip('{} not installed'.format(codec))
+    remote_dir = temp_dir / 'remote'
+    (remote_dir / 'results' / 'sub').mkdir(parents=True)
+    (remote_dir / 'results' / 'a.txt').write_text('hello\n')
+    (remote_dir / 'results' / 'sub' / 'b.txt').write_text('world\n' * 1000)
+    (remote_dir / 'run.log').write_text('log\n')
+    dest_dir = temp_dir / 'dest'
+    for remote_path in ['results/', 'run.log']:
+        p = subprocess.Popen(
+            ['sh', '-c', download_script(remote_path, codec)], cwd=str(remote_dir), stdout=subprocess.PIPE)
+        if codec == 'none':
+            reader = CountingReader(p.stdout)
+            extract_tar_stream(reader, dest_dir)
+        else:
+            d = subprocess.Popen(decompress_command(codec), stdin=p.stdout, stdout=subprocess.PIPE)
+            reader = CountingReader(d.stdout)
+            extract_tar_stream(reader, dest_dir)
+            d.stdout.close()
+            assert d.wait() == 0
+        p.stdout.close()
+        assert p.wait() == 0
+        assert reader.size > 0
+    assert (dest_dir / 'results' / 'a.txt').read_text() == 'hello\n'
+    assert (dest_dir / 'results' / 'sub' / 'b.txt').read_text() == 'world\n' * 1000
+    assert (dest_dir / 'run.log').read_text() == 'log\n'
+
+
+def test_download_script_missing_path(temp_dir):
+    p = subprocess.run(['sh', '-c', download_script('missing')], cwd=str(temp_dir), stdout=subprocess.PIPE)
+    assert p.returncode != 0
+
+
+def tar_bytes(members):
+    f = BytesIO()
+    with tarfile.open(fileobj=f, mode='w') as tar:
+        for member, data in members:
+            tar.addfile(member, BytesIO(data) if data is not None else None)
+    f.seek(0)
+    return f
+
+
+def link_member(name, linkname, link_type=tarfile.SYMTYPE):
+    member = tarfile.TarInfo(name)
+    member.type = link_type
+    member.linkname = linkname
+    return member
+
+
+def file_member(name, data):
+    member = tarfile.TarInfo(name)
+    member.size = len(data)
+    return member, data
+
+
+@pytest.mark.parametrize('data_filter', [True, False])
+def test_extract_tar_stream_rejects_links_outside(temp_dir, monkeypatch, data_filter):
+    if not data_filter:
+        monkeypatch.delattr(tarfile, 'data_filter', raising=False)
+    elif not hasattr(tarfile, 'data_filter'):
+        pytest.skip('tarfile.data_filter not available')
+    outside = temp_dir / 'outside'
+    outside.mkdir()
+    dest_dir = temp_dir / 'dest'
+    archives = [
+        [(link_member('evil', str(outside)), None), file_member('evil/x', b'x')],
+        [(link_member('evil', '../outside'), None), file_member('evil/x', b'x')],
+        [(link_member('a', 'b'), None), (link_member('b', '..'), None)],
+        [(link_member('evil', '../outside/x', tarfile.LNKTYPE), None)],
+        [file_member('../x', b'x')],
+    ]
+    for members in archives:
+        with pytest.raises(Exception):
+            extract_tar_stream(tar_bytes(members), dest_dir)
+    assert list(outside.iterdir()) == []
+    # links inside dest_dir are fine
+    members = [file_member('sub/a.txt', b'a'), (link_member('link', 'sub'), None), file_member('link/b.txt', b'b')]
+    assert extract_tar_stream(tar_bytes(members), dest_dir) == 3
+    assert (dest_dir / 'sub/b.txt').read_bytes() == b'b'
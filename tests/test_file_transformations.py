@@ -1,3 +1,4 @@
+from pytest import raises
 from textwrap import dedent
 
 from spot_runner.file_transformations import \
@@ -69,3 +70,36 @@ def test_preprocess_file_with_jinja_and_yaml_includes(temp_dir):
     ''')
     result = preprocess_file(temp_dir / 'test.txt', content, {'name': 'sample'})
     assert result == 'foo: bar\n'
+
+
+def test_preprocess_yaml_includes_nested(temp_dir):
+    (temp_dir / 'sub').mkdir()
+    (temp_dir / 'sub/a.yaml').write_text('a:\n    INCLUDE_YAML: b.yaml\n')
+    (temp_dir / 'sub/b.yaml').write_text('b: [1, 2]\n')
+    content = dedent('''\
+        x:
+            INCLUDE_YAML: sub/a.yaml
+        y:
+            INCLUDE_YAML: sub/a.yaml
+    ''')
+    result = preprocess_yaml_includes(temp_dir, content)
+    # included data are dumped in full, without YAML aliases
+    assert result == dedent('''\
+        x:
+          a:
+            b:
+            - 1
+            - 2
+        y:
+          a:
+            b:
+            - 1
+            - 2
+    ''')
+
+
+def test_preprocess_yaml_includes_cycle(temp_dir):
+    (temp_dir / 'a.yaml').write_text('a:\n    INCLUDE_YAML: b.yaml\n')
+    (temp_dir / 'b.yaml').write_text('b:\n    INCLUDE_YAML: a.yaml\n')
+    with raises(Exception, match='Include cycle detected'):
+        preprocess_yaml_includes(temp_dir, 'x:\n    INCLUDE_YAML: a.yaml\n')
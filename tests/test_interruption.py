@@ -0,0 +1,130 @@
+from time import monotonic, sleep
+from unittest.mock import MagicMock
+
+from pytest import raises
+
+from spot_runner.errors import AppError
+from spot_runner.interruption import InterruptionWatcher, is_interrupted_state, parse_instance_action
+from spot_runner.state import open_state_file
+
+
+def test_parse_instance_action():
+    assert parse_instance_action('') is None
+    assert parse_instance_action('<html>404 - Not Found</html>') is None
+    assert parse_instance_action('{"action": "terminate", "time": "2026-01-01T12:00:00Z"}\n') == {
+        'action': 'terminate', 'time': '2026-01-01T12:00:00Z'}
+
+
+def test_is_interrupted_state():
+    assert is_interrupted_state(None)
+    assert not is_interrupted_state({'State': {'Name': 'running'}})
+    assert not is_interrupted_state({
+        'State': {'Name': 'stopped'},
+        'StateReason': {'Code': 'Client.UserInitiatedShutdown'},
+    })
+    assert is_interrupted_state({
+        'State': {'Name': 'shutting-down'},
+        'StateReason': {'Code': 'Server.SpotInstanceTermination'},
+    })
+
+
+def test_interruption_watcher():
+    notices = [None, {'action': 'terminate', 'time': 'soon'}]
+    hook_calls = []
+    watcher = InterruptionWatcher(
+        poll_notice=lambda: notices.pop(0) if notices else None,
+        poll_instance_state=lambda: {'State': {'Name': 'running'}},
+        on_notice=hook_calls.append,
+        interval=0.01, state_interval=0.02)
+    with watcher:
+        for n in range(100):
+            if hook_calls:
+                break
+            sleep(0.01)
+    assert watcher.interrupted
+    assert not watcher.reclaimed
+    assert hook_calls == [{'action': 'terminate', 'time': 'soon'}]
+
+
+def relaunch_run(state, blueprint, make_run, ssh_results):
+    '''
+    Return RunSpotInstance whose remote command fails with the first
+    ssh_results (the instance is reclaimed meanwhile) and returns the rest.
+    '''
+    r = make_run(state, blueprint)
+    r.ec2_client.run_instances.side_effect = [
+        {'Instances': [{'InstanceId': 'i-{}'.format(n)}]} for n in range(1, 5)]
+    r.ec2_client.describe_instances.return_value = {'Reservations': [{'Instances': [{
+        'State': {'Name': 'shutting-down'},
+        'StateReason': {'Code': 'Server.SpotInstanceTermination'},
+    }]}]}
+    r.prepare_instance = MagicMock()
+    r.uploads = []
+    r.upload = lambda: r.uploads.append((state['instance_id'], state.get('uploaded_data_sha1')))
+    r.run_ssh = MagicMock(side_effect=ssh_results)
+    return r
+
+
+def test_relaunch_interrupted_instance(temp_dir, make_blueprint, make_run):
+    with open_state_file(temp_dir / 'state.yaml') as state:
+        r = relaunch_run(state, make_blueprint(max_relaunches=1), make_run, [AppError('ssh failed'), 0])
+        r.run_spot_instance()
+        task_id = state['task_id']
+        assert r.uploads == [('i-1', None), ('i-2', None)]
+        assert [c[1]['env'] for c in r.run_ssh.call_args_list] == [{'RELAUNCH_COUNT': 0}, {'RELAUNCH_COUNT': 1}]
+        assert state['instance_id'] == 'i-2'
+        assert state['task_id'] == task_id
+        assert state['relaunch_count'] == 1
+        assert state['interrupted_instance_ids'] == ['i-1']
+        assert state['stage'] == 'finished'
+        assert r.ec2_client.run_instances.call_args[1]['MinCount'] == 1
+
+
+def test_relaunch_gives_up(temp_dir, make_blueprint, make_run):
+    with open_state_file(temp_dir / 'state.yaml') as state:
+        r = relaunch_run(state, make_blueprint(max_relaunches=1), make_run, [AppError('ssh failed')] * 2)
+        with raises(AppError):
+            r.run_spot_instance()
+        assert r.ec2_client.run_instances.call_count == 2
+        assert state['interrupted_instance_ids'] == ['i-1']
+        assert state['stage'] == 'failed'
+
+
+def test_no_relaunch_when_instance_is_running(temp_dir, make_blueprint, make_run):
+    with open_state_file(temp_dir / 'state.yaml') as state:
+        r = relaunch_run(state, make_blueprint(max_relaunches=1), make_run, [AppError('command failed')])
+        r.ec2_client.describe_instances.return_value = {'Reservations': [{'Instances': [{
+            'State': {'Name': 'running'}}]}]}
+        with raises(AppError):
+            r.run_spot_instance()
+        assert r.ec2_client.run_instances.call_count == 1
+        assert state.get('relaunch_count') is None
+
+
+def test_reclaimed_instance_unblocks_ssh(temp_dir, make_blueprint, make_run, fake_ssh):
+    (fake_ssh.home / 'job.sh').write_text('[ "$RELAUNCH_COUNT" = 0 ] && sleep 60\nexit 0\n')
+    blueprint = make_blueprint(max_relaunches=1, remote_command=['sh', 'job.sh'])
+    with open_state_file(temp_dir / 'state.yaml') as state:
+        r = make_run(state, blueprint, running=True)
+        r.interruption_poll_interval = r.instance_state_poll_interval = 0.05
+        r.ec2_client.run_instances.return_value = {'Instances': [{'InstanceId': 'i-2'}]}
+
+        def describe_instances(InstanceIds, **kwargs):
+            name = 'shutting-down' if InstanceIds == ['i-1'] else 'running'
+            return {'Reservations': [{'Instances': [{
+                'State': {'Name': name},
+                'StateReason': {'Code': 'Server.SpotInstanceTermination'},
+            }]}]}
+
+        r.ec2_client.describe_instances.side_effect = describe_instances
+        r.poll_interruption_notice = lambda: None
+        r.instance_public_ip = lambda: '10.0.0.1'
+        r.instance_host_keys = lambda: ['ssh-ed25519 AAAA']
+        r.prepare_instance = MagicMock()
+        r.upload = MagicMock()
+        t0 = monotonic()
+        r.run_spot_instance()
+        assert monotonic() - t0 < 30
+        assert state['relaunch_count'] == 1
+        assert state['interrupted_instance_ids'] == ['i-1']
+        assert state['stage'] == 'finished'
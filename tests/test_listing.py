@@ -0,0 +1,67 @@
+from datetime import datetime, timezone
+from unittest.mock import MagicMock
+
+from spot_runner.listing import describe_task_instances, format_table, join_local_tasks, list_instances
+
+
+def ec2_client(region_name, instances):
+    client = MagicMock()
+    client.meta.region_name = region_name
+    client.get_paginator.return_value.paginate.return_value = [
+        {'Reservations': [{'Instances': instances}]},
+    ]
+    return client
+
+
+def instance(instance_id, task_id, **kwargs):
+    return dict({
+        'InstanceId': instance_id,
+        'InstanceType': 'm5.large',
+        'InstanceLifecycle': 'spot',
+        'State': {'Name': 'running'},
+        'LaunchTime': datetime(2026, 1, 1, 12, 0, tzinfo=timezone.utc),
+        'PublicIpAddress': '1.2.3.4',
+        'Tags': [{'Key': 'TaskId', 'Value': task_id}, {'Key': 'CreatedBy', 'Value': 'spot_runner.workflow'}],
+    }, **kwargs)
+
+
+def test_describe_task_instances():
+    client = ec2_client('eu-west-1', [instance('i-1', 'task1')])
+    rows = describe_task_instances(client, task_id='task*')
+    assert rows == [{
+        'region': 'eu-west-1',
+        'instance_id': 'i-1',
+        'instance_type': 'm5.large',
+        'state': 'running',
+        'launch_time': '2026-01-01T12:00:00Z',
+        'public_ip': '1.2.3.4',
+        'lifecycle': 'spot',
+        'task_id': 'task1',
+        'pool_idle_until': None,
+    }]
+    filters = client.get_paginator.return_value.paginate.call_args[1]['Filters']
+    assert {'Name': 'tag:TaskId', 'Values': ['task*']} in filters
+    assert any(f['Name'] == 'instance-state-name' for f in filters)
+    describe_task_instances(client, include_terminated=True)
+    filters = client.get_paginator.return_value.paginate.call_args[1]['Filters']
+    assert [f['Name'] for f in filters] == ['tag:CreatedBy']
+
+
+def test_list_instances():
+    failing = ec2_client('ap-south-1', [])
+    failing.get_paginator.return_value.paginate.side_effect = Exception('AuthFailure')
+    clients = {
+        'eu-west-1': ec2_client('eu-west-1', [instance('i-2', 'task2'), instance('i-1', 'task1')]),
+        'ap-south-1': failing,
+        'eu-central-1': ec2_client('eu-central-1', [instance('i-3', 'task3')]),
+    }
+    rows = list_instances(sorted(clients), clients.get)
+    assert [(r['region'], r['instance_id']) for r in rows] == [
+        ('eu-central-1', 'i-3'), ('eu-west-1', 'i-1'), ('eu-west-1', 'i-2')]
+    rows = join_local_tasks(rows, {'i-1': {'stage': 'running', 'state_path': 'state.yaml'}})
+    assert rows[1]['stage'] == 'running'
+    assert rows[0]['stage'] is None
+    table = format_table(rows).splitlines()
+    assert len(table) == 3
+    assert table[1].split() == [
+        'eu-west-1', 'i-1', 'm5.large', 'running', '2026-01-01', '12:00', '1.2.3.4', 'running', 'task1']
@@ -0,0 +1,203 @@
+import hashlib
+import os
+import subprocess
+from time import time
+from unittest.mock import MagicMock
+
+from pytest import mark, raises
+
+from spot_runner.errors import AppError
+from spot_runner.pool import \
+    find_idle_instances, lease_script_template, lease_taken, pool_fingerprint, pool_host_key, release_tags, \
+    terminate_expired_instances
+from spot_runner.state import open_state_file
+from spot_runner.upload import format_manifest, meta_dir_name
+
+
+now = 1700000000
+
+
+def ec2_client_with_instances(instances):
+    client = MagicMock()
+    client.get_paginator.return_value.paginate.return_value = [
+        {'Reservations': [{'Instances': instances}]},
+    ]
+    return client
+
+
+def idle_instance(instance_id, idle_until, fingerprint='fp'):
+    return {
+        'InstanceId': instance_id,
+        'PublicIpAddress': '10.0.0.{}'.format(instance_id[2:]),
+        'Tags': [
+            {'Key': 'SpotRunnerPool', 'Value': fingerprint},
+            {'Key': 'SpotRunnerIdleUntil', 'Value': str(idle_until)},
+            {'Key': 'SpotRunnerHostKey', 'Value': 'ssh-ed25519 AAAA'},
+        ],
+    }
+
+
+def test_pool_fingerprint():
+    spec = {'ImageId': 'ami-1', 'InstanceType': 'm5.large'}
+    fp = pool_fingerprint('eu-west-1', spec, [], 'abc')
+    assert fp == pool_fingerprint('eu-west-1', dict(reversed(list(spec.items()))), [], 'abc')
+    assert fp != pool_fingerprint('eu-west-1', spec, [], 'abd')
+    assert fp != pool_fingerprint('eu-central-1', spec, [], 'abc')
+    assert fp != pool_fingerprint('eu-west-1', dict(spec, InstanceType='c5.large'), [], 'abc')
+
+
+def test_release_tags():
+    host_keys = [
+        'ssh-rsa ' + 'A' * 500 + ' root@host',
+        'ssh-ed25519 AAAA root@host',
+        'ecdsa-sha2-nistp256 BBBB root@host',
+    ]
+    assert pool_host_key(host_keys) == 'ssh-ed25519 AAAA'
+    assert pool_host_key(host_keys[:1]) is None
+    assert release_tags('fp', 600, host_keys, now=now) == [
+        {'Key': 'SpotRunnerPool', 'Value': 'fp'},
+        {'Key': 'SpotRunnerIdleUntil', 'Value': str(now + 600)},
+        {'Key': 'SpotRunnerHostKey', 'Value': 'ssh-ed25519 AAAA'},
+    ]
+
+
+def test_find_idle_instances():
+    client = ec2_client_with_instances([
+        idle_instance('i-1', now + 600),
+        idle_instance('i-2', now + 60),
+        idle_instance('i-3', now + 1200),
+        idle_instance('i-4', now - 10),
+        idle_instance('i-5', now + 1800, fingerprint='other'),
+    ])
+    assert [i['InstanceId'] for i in find_idle_instances(client, 'fp', now=now)] == ['i-3', 'i-1']
+    filters = client.get_paginator.return_value.paginate.call_args[1]['Filters']
+    assert {'Name': 'tag:SpotRunnerPool', 'Values': ['fp']} in filters
+
+
+def test_terminate_expired_instances():
+    client = ec2_client_with_instances([
+        idle_instance('i-1', now + 600),
+        idle_instance('i-2', now - 10),
+    ])
+    assert terminate_expired_instances(client, now=now) == ['i-2']
+    client.terminate_instances.assert_called_once_with(InstanceIds=['i-2'])
+    client = ec2_client_with_instances([idle_instance('i-1', now + 600)])
+    assert terminate_expired_instances(client, now=now) == []
+    assert not client.terminate_instances.called
+
+
+def test_lease_script_is_atomic(temp_dir):
+    # fake sudo, so that the script does not touch shutdown of this machine
+    bin_dir = temp_dir / 'bin'
+    bin_dir.mkdir()
+    (bin_dir / 'sudo').write_text('#!/bin/sh\ntrue\n')
+    (bin_dir / 'sudo').chmod(0o755)
+    home = temp_dir / 'home'
+    (home / 'uploaded' / meta_dir_name).mkdir(parents=True)
+    (home / 'uploaded' / 'data.txt').write_text('data\n')
+    manifest = format_manifest({'data.txt': hashlib.sha1(b'data\n').hexdigest()})
+    (home / 'uploaded' / meta_dir_name / 'manifest').write_text(manifest)
+    script = lease_script_template.format(taken=lease_taken, meta=meta_dir_name)
+    env = dict(os.environ, PATH='{}:{}'.format(bin_dir, os.environ['PATH']))
+
+    def lease():
+        return subprocess.run(['sh', '-c', script], cwd=str(home), env=env, stdout=subprocess.PIPE)
+
+    first, second = lease(), lease()
+    assert (first.returncode, first.stdout) == (0, manifest.encode())
+    assert second.returncode == lease_taken
+    # the previous run modified an uploaded file
+    (home / '.spot_runner_lease').rmdir()
+    (home / 'uploaded' / 'data.txt').write_text('changed\n')
+    third = lease()
+    assert (third.returncode, third.stdout) == (0, b'')
+    assert not (home / 'uploaded').exists()
+
+
+def pool_run(state, make_blueprint, make_run, instances, **settings):
+    r = make_run(state, make_blueprint(pool_idle_ttl=600, **settings))
+    r.ec2_client.get_paginator.return_value.paginate.return_value = [
+        {'Reservations': [{'Instances': instances}]},
+    ]
+    r.run_pool_script = MagicMock()
+    return r
+
+
+def test_lease_pooled_instance(temp_dir, make_blueprint, make_run):
+    with open_state_file(temp_dir / 'state.yaml') as state:
+        r = pool_run(state, make_blueprint, make_run, [])
+        fp = r.pool_fingerprint()
+        r.ec2_client.get_paginator.return_value.paginate.return_value = [{'Reservations': [{'Instances': [
+            idle_instance('i-1', int(time()) + 3600, fingerprint='other'),
+            idle_instance('i-2', int(time()) + 1800, fingerprint=fp),
+            idle_instance('i-3', int(time()) + 1200, fingerprint=fp),
+        ]}]}]
+        # i-2 is leased by another run meanwhile
+        r.run_pool_script.side_effect = [None, 'a' * 40 + '  data.txt\n']
+        assert r.lease_pooled_instance()
+        assert state['instance_id'] == 'i-3'
+        assert state['public_ip'] == '10.0.0.3'
+        assert state['instance_host_keys'] == ['ssh-ed25519 AAAA']
+        assert state['leased_from_pool'] is True
+        assert state['setup_done'] is True
+        assert state['uploaded_manifest'] == {'data.txt': 'a' * 40}
+        assert r.run_pool_script.call_count == 2
+        r.ec2_client.delete_tags.assert_called_once_with(
+            Resources=['i-3'], Tags=[{'Key': 'SpotRunnerPool'}, {'Key': 'SpotRunnerIdleUntil'},
+                                     {'Key': 'SpotRunnerHostKey'}])
+        assert not r.ec2_client.run_instances.called
+
+
+def test_lease_pooled_instance_none_available(temp_dir, make_blueprint, make_run):
+    with open_state_file(temp_dir / 'state.yaml') as state:
+        r = pool_run(state, make_blueprint, make_run, [idle_instance('i-1', int(time()) + 3600, fingerprint='other')])
+        assert not r.lease_pooled_instance()
+        assert not r.run_pool_script.called
+        assert state.get('instance_id') is None
+
+
+def pool_run_with_instance(state, make_blueprint, make_run, **settings):
+    r = pool_run(state, make_blueprint, make_run, [], **settings)
+    state['task_id'] = 'task1'
+    state['instance_id'] = 'i-1'
+    r.ec2_client.describe_instances.return_value = {'Reservations': [{'Instances': [
+        {'State': {'Name': 'running'}}]}]}
+    r.prepare_instance = MagicMock()
+    r.upload = MagicMock()
+    return r
+
+
+def test_finished_run_releases_instance_to_pool(temp_dir, make_blueprint, make_run):
+    with open_state_file(temp_dir / 'state.yaml') as state:
+        r = pool_run_with_instance(state, make_blueprint, make_run)
+        r.run_ssh = MagicMock()
+        r.run_pool_script.return_value = ''
+        r.run_spot_instance()
+        assert state['stage'] == 'finished'
+        assert state['released_to_pool'] is True
+        tags = r.ec2_client.create_tags.call_args[1]['Tags']
+        assert {'Key': 'SpotRunnerPool', 'Value': r.pool_fingerprint()} in tags
+        assert not r.ec2_client.terminate_instances.called
+
+
+def test_failed_release_terminates_instance(temp_dir, make_blueprint, make_run):
+    with open_state_file(temp_dir / 'state.yaml') as state:
+        r = pool_run_with_instance(state, make_blueprint, make_run)
+        r.run_ssh = MagicMock()
+        r.run_pool_script.side_effect = AppError('ssh failed')
+        r.run_spot_instance()
+        assert state.get('released_to_pool') is None
+        r.ec2_client.terminate_instances.assert_called_once_with(InstanceIds=['i-1'])
+
+
+@mark.parametrize('settings', [{}, {'setup_command': ['setup']}])
+def test_failed_run_terminates_instance(temp_dir, make_blueprint, make_run, settings):
+    with open_state_file(temp_dir / 'state.yaml') as state:
+        r = pool_run_with_instance(state, make_blueprint, make_run, **settings)
+        r.run_ssh = MagicMock(side_effect=AppError('command failed'))
+        with raises(AppError):
+            r.run_spot_instance()
+        assert state['stage'] == 'failed'
+        assert not r.run_pool_script.called
+        assert state.get('released_to_pool') is None
+        r.ec2_client.terminate_instances.assert_called_once_with(InstanceIds=['i-1'])
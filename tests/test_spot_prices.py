@@ -0,0 +1,58 @@
+from datetime import datetime, timedelta, timezone
+
+from spot_runner.spot_prices import apply_pool, pool_price_stats, rank_pools
+
+
+now = datetime(2026, 1, 1, 12, 0, tzinfo=timezone.utc)
+
+
+def history_records(*prices):
+    return [(now - timedelta(hours=len(prices) - n), p) for n, p in enumerate(prices)]
+
+
+def test_pool_price_stats():
+    assert pool_price_stats(history_records(0.1, 0.1, 0.1), now) == (0.1, 0)
+    price, volatility = pool_price_stats(history_records(0.1, 0.3, 0.2), now)
+    assert price == 0.2
+    assert volatility > 0.3
+
+
+def test_rank_pools():
+    type_info = {
+        'm5.large': {'vcpus': 2, 'memory_gib': 8},
+        'c5.xlarge': {'vcpus': 4, 'memory_gib': 8},
+        'r5.large': {'vcpus': 2, 'memory_gib': 16},
+    }
+    history = {
+        ('m5.large', 'eu-west-1a'): history_records(0.04, 0.04),
+        ('m5.large', 'eu-west-1b'): history_records(0.03, 0.06, 0.03),
+        ('c5.xlarge', 'eu-west-1a'): history_records(0.07, 0.07),
+        ('r5.large', 'eu-west-1a'): history_records(0.05, 0.05),
+        ('r5.large', 'eu-west-1b'): history_records(0.5, 0.5),
+    }
+    pools = [
+        {'instance_type': t, 'availability_zone': az}
+        for t in ['m5.large', 'c5.xlarge', 'r5.large'] for az in ['eu-west-1a', 'eu-west-1b']
+    ]
+    ranked = rank_pools(pools, history, type_info, max_price='0.2', now=now)
+    assert [(p['instance_type'], p['availability_zone']) for p in ranked] == [
+        ('c5.xlarge', 'eu-west-1a'),
+        ('m5.large', 'eu-west-1a'),
+        # cheaper, but the price is not stable
+        ('m5.large', 'eu-west-1b'),
+        ('r5.large', 'eu-west-1a'),
+    ]
+    ranked = rank_pools(pools, history, type_info, rank_by='memory', max_price='0.2', now=now)
+    assert (ranked[0]['instance_type'], ranked[0]['availability_zone']) == ('r5.large', 'eu-west-1a')
+
+
+def test_apply_pool():
+    args = {'InstanceType': 'm5.large', 'SubnetId': 'subnet-1', 'Placement': {'Tenancy': 'default'}}
+    pool = {'instance_type': 'c5.large', 'availability_zone': 'eu-west-1b', 'subnet_id': 'subnet-2'}
+    assert apply_pool(args, pool) == {
+        'InstanceType': 'c5.large', 'SubnetId': 'subnet-2', 'Placement': {'Tenancy': 'default'}}
+    args = {'InstanceType': 'm5.large', 'Placement': {'Tenancy': 'default'}}
+    pool = {'instance_type': 'c5.large', 'availability_zone': 'eu-west-1b'}
+    assert apply_pool(args, pool) == {
+        'InstanceType': 'c5.large', 'Placement': {'Tenancy': 'default', 'AvailabilityZone': 'eu-west-1b'}}
+    assert args['Placement'] == {'Tenancy': 'default'}
@@ -0,0 +1,121 @@
+import json
+import subprocess
+import sys
+
+from click.testing import CliRunner
+
+from spot_runner.errors import AppError
+from spot_runner.main import cli
+from spot_runner.state import StateFile
+from spot_runner.state_scan import read_simple_state_value, scalar_str, scan_state_file
+
+
+check_script = '''\
+import json, sys
+from spot_runner.main import cli
+try:
+    cli(args=sys.argv[1:], obj={})
+except SystemExit as e:
+    assert not e.code, e.code
+heavy = sorted(m for m in sys.modules if m.split('.')[0] in ('boto3', 'botocore', 'jinja2', 'yaml'))
+print(json.dumps(heavy))
+'''
+
+
+def run_cli(project_dir, *args):
+    out = subprocess.check_output(
+        [sys.executable, '-c', check_script] + list(args), cwd=str(project_dir), universal_newlines=True)
+    *lines, heavy = out.splitlines()
+    return lines, json.loads(heavy)
+
+
+def create_state(path):
+    state = StateFile(path)
+    state['task_id'] = 'task1'
+    state['instance_id'] = 'i-0123456789abcdef0'
+    state['instance_info'] = {'InstanceId': 'i-0123456789abcdef0', 'PublicIpAddress': '1.2.3.4'}
+    state['public_ip'] = '1.2.3.4'
+    state['timings'] = [{'command': 'run-spot-instance', 'records': [{'name': 'x\ny', 'duration': 1.5}]}]
+    return state
+
+
+def test_read_only_commands_do_not_import_heavy_modules(temp_dir, project_dir):
+    state_path = temp_dir / 'state.yaml'
+    state = create_state(state_path)
+    for compacted in False, True:
+        if compacted:
+            state.close()
+        lines, heavy = run_cli(project_dir, 'instance-id', '--state', str(state_path))
+        assert lines == ['i-0123456789abcdef0']
+        assert heavy == []
+        lines, heavy = run_cli(project_dir, 'ip-address', '--state', str(state_path))
+        assert lines == ['1.2.3.4']
+        assert heavy == []
+
+
+def test_read_only_commands_fall_back_to_state_file(temp_dir, project_dir):
+    state_path = temp_dir / 'state.yaml'
+    state = create_state(state_path)
+    state['instances'] = [{'instance_id': 'i-1'}, {'instance_id': 'i-2'}]
+    state.close()
+    lines, heavy = run_cli(project_dir, 'instance-id', '--state', str(state_path))
+    assert lines == ['i-1', 'i-2']
+    assert 'yaml' in heavy
+
+
+def test_ip_address_of_relaunching_instance(temp_dir):
+    state_path = temp_dir / 'state.yaml'
+    state = create_state(state_path)
+    state['instance_id'] = None
+    state['instance_info'] = None
+    state['public_ip'] = None
+    state.close()
+    result = CliRunner().invoke(cli, ['ip-address', '--state', str(state_path)], obj={})
+    assert isinstance(result.exception, AppError)
+    assert 'has no public IP address' in str(result.exception)
+
+
+def test_scan_state_file(temp_dir):
+    state_path = temp_dir / 'state.yaml'
+    assert scan_state_file(state_path) is None
+    state = create_state(state_path)
+    state['instance_id'] = 'i-1'
+    values = scan_state_file(state_path)
+    assert values['instance_id'] == 'i-1'
+    assert values['task_id'] == 'task1'
+    assert values['instance_info'].startswith('{')
+    state.close()
+    assert scan_state_file(state_path) == values
+    state_path.write_text('spot_runner_state:\n  instance_id: i-1\n  instance_info:\n    Foo: bar\n')
+    assert scan_state_file(state_path) is None
+    state_path.write_text('spot_runner_state: {instance_id: i-1}\n')
+    assert scan_state_file(state_path) is None
+    state_path.write_text('spot_runner_state:\n  instance_id: i-1\n--- {spot_runner_state_update: {instance_id: i')
+    assert scan_state_file(state_path) is None
+
+
+def test_scalar_str():
+    assert scalar_str('i-0123456789abcdef0') == 'i-0123456789abcdef0'
+    assert scalar_str('1.2.3.4') == '1.2.3.4'
+    assert scalar_str("'1234'") == '1234'
+    assert scalar_str('1234') is None
+    assert scalar_str('1.5') is None
+    assert scalar_str('null') is None
+    assert scalar_str('Yes') is None
+    assert scalar_str('2020-01-01') is None
+    assert scalar_str('"a\\nb"') is None
+    assert scalar_str('{a: b}') is None
+
+
+def test_read_simple_state_value(temp_dir):
+    state_path = temp_dir / 'state.yaml'
+    state = create_state(state_path)
+    assert read_simple_state_value(state_path, 'instance_id') == 'i-0123456789abcdef0'
+    assert read_simple_state_value(state_path, 'instance_info') is None
+    assert read_simple_state_value(state_path, 'missing') is None
+    assert read_simple_state_value('sqlite:{}#task1'.format(temp_dir / 'db'), 'instance_id') is None
+    state['instance_id'] = None
+    assert read_simple_state_value(state_path, 'instance_id') is None
+    state['instances'] = [{'instance_id': 'i-1'}]
+    assert read_simple_state_value(state_path, 'task_id') is None
+    state.close()
@@ -1,4 +1,4 @@
-from spot_runner.state import open_state_file
+from spot_runner.state import InstanceState, StateFile, backup_state, open_state_file, query_tasks
 
 
 def test_create_state_file(temp_dir):
@@ -7,6 +7,129 @@ def test_create_state_file(temp_dir):
         state['foo'] = 'bar'
     with p.open() as f:
         content = f.read()
-    assert content == 'spot_runner_state: {foo: bar}\n'
+    assert content == 'spot_runner_state:\n  foo: bar\n'
     with open_state_file(p) as state:
         assert state['foo'] == 'bar'
+
+
+def test_instance_state(temp_dir):
+    p = temp_dir / 'state.yaml'
+    with open_state_file(p) as state:
+        state['task_id'] = 'task1'
+        state['instances'] = [{'instance_id': 'i-1'}, {'instance_id': 'i-2'}]
+        st = InstanceState(state, 1)
+        assert st['task_id'] == 'task1'
+        assert st['instance_id'] == 'i-2'
+        st['foo'] = 'bar'
+        assert st.get('foo') == 'bar'
+    with open_state_file(p) as state:
+        assert state['instances'] == [{'instance_id': 'i-1'}, {'instance_id': 'i-2', 'foo': 'bar'}]
+
+
+def test_state_file_journal(temp_dir):
+    p = temp_dir / 'state.yaml'
+    state = StateFile(p)
+    state['foo'] = 'bar'
+    state['foo'] = 'baz'
+    state['n'] = 1
+    assert p.read_text() == (
+        'spot_runner_state:\n'
+        '  foo: bar\n'
+        '--- {spot_runner_state_update: {foo: baz}}\n'
+        '--- {spot_runner_state_update: {n: 1}}\n')
+    assert StateFile(p)['foo'] == 'baz'
+    state.close()
+    assert p.read_text() == 'spot_runner_state:\n  foo: baz\n  n: 1\n'
+
+
+def test_state_file_concurrent_updates(temp_dir):
+    p = temp_dir / 'state.yaml'
+    state1 = StateFile(p)
+    state2 = StateFile(p)
+    state1['a'] = 1
+    state2['b'] = 2
+    state1.close()
+    state1['c'] = 3
+    assert state1['b'] == 2
+    state2.close()
+    state1.close()
+    with open_state_file(p) as state:
+        assert state.get('a') == 1
+        assert state.get('b') == 2
+        assert state.get('c') == 3
+
+
+def test_state_file_read_does_not_create_lock_file(temp_dir):
+    p = temp_dir / 'state.yaml'
+    p.write_text('spot_runner_state:\n  foo: bar\n')
+    with open_state_file(p) as state:
+        assert state['foo'] == 'bar'
+        state.flush()
+    assert sorted(f.name for f in temp_dir.iterdir()) == ['state.yaml']
+    with open_state_file(p) as state:
+        state['foo'] = 'baz'
+    assert (temp_dir / 'state.yaml.lock').exists()
+    with open_state_file(p) as state:
+        assert state['foo'] == 'baz'
+
+
+def test_state_file_compaction(temp_dir):
+    p = temp_dir / 'state.yaml'
+    state = StateFile(p)
+    for n in range(StateFile.compact_threshold + 2):
+        state['n'] = n
+    assert len(p.read_text().splitlines()) < StateFile.compact_threshold
+    assert StateFile(p)['n'] == StateFile.compact_threshold + 1
+
+
+def test_state_file_multiline_values(temp_dir):
+    p = temp_dir / 'state.yaml'
+    value = {'output': 'line 1\nline 2\r\n', 'items': ['a\nb', {'c': 'd\n'}]}
+    with open_state_file(p) as state:
+        state['first'] = value
+        state['second'] = value
+        assert len(p.read_text().splitlines()) == 3
+    assert len(p.read_text().splitlines()) == 3
+    with open_state_file(p) as state:
+        assert state['first'] == value
+        assert state['second'] == value
+
+
+def test_sqlite_state(temp_dir):
+    db_path = temp_dir / 'tasks.db'
+    with open_state_file('sqlite:{}#bp1'.format(db_path)) as state:
+        state['task_id'] = 'task-1'
+        state['region'] = 'eu-west-1'
+        state['stage'] = 'running'
+        state['instance_info'] = {'PublicIpAddress': '1.2.3.4'}
+    with open_state_file('sqlite:{}#bp2'.format(db_path)) as state:
+        state['task_id'] = 'task-2'
+        state['region'] = 'us-east-1'
+        state['stage'] = 'running'
+    with open_state_file('sqlite:{}#task-1'.format(db_path)) as state:
+        assert state['instance_info'] == {'PublicIpAddress': '1.2.3.4'}
+    rows = query_tasks(db_path, region='eu-west-1', stage='running')
+    assert [r['task_id'] for r in rows] == ['task-1']
+    rows = query_tasks(db_path, task_id='task-*')
+    assert [r['task_id'] for r in rows] == ['task-1', 'task-2']
+    backup_state('sqlite:{}#bp1'.format(db_path))
+    with open_state_file('sqlite:{}#bp1'.format(db_path)) as state:
+        assert state.get('task_id') is None
+    assert len(query_tasks(db_path)) == 2
+
+
+def test_sqlite_state_instances(temp_dir):
+    db_path = temp_dir / 'tasks.db'
+    with open_state_file('sqlite:{}#bp1'.format(db_path)) as state:
+        state['task_id'] = 'task-1'
+        state['instances'] = [{}, {}]
+        for n in range(2):
+            InstanceState(state, n)['instance_id'] = 'i-{}'.format(n)
+        InstanceState(state, 1)['stage'] = 'running'
+    rows = query_tasks(db_path, instance_id='i-1')
+    assert [r['task_id'] for r in rows] == ['task-1']
+    assert rows[0]['instance_id'] is None
+    assert rows[0]['instances'] == [{'instance_id': 'i-0', 'stage': None}, {'instance_id': 'i-1', 'stage': 'running'}]
+    assert query_tasks(db_path, instance_id='i-2') == []
+    backup_state('sqlite:{}#bp1'.format(db_path))
+    assert query_tasks(db_path, instance_id='i-1')[0]['name'].startswith('bp1.backup-')
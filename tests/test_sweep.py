@@ -0,0 +1,59 @@
+from queue import Queue
+from unittest.mock import MagicMock
+
+from pytest import raises
+
+from spot_runner.errors import AppError
+from spot_runner.state import open_state_file
+from spot_runner.sweep import RunSweep, Sweep, expand_matrix, get_job_id
+
+
+def test_expand_matrix():
+    assert expand_matrix({'b': [1, 2], 'a': ['x']}) == [
+        {'a': 'x', 'b': 1},
+        {'a': 'x', 'b': 2},
+    ]
+    assert expand_matrix([{'a': 1}, {'a': [2, 3]}]) == [{'a': 1}, {'a': 2}, {'a': 3}]
+
+
+def test_get_job_id():
+    assert get_job_id({'a': 1, 'b': 2}) == get_job_id({'b': 2, 'a': 1})
+    assert get_job_id({'a': 1}) != get_job_id({'a': 2})
+
+
+def test_load_example_sweep(project_dir):
+    sweep = Sweep(project_dir / 'examples/hello_sweep/sweep.yaml')
+    assert len(sweep.jobs) == 6
+    assert sweep.job_command({'greeting': 'ahoj', 'count': 2}) == ['bash', 'uploaded/job.sh', 'ahoj', '2']
+
+
+def sweep_worker_setup(state, job_ids):
+    sweep = MagicMock()
+    sweep.job_command.side_effect = lambda values: ['echo', values['n']]
+    state['sweep_jobs'] = {job_id: {'values': {'n': job_id}, 'status': 'pending'} for job_id in job_ids}
+    queue = Queue()
+    for job_id in job_ids:
+        queue.put(job_id)
+    run = MagicMock()
+    run.instance_id.return_value = 'i-1'
+    run.run_ssh.return_value = 0
+    return RunSweep(state, MagicMock(), sweep, None), run, queue
+
+
+def test_run_worker(temp_dir):
+    with open_state_file(temp_dir / 'state.yaml') as state:
+        rs, run, queue = sweep_worker_setup(state, ['a', 'b'])
+        rs.run_worker(run, queue)
+        run.run_setup_command.assert_called_once_with()
+        assert [job['status'] for job_id, job in sorted(state['sweep_jobs'].items())] == ['done', 'done']
+
+
+def test_run_worker_job_failure_and_lost_connection(temp_dir):
+    with open_state_file(temp_dir / 'state.yaml') as state:
+        rs, run, queue = sweep_worker_setup(state, ['a', 'b', 'c'])
+        run.run_ssh.side_effect = [AppError('job failed'), 255]
+        with raises(AppError, match='Lost SSH connection'):
+            rs.run_worker(run, queue)
+        jobs = state['sweep_jobs']
+        assert (jobs['a']['status'], jobs['b']['status'], jobs['c']['status']) == ('failed', 'pending', 'pending')
+        assert [queue.get_nowait(), queue.get_nowait()] == ['c', 'b']
@@ -0,0 +1,73 @@
+import boto3
+from botocore.stub import Stubber
+import pytest
+
+from spot_runner.timings import Timings, percentile, save_timings_to_state, summarize, write_prometheus_textfile
+
+
+def test_percentile():
+    assert percentile([3, 1, 2], 50) == 2
+    assert percentile(list(range(1, 101)), 95) == 95
+    assert percentile([5], 95) == 5
+
+
+def test_phase_and_summarize():
+    t = Timings()
+    with t.phase('upload', region='eu-west-1'):
+        pass
+    with pytest.raises(ValueError):
+        with t.phase('upload', region='eu-west-1'):
+            raise ValueError()
+    assert [(r['kind'], r['name'], r['ok'], r['region']) for r in t.records] == [
+        ('phase', 'upload', True, 'eu-west-1'),
+        ('phase', 'upload', False, 'eu-west-1'),
+    ]
+    summary, = summarize(t.records)
+    assert summary['name'] == 'upload'
+    assert summary['count'] == 2
+
+
+def test_instrument_client():
+    t = Timings()
+    client = boto3.client('ec2', region_name='eu-west-1', aws_access_key_id='x', aws_secret_access_key='x')
+    t.instrument_client(client)
+    with Stubber(client) as stubber:
+        stubber.add_response('describe_images', {'Images': []})
+        client.describe_images(ImageIds=['ami-1'])
+        t.tag_client(client, instance_type='m5.large')
+        stubber.add_response('describe_images', {'Images': []})
+        client.describe_images(ImageIds=['ami-1'])
+    first, second = t.records
+    assert (first['kind'], first['name'], first['region']) == ('api', 'DescribeImages', 'eu-west-1')
+    assert 'instance_type' not in first
+    assert second['instance_type'] == 'm5.large'
+
+
+def test_save_timings_to_state():
+    state = {}
+    records = [{'kind': 'phase', 'name': 'launch', 'start': 1500000000, 'duration': 1.5, 'ok': True}]
+    for n in range(25):
+        save_timings_to_state(state, 'run-spot-instance', records)
+    assert len(state['timings']) == 20
+    assert state['timings'][0]['started'] == '2017-07-14T02:40:00Z'
+
+
+def test_write_prometheus_textfile(temp_dir):
+    records = [
+        {'kind': 'phase', 'name': 'upload', 'start': 0, 'duration': 1.5, 'ok': True,
+         'region': 'eu-west-1', 'instance_type': 'm5.large'},
+        {'kind': 'api', 'name': 'DescribeImages', 'start': 0, 'duration': 0.25, 'ok': True, 'region': 'eu-west-1'},
+        {'kind': 'api', 'name': 'DescribeImages', 'start': 0, 'duration': 0.25, 'ok': True, 'region': 'eu-west-1',
+         'instance_type': 'm5.large'},
+        {'kind': 'api', 'name': 'DescribeImages', 'start': 0, 'duration': 0.25, 'ok': True, 'region': 'eu-west-1',
+         'instance_type': 'm5.large'},
+    ]
+    path = temp_dir / 'spot_runner.prom'
+    write_prometheus_textfile(path, records, task_id='t1')
+    lines = path.read_text().splitlines()
+    labels = 'instance_type="m5.large",phase="upload",region="eu-west-1",task_id="t1"'
+    assert 'spot_runner_phase_duration_seconds{' + labels + '} 1.500' in lines
+    labels = 'instance_type="m5.large",operation="DescribeImages",region="eu-west-1",task_id="t1"'
+    assert 'spot_runner_api_call_duration_seconds_count{' + labels + '} 2' in lines
+    labels = 'operation="DescribeImages",region="eu-west-1",task_id="t1"'
+    assert 'spot_runner_api_call_duration_seconds_count{' + labels + '} 1' in lines
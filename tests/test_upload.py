@@ -0,0 +1,98 @@
+from io import BytesIO
+import pytest
+import tarfile
+
+from spot_runner.state import open_state_file
+from spot_runner.upload import \
+    build_manifest, diff_manifests, format_manifest, list_dir_files, parse_manifest, write_tar
+
+
+def test_list_dir_files(temp_dir):
+    (temp_dir / 'a.txt').write_text('a')
+    (temp_dir / 'sub').mkdir()
+    (temp_dir / 'sub/b.txt').write_text('b')
+    assert list_dir_files(temp_dir, 'x') == {
+        'x/a.txt': temp_dir / 'a.txt',
+        'x/sub/b.txt': temp_dir / 'sub/b.txt',
+    }
+
+
+def test_list_dir_files_link_cycle(temp_dir):
+    (temp_dir / 'sub').mkdir()
+    (temp_dir / 'sub/b.txt').write_text('b')
+    (temp_dir / 'sub/loop').symlink_to('..')
+    (temp_dir / 'link').symlink_to('sub')
+    assert list_dir_files(temp_dir, 'x') == {
+        'x/link/b.txt': temp_dir / 'link/b.txt',
+        'x/sub/b.txt': temp_dir / 'sub/b.txt',
+    }
+
+
+def test_build_manifest(temp_dir):
+    (temp_dir / 'a.txt').write_text('a')
+    assert build_manifest({'a.txt': temp_dir / 'a.txt', 'b.txt': b'b'}) == {
+        'a.txt': '86f7e437faa5a7fce15d1ddcb9eaeaea377667b8',
+        'b.txt': 'e9d71f5ee7c92d6dc9e92ffdad17b8bd49418f98',
+    }
+
+
+def test_format_manifest():
+    assert format_manifest({'b': '2', 'a': '1'}) == '1  a\n2  b\n'
+
+
+def test_parse_manifest():
+    manifest = {'a b/c.txt': '1' * 40, 'd': '2' * 40}
+    assert parse_manifest(format_manifest(manifest)) == manifest
+
+
+def test_diff_manifests():
+    old = {'a': '1', 'b': '2', 'c': '3'}
+    new = {'a': '1', 'b': '22', 'd': '4'}
+    assert diff_manifests(old, new) == (['b', 'd'], ['c'])
+    assert diff_manifests(None, new) == (['a', 'b', 'd'], [])
+
+
+def test_write_tar(temp_dir):
+    (temp_dir / 'a.txt').write_text('a')
+    f = BytesIO()
+    write_tar(f, [('x/a.txt', temp_dir / 'a.txt'), ('b.txt', b'bb')])
+    f.seek(0)
+    with tarfile.open(fileobj=f) as tar:
+        assert tar.getnames() == ['x/a.txt', 'b.txt']
+        assert tar.extractfile('x/a.txt').read() == b'a'
+        assert tar.extractfile('b.txt').read() == b'bb'
+
+
+@pytest.mark.parametrize('compression', ['none', 'gzip', 'ssh', 'auto'])
+def test_streamed_upload(temp_dir, make_blueprint, make_run, fake_ssh, compression):
+    data_dir = temp_dir / 'data'
+    (data_dir / 'sub').mkdir(parents=True)
+    (data_dir / 'a.txt').write_text('a' * 100000)
+    (data_dir / 'sub/b.txt').write_text('b')
+    bp = make_blueprint(upload=['data'], compression=compression)
+    uploaded = fake_ssh.home / 'uploaded'
+    with open_state_file(temp_dir / 'state.yaml') as state:
+        r = make_run(state, bp, running=True)
+        r.upload()
+        assert (uploaded / 'data/a.txt').read_text() == 'a' * 100000
+        assert (uploaded / 'data/sub/b.txt').read_text() == 'b'
+        upload_call = fake_ssh.calls()[-1]
+        host_index = upload_call.index('10.0.0.1')
+        assert upload_call[host_index + 1:host_index + 3] == ['env', 'TASK_ID=task1']
+        assert upload_call[host_index + 3:host_index + 5] == ['sh', '-c']
+        script = upload_call[host_index + 5]
+        assert 'tar' in script
+        assert ('gzip -1' in script) == (compression == 'gzip')
+        assert ('-C' in upload_call) == (compression == 'ssh')
+        # second upload sends only the changes
+        (data_dir / 'sub/b.txt').unlink()
+        (data_dir / 'c.txt').write_text('c')
+        calls_before = len(fake_ssh.calls())
+        r.upload()
+        assert not (uploaded / 'data/sub/b.txt').exists()
+        assert (uploaded / 'data/c.txt').read_text() == 'c'
+        assert len(fake_ssh.calls()) == calls_before + 1
+        assert state['uploaded_manifest'] == build_manifest(list_dir_files(data_dir, 'data'))
+        # nothing changed - no ssh call at all
+        r.upload()
+        assert len(fake_ssh.calls()) == calls_before + 1
@@ -0,0 +1,156 @@
+import socket
+from threading import Thread, current_thread
+from time import sleep
+from unittest.mock import MagicMock
+
+from pytest import raises
+
+from spot_runner import workflow
+from spot_runner.errors import AppError
+from spot_runner.state import open_state_file
+from spot_runner.workflow import \
+    parse_host_ssh_keys, race_launch_specification, run_instances_launch_args, wait_for_ssh_port
+
+
+def test_parse_host_ssh_keys():
+    output = [
+        'foo',
+        '-----BEGIN SSH HOST KEY KEYS-----',
+        'ssh-ed25519 AAAA root@host',
+        'ssh-rsa BBBB root@host',
+        '-----END SSH HOST KEY KEYS-----',
+        'bar',
+    ]
+    assert parse_host_ssh_keys(output) == ['ssh-ed25519 AAAA root@host', 'ssh-rsa BBBB root@host']
+
+
+def test_wait_for_ssh_port():
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    port = server.getsockname()[1]
+
+    def serve():
+        conn, addr = server.accept()
+        conn.sendall(b'SSH-2.0-Test\r\n')
+        conn.close()
+
+    t = Thread(target=serve)
+    t.start()
+    try:
+        assert wait_for_ssh_port('127.0.0.1', port, timeout=5)
+    finally:
+        t.join()
+        server.close()
+    assert not wait_for_ssh_port('127.0.0.1', port, timeout=0)
+
+
+def test_run_instances_launch_args():
+    spec = {'ImageId': 'ami-123', 'AddressingType': 'public', 'UserData': 'aGVsbG8='}
+    assert run_instances_launch_args(spec) == {'ImageId': 'ami-123', 'UserData': 'hello'}
+
+
+def test_race_launch_specification():
+    launch_spec = {'ImageId': 'ami-1', 'InstanceType': 'm5.large', 'SecurityGroupIds': ['sg-1']}
+    entry = {
+        'region': 'eu-central-1',
+        'image_id': 'ami-2',
+        'availability_zone': 'eu-central-1b',
+        'launch_specification': {'SecurityGroupIds': ['sg-2']},
+    }
+    assert race_launch_specification(launch_spec, entry) == {
+        'ImageId': 'ami-2',
+        'InstanceType': 'm5.large',
+        'SecurityGroupIds': ['sg-2'],
+        'Placement': {'AvailabilityZone': 'eu-central-1b'},
+    }
+    assert launch_spec['ImageId'] == 'ami-1'
+
+
+def pending_instance(public_ip=None):
+    instance = {
+        'InstanceId': 'i-1',
+        'InstanceLifecycle': 'spot',
+        'State': {'Name': 'pending'},
+        'PublicDnsName': '',
+    }
+    if public_ip:
+        instance['PublicIpAddress'] = public_ip
+    return {'Reservations': [{'ReservationId': 'r-1', 'Instances': [instance]}]}
+
+
+def test_instance_info_waits_for_public_ip(temp_dir, make_blueprint, make_run, monkeypatch):
+    monkeypatch.setattr(workflow, 'sleep', lambda seconds: None)
+    with open_state_file(temp_dir / 'state.yaml') as state:
+        state['instance_id'] = 'i-1'
+        r = make_run(state, make_blueprint())
+        r.ec2_client.describe_instances.side_effect = [pending_instance(), pending_instance('1.2.3.4')]
+        assert r.instance_public_ip() == '1.2.3.4'
+        assert state['public_ip'] == '1.2.3.4'
+
+
+def test_instance_info_pending_timeout(temp_dir, make_blueprint, make_run, monkeypatch):
+    monkeypatch.setattr(workflow, 'sleep', lambda seconds: None)
+    with open_state_file(temp_dir / 'state.yaml') as state:
+        state['instance_id'] = 'i-1'
+        r = make_run(state, make_blueprint())
+        r.pending_timeout = -1
+        r.ec2_client.describe_instances.return_value = pending_instance()
+        with raises(AppError, match='pending'):
+            r.instance_info()
+
+
+def test_ssh_multiplexing(temp_dir, make_blueprint, make_run, fake_ssh):
+    with open_state_file(temp_dir / 'state.yaml') as state:
+        with make_run(state, make_blueprint(ssh_multiplexing=True), running=True) as r:
+            r.run_ssh(['true'])
+            r.run_ssh(['true'])
+            assert len(fake_ssh.calls()) == 3
+        master, first, second, exit_call = fake_ssh.calls()
+    control_path = 'ControlPath=' + str(temp_dir / 'ssh_control-%r')
+    for args in master, first, second, exit_call:
+        assert args[args.index(control_path) - 1] == '-o'
+        assert '-S' not in args
+    assert ['-o', 'ControlMaster=yes', '-o', 'ControlPersist=yes', '-f', '-N', '10.0.0.1'] == master[-7:]
+    assert first[-4:] == ['10.0.0.1', 'env', 'TASK_ID=task1', 'true']
+    assert 'ControlMaster=yes' not in first
+    assert exit_call[-3:] == ['-O', 'exit', '10.0.0.1']
+
+
+def test_ssh_without_multiplexing(temp_dir, make_blueprint, make_run, fake_ssh):
+    with open_state_file(temp_dir / 'state.yaml') as state:
+        with make_run(state, make_blueprint(), running=True) as r:
+            r.run_ssh(['true'])
+    call, = fake_ssh.calls()
+    assert call[call.index('-S') + 1] == 'none'
+    assert not [a for a in call if a.startswith('Control')]
+
+
+def test_race_run_instances(temp_dir, make_blueprint, make_run, monkeypatch):
+    clients = {}
+    client_threads = []
+
+    def create_ec2_client(region_name):
+        client_threads.append(current_thread())
+        clients[region_name] = MagicMock()
+        clients[region_name].meta.region_name = region_name
+        clients[region_name].terminate_instances.side_effect = Exception('API error')
+        return clients[region_name]
+
+    def run_instances(stop_event, ec2_client, **kwargs):
+        if ec2_client.meta.region_name == 'us-east-1':
+            sleep(0.2)
+        return {'Instances': [{'InstanceId': 'i-' + ec2_client.meta.region_name}]}
+
+    monkeypatch.setattr(workflow, 'create_ec2_client', create_ec2_client)
+    race = [{'region': 'eu-west-1', 'image_id': 'ami-1'}, {'region': 'us-east-1', 'image_id': 'ami-2'}]
+    with open_state_file(temp_dir / 'state.yaml') as state:
+        r = make_run(state, make_blueprint(race=race))
+        r.check_image = MagicMock()
+        r.run_instances = run_instances
+        region, reply = r.race_run_instances('task1', 1)
+    assert region == 'eu-west-1'
+    assert reply == {'Instances': [{'InstanceId': 'i-eu-west-1'}]}
+    assert r.ec2_client is clients['eu-west-1']
+    clients['us-east-1'].terminate_instances.assert_called_once_with(InstanceIds=['i-us-east-1'])
+    assert client_threads == [current_thread()] * 2
@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+
+'''
+Offline benchmarks of spot-runner hot paths. No AWS account or SSH server
+is needed: EC2 API is answered by a stand-in (canned replies injected via
+botocore events) and ssh is replaced by a script that runs the "remote"
+command locally (SPOT_RUNNER_SSH).
+
+Every benchmark runs in a separate process, so that its peak memory (max RSS)
+can be measured too. Results are printed (or saved with --output) as JSON;
+use --compare to compare them with results of a previous run.
+
+    python3 util/benchmark.py --output bench.json
+    python3 util/benchmark.py --compare bench.json --only upload_10k_files
+'''
+
+import argparse
+import json
+import os
+import platform
+from pathlib import Path
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+from time import monotonic as monotime
+
+
+benchmarks = {}
+
+
+def benchmark(f):
+    benchmarks[f.__name__[len('bench_'):]] = f
+    return f
+
+
+def main():
+    p = argparse.ArgumentParser(description='Offline spot-runner benchmarks')
+    p.add_argument('--output', metavar='FILE', help='save results (JSON) to file')
+    p.add_argument('--compare', metavar='FILE', help='compare with results saved earlier')
+    p.add_argument('--only', metavar='NAME', action='append', choices=sorted(benchmarks),
+                   help='run only this benchmark (can be repeated)')
+    p.add_argument('--large-mb', type=int, default=1024, help='size of the large upload tree (default: %(default)s)')
+    p.add_argument('--run', help=argparse.SUPPRESS)
+    p.add_argument('--work-dir', help=argparse.SUPPRESS)
+    args = p.parse_args()
+
+    if args.run:
+        # child process running one benchmark
+        print(json.dumps(benchmarks[args.run](Path(args.work_dir), args)))
+        return
+
+    results = []
+    with TemporaryDirectory(prefix='spot_runner_bench.') as td:
+        for name in args.only or sorted(benchmarks):
+            print('Running benchmark {}...'.format(name), file=sys.stderr)
+            work_dir = Path(td) / name
+            work_dir.mkdir()
+            results.extend(run_isolated(name, work_dir, args))
+    doc = {
+        'format_version': 1,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    if args.output:
+        Path(args.output).write_text(json.dumps(doc, indent=2) + '\n')
+    else:
+        print(json.dumps(doc, indent=2))
+    if args.compare:
+        print_comparison(json.loads(Path(args.compare).read_text()), doc)
+
+
+def run_isolated(name, work_dir, args):
+    cmd = [
+        sys.executable, __file__, '--run', name, '--work-dir', str(work_dir),
+        '--large-mb', str(args.large_mb),
+    ]
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    output = p.stdout.read()
+    p.stdout.close()
+    pid, status, rusage = os.wait4(p.pid, 0)
+    p.returncode = status
+    if status != 0:
+        raise Exception('Benchmark {} failed'.format(name))
+    results = json.loads(output.decode())
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    max_rss = rusage.ru_maxrss / (2**20 if sys.platform == 'darwin' else 2**10)
+    results.append(result(name + '.peak_rss', max_rss, 'MB'))
+    return results
+
+
+def print_comparison(old_doc, new_doc):
+    old = {r['name']: r for r in old_doc['results']}
+    print('{:45} {:>12} {:>12} {:>8}'.format('benchmark', 'old', 'new', 'change'))
+    for r in new_doc['results']:
+        o = old.get(r['name'])
+        if o and o['value']:
+            change = '{:+.1f} %'.format((r['value'] - o['value']) / o['value'] * 100)
+            print('{:45} {:12.4f} {:12.4f} {:>8} {}'.format(r['name'], o['value'], r['value'], change, r['unit']))
+        else:
+            print('{:45} {:>12} {:12.4f} {:>8} {}'.format(r['name'], '-', r['value'], '', r['unit']))
+
+
+def result(name, value, unit):
+    return {'name': name, 'value': value, 'unit': unit}
+
+
+def median_time(f, repeat):
+    durations = []
+    for n in range(repeat):
+        start_mt = monotime()
+        f()
+        durations.append(monotime() - start_mt)
+    return statistics.median(durations)
+
+
+# Stand-in for ssh: skips ssh options and the host name and runs
+# the command locally in directory $FAKE_SSH_HOME
+fake_ssh_script = '''\
+#!/bin/sh
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -O|-N) exit 0 ;;
+        -i|-l|-o|-S|-p) shift 2 ;;
+        -*) shift ;;
+        *) break ;;
+    esac
+done
+shift
+cd "$FAKE_SSH_HOME" && exec sh -c "$*"
+'''
+
+fake_ec2_replies = {
+    'DescribeImages': {'Images': [{'ImageId': 'ami-1', 'OwnerId': '123456789012'}]},
+    'RunInstances': {'Instances': [{'InstanceId': 'i-1'}]},
+    'DescribeInstances': {'Reservations': [{
+        'ReservationId': 'r-1',
+        'Instances': [{
+            'InstanceId': 'i-1',
+            'InstanceLifecycle': 'spot',
+            'InstanceType': 'm5.large',
+            'State': {'Name': 'running', 'Code': 16},
+            'PublicIpAddress': '127.0.0.1',
+            'PublicDnsName': 'localhost',
+        }],
+    }]},
+    'DescribeInstanceStatus': {'InstanceStatuses': [{
+        'InstanceId': 'i-1',
+        'InstanceStatus': {'Status': 'ok'},
+        'SystemStatus': {'Status': 'ok'},
+    }]},
+    'GetConsoleOutput': {
+        'InstanceId': 'i-1',
+        'Output': '\n'.join([
+            'boot...',
+            '-----BEGIN SSH HOST KEY KEYS-----',
+            'ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIBench root@localhost',
+            '-----END SSH HOST KEY KEYS-----',
+        ]),
+    },
+}
+
+
+def fake_ec2_client():
+    import boto3
+    from botocore.awsrequest import AWSResponse
+    client = boto3.client(
+        'ec2', region_name='eu-west-1', aws_access_key_id='bench', aws_secret_access_key='bench')
+
+    def reply(model, **kwargs):
+        return AWSResponse('https://ec2.invalid/', 200, {}, None), fake_ec2_replies[model.name]
+
+    client.meta.events.register_first('before-call.ec2', reply)
+    return client
+
+
+def setup_environment(work_dir):
+    os.environ['SPOT_RUNNER_CACHE_DIR'] = str(work_dir / 'cache')
+    ssh_path = work_dir / 'fake_ssh'
+    ssh_path.write_text(fake_ssh_script)
+    ssh_path.chmod(0o755)
+    os.environ['SPOT_RUNNER_SSH'] = str(ssh_path)
+    remote_home = work_dir / 'remote_home'
+    remote_home.mkdir(exist_ok=True)
+    os.environ['FAKE_SSH_HOME'] = str(remote_home)
+    return remote_home
+
+
+def write_blueprint(bp_dir, upload=(), extra_lines=()):
+    bp_dir.mkdir(parents=True, exist_ok=True)
+    (bp_dir / 'bench_key').write_text('not a real key\n')
+    lines = [
+        'spot_runner_blueprint:',
+        '    region: eu-west-1',
+        '    task_id_template: bench-{date}',
+        "    spot_price: '0.10'",
+        '    ssh_private_key_path: bench_key',
+        "    remote_command: ['true']",
+        '    upload: {}'.format(json.dumps([str(p) for p in upload])),
+        '    launch_specification:',
+        '        ImageId: ami-1',
+        '        KeyName: bench',
+        '        InstanceType: m5.large',
+    ]
+    path = bp_dir / 'blueprint.yaml'
+    path.write_text('\n'.join(lines + list(extra_lines)) + '\n')
+    return path
+
+
+def prepared_run(work_dir, blueprint_path):
+    '''
+    Return RunSpotInstance for an instance that is already launched
+    (state says so) - ssh goes to the fake ssh.
+    '''
+    from spot_runner.api_cache import ApiCache
+    from spot_runner.blueprint import Blueprint
+    from spot_runner.state import StateFile
+    from spot_runner.workflow import RunSpotInstance
+    state = StateFile(work_dir / 'state.yaml')
+    state['task_id'] = 'bench'
+    state['instance_id'] = 'i-1'
+    state['instance_ok'] = True
+    state['instance_host_keys'] = ['ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIBench']
+    temp_dir = work_dir / 'temp'
+    temp_dir.mkdir(exist_ok=True)
+    r = RunSpotInstance(
+        state=state, blueprint=Blueprint(blueprint_path), temp_dir=temp_dir,
+        ec2_client=fake_ec2_client(), api_cache=ApiCache(enabled=False))
+    r._instance_info = fake_ec2_replies['DescribeInstances']['Reservations'][0]['Instances'][0]
+    return r
+
+
+def reset_upload(r, remote_home):
+    for key in 'uploaded_manifest', 'uploaded_data_sha1', 'transfer_throughput':
+        r.state[key] = None
+    shutil.rmtree(str(remote_home))
+    remote_home.mkdir()
+
+
+def tree_size(path):
+    return sum(p.stat().st_size for p in path.rglob('*') if p.is_file())
+
+
+@benchmark
+def bench_cli_startup(work_dir, args):
+    from spot_runner.state import StateFile
+    setup_environment(work_dir)
+    state_path = work_dir / 'state.yaml'
+    state = StateFile(state_path)
+    state['instance_id'] = 'i-1'
+    state.close()
+    cmd = [sys.executable, '-m', 'spot_runner']
+    return [
+        result('cli_startup.help', median_time(
+            lambda: subprocess.run(cmd + ['--help'], stdout=subprocess.DEVNULL, check=True), 10), 's'),
+        result('cli_startup.instance_id', median_time(
+            lambda: subprocess.run(
+                cmd + ['instance-id', '--state', str(state_path)], stdout=subprocess.DEVNULL, check=True), 10), 's'),
+    ]
+
+
+@benchmark
+def bench_blueprint_load(work_dir, args):
+    from spot_runner.blueprint import Blueprint
+    setup_environment(work_dir)
+    bp_dir = work_dir / 'bp'
+    bp_dir.mkdir()
+    (bp_dir / 'launch_spec.yaml').write_text(''.join(
+        'tag{}: {}\n'.format(n, 'x' * 50) for n in range(1000)))
+    path = write_blueprint(bp_dir, extra_lines=[
+        '    included:',
+        '        INCLUDE_YAML: launch_spec.yaml',
+    ])
+    path.write_text('#!yaml-includes\n' + path.read_text())
+    start_mt = monotime()
+    Blueprint(path)
+    cold = monotime() - start_mt
+    return [
+        result('blueprint_load.uncached', median_time(lambda: Blueprint(path, use_cache=False), 20), 's'),
+        result('blueprint_load.cache_cold', cold, 's'),
+        result('blueprint_load.cache_warm', median_time(lambda: Blueprint(path), 20), 's'),
+    ]
+
+
+@benchmark
+def bench_preprocess_large_template(work_dir, args):
+    from spot_runner.file_transformations import preprocess_file
+    setup_environment(work_dir)
+    (work_dir / 'snippet.txt').write_text('snippet\n' * 100)
+    jinja_path = work_dir / 'large_jinja.yaml'
+    jinja_path.write_text(''.join([
+        '#!jinja\n',
+        'items:\n',
+        '{% for i in range(10000) %}\n',
+        '  - name: item{{ i }}\n',
+        '    value: "{{ i * 2 }}"\n',
+        '{% endfor %}\n',
+        'snippet: |\n',
+        '  {{ read_file("snippet.txt") | indent(2) }}\n',
+    ]))
+    (work_dir / 'included.yaml').write_text(''.join(
+        'key{}: {{a: {}, b: [1, 2, 3]}}\n'.format(n, n) for n in range(10000)))
+    includes_path = work_dir / 'large_includes.yaml'
+    includes_path.write_text('#!yaml-includes\n' + ''.join(
+        'part{}:\n  INCLUDE_YAML: included.yaml\n'.format(n) for n in range(5)))
+    return [
+        result('preprocess.jinja_10k_items', median_time(lambda: preprocess_file(jinja_path), 5), 's'),
+        result('preprocess.yaml_includes_50k_keys', median_time(lambda: preprocess_file(includes_path), 5), 's'),
+    ]
+
+
+@benchmark
+def bench_state_flush(work_dir, args):
+    from spot_runner.state import StateFile
+    n = 500
+    state = StateFile(work_dir / 'state.yaml')
+    state['instance_info'] = fake_ec2_replies['DescribeInstances']['Reservations'][0]['Instances'][0]
+
+    def small_updates():
+        for i in range(n):
+            state['counter'] = i
+            state.flush()
+
+    large_value = {'file{}.txt'.format(i): '{:040x}'.format(i) for i in range(2000)}
+
+    def large_updates():
+        for i in range(n // 10):
+            state['uploaded_manifest'] = dict(large_value, counter=str(i))
+            state.flush()
+
+    return [
+        result('state_flush.small_update', median_time(small_updates, 3) / n, 's'),
+        result('state_flush.large_update', median_time(large_updates, 3) / (n // 10), 's'),
+        result('state_flush.close', median_time(state.close, 1), 's'),
+    ]
+
+
+@benchmark
+def bench_orchestration(work_dir, args):
+    from spot_runner.api_cache import ApiCache
+    from spot_runner.blueprint import Blueprint
+    from spot_runner.state import StateFile
+    from spot_runner.workflow import RunSpotInstance
+    setup_environment(work_dir)
+    bp = Blueprint(write_blueprint(work_dir / 'bp'))
+    ec2_client = fake_ec2_client()
+    counter = [0]
+
+    def launch_and_prepare():
+        counter[0] += 1
+        run_dir = work_dir / 'run{}'.format(counter[0])
+        run_dir.mkdir()
+        state = StateFile(run_dir / 'state.yaml')
+        r = RunSpotInstance(
+            state=state, blueprint=bp, temp_dir=run_dir, ec2_client=ec2_client,
+            api_cache=ApiCache(enabled=False))
+        r.ensure_instance()
+        r.prepare_instance()
+        r.instance_host_key_path()
+        state.close()
+
+    return [
+        result('orchestration.launch_and_prepare', median_time(launch_and_prepare, 10), 's'),
+    ]
+
+
+@benchmark
+def bench_upload_10k_files(work_dir, args):
+    remote_home = setup_environment(work_dir)
+    tree = work_dir / 'src' / 'tree'
+    rnd = random.Random(0)
+    for n in range(10000):
+        d = tree / 'd{:03d}'.format(n // 100)
+        d.mkdir(parents=True, exist_ok=True)
+        words = ' '.join(rnd.choice(['alpha', 'beta', 'gamma', 'delta']) for i in range(rnd.randint(100, 1500)))
+        (d / 'f{:05d}.txt'.format(n)).write_text(words)
+    size = tree_size(tree)
+    r = prepared_run(work_dir, write_blueprint(work_dir / 'bp', upload=[tree]))
+    results = []
+    for codec in ['none', 'zstd']:
+        r.blueprint.compression = codec
+        reset_upload(r, remote_home)
+        start_mt = monotime()
+        r.upload()
+        duration = monotime() - start_mt
+        results.append(result('upload_10k_files.full_{}'.format(codec), duration, 's'))
+        results.append(result('upload_10k_files.full_{}_throughput'.format(codec), size / 2**20 / duration, 'MB/s'))
+    results.append(result('upload_10k_files.unchanged', median_time(r.upload, 3), 's'))
+    changed_path = tree / 'd000' / 'f00000.txt'
+
+    def upload_one_changed():
+        changed_path.write_text(changed_path.read_text() + ' x')
+        r.upload()
+
+    results.append(result('upload_10k_files.one_changed', median_time(upload_one_changed, 3), 's'))
+    return results
+
+
+@benchmark
+def bench_upload_large(work_dir, args):
+    remote_home = setup_environment(work_dir)
+    tree = work_dir / 'src' / 'large'
+    tree.mkdir(parents=True)
+    file_count = 4
+    chunk = os.urandom(2**20)
+    for n in range(file_count):
+        with (tree / 'data{}.bin'.format(n)).open('wb') as f:
+            for i in range(args.large_mb // file_count):
+                f.write(chunk)
+    size = tree_size(tree)
+    r = prepared_run(work_dir, write_blueprint(work_dir / 'bp', upload=[tree]))
+    results = [result('upload_large.size', size / 2**20, 'MB')]
+    for codec in ['none', 'zstd']:
+        r.blueprint.compression = codec
+        reset_upload(r, remote_home)
+        start_mt = monotime()
+        r.upload()
+        duration = monotime() - start_mt
+        results.append(result('upload_large.{}_throughput'.format(codec), size / 2**20 / duration, 'MB/s'))
+    return results
+
+
+if __name__ == '__main__':
+    main()